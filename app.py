@@ -3,6 +3,7 @@
 # This module was taken from MS examples as-is
 
 import sys
+import time
 import traceback
 from datetime import datetime
 
@@ -11,10 +12,8 @@ from aiohttp.web import Request, Response, json_response
 from botbuilder.core import (
     BotFrameworkAdapter,
     BotFrameworkAdapterSettings,
-    ConversationState,
     MemoryStorage,
     TurnContext,
-    UserState,
 )
 from botbuilder.core.integration import aiohttp_error_middleware
 from botbuilder.schema import Activity, ActivityTypes
@@ -23,7 +22,17 @@ from bots import DialogBot
 
 # Create the loop and Flask app
 from config import DefaultConfig
-from dialogs import MainDialog
+from dialogs import MainDialog, PersonDialog, TopLevelDialog
+from graph_client import GraphClient
+from helpers.quotes import QuoteService, YahooQuoteSource
+from helpers.executors import executor_stats, shutdown_executors
+from helpers.metrics import REGISTRY, TURN_ERRORS, TURN_SECONDS, TURNS_IN_FLIGHT, MetricFamily, stats_family
+from helpers.presence_subscriptions import PresenceSubscriptions
+from helpers.profiler import PROFILER
+from helpers.sqlite_storage import SqliteStorage
+from helpers.tracing import TRACER, FileSpanExporter, OTLPSpanExporter
+from helpers.tracked_state import TrackedConversationState, TrackedUserState
+from helpers.warmup import Warmup, import_modules
 
 CONFIG = DefaultConfig()
 
@@ -38,7 +47,9 @@ async def on_error(context: TurnContext, error: Exception):
     # This check writes out errors to console log .vs. app insights.
     # NOTE: In production environment, you should consider logging this to Azure
     #       application insights.
-    print(f"\n [on_turn_error] unhandled error: {error}", file=sys.stderr)
+    TURN_ERRORS.inc(type(error).__name__)
+    print(
+        f"\n [on_turn_error] unhandled error: {error} (trace {TRACER.current_trace_id()})", file=sys.stderr)
     traceback.print_exc()
 
     # Send a message to the user
@@ -68,16 +79,82 @@ async def on_error(context: TurnContext, error: Exception):
 # In this case, we want an unbound function, so MethodType is not needed.
 ADAPTER.on_turn_error = on_error
 
-# Create MemoryStorage and state
-MEMORY = MemoryStorage()
-USER_STATE = UserState(MEMORY)
-CONVERSATION_STATE = ConversationState(MEMORY)
+# Create the state storage and state
+if CONFIG.STATE_STORAGE == "sqlite":
+    STORAGE = SqliteStorage(
+        CONFIG.STATE_DB_PATH,
+        flush_interval=CONFIG.STATE_FLUSH_INTERVAL,
+        compact_interval=CONFIG.STATE_COMPACT_INTERVAL,
+        retention_days=CONFIG.STATE_RETENTION_DAYS,
+        max_entries=CONFIG.STATE_MEMORY_ENTRIES,
+    )
+else:
+    STORAGE = MemoryStorage()
+USER_STATE = TrackedUserState(STORAGE)
+CONVERSATION_STATE = TrackedConversationState(STORAGE)
+
+# Create the Graph client shared by all dialogs
+GRAPH_CLIENT = GraphClient()
+
+# Create the stock quote service refreshing in the background
+QUOTE_SERVICE = QuoteService(
+    YahooQuoteSource(), CONFIG.QUOTE_OPEN_INTERVAL, CONFIG.QUOTE_CLOSED_INTERVAL)
 
 # Create Dialog and Bot
-DIALOG = MainDialog(USER_STATE)
+DIALOG = MainDialog(USER_STATE, GRAPH_CLIENT, QUOTE_SERVICE)
 BOT = DialogBot(CONVERSATION_STATE, USER_STATE, DIALOG)
 
 
+# Statuses of the people PersonDialog can suggest, pushed by Graph change notifications
+async def presence_contacts() -> list:
+    top_level = await DIALOG.find_dialog(TopLevelDialog.__name__)
+    person = await top_level.find_dialog(PersonDialog.__name__)
+    return list((await person.tree_store.get_index()).node([]).emails)
+
+
+PRESENCE = None
+if CONFIG.PRESENCE_SUBSCRIPTIONS:
+    PRESENCE = PresenceSubscriptions(
+        GRAPH_CLIENT,
+        presence_contacts,
+        CONFIG.PRESENCE_NOTIFICATION_URL,
+        CONFIG.PRESENCE_CLIENT_STATE,
+        lifetime=CONFIG.PRESENCE_SUBSCRIPTION_LIFETIME,
+        renew_margin=CONFIG.PRESENCE_RENEW_MARGIN,
+    )
+    GRAPH_CLIENT.live_presence = PRESENCE
+
+# Turn tracing, see TRACE_EXPORTER in config.py
+if CONFIG.TRACE_EXPORTER == "file":
+    TRACER.exporter = FileSpanExporter(
+        CONFIG.TRACE_FILE_PATH, CONFIG.TRACE_SERVICE_NAME)
+elif CONFIG.TRACE_EXPORTER == "otlp":
+    TRACER.exporter = OTLPSpanExporter(
+        CONFIG.TRACE_OTLP_ENDPOINT, CONFIG.TRACE_SERVICE_NAME, CONFIG.TRACE_OTLP_HEADERS)
+TRACER.sample_rate = CONFIG.TRACE_SAMPLE_RATE
+TRACER.slow_threshold = CONFIG.TRACE_SLOW_THRESHOLD
+
+# Slow turn profiling, see PROFILE_SAMPLE_RATE in config.py
+PROFILER.sample_rate = CONFIG.PROFILE_SAMPLE_RATE
+PROFILER.slow_threshold = CONFIG.PROFILE_SLOW_THRESHOLD
+PROFILER.keep = CONFIG.PROFILE_KEEP
+PROFILER.admin_token = CONFIG.PROFILE_ADMIN_TOKEN
+
+# Start-up work run in the background once the listener is up.
+# Modules listed here are imported lazily by the code using them
+WARMUP = Warmup()
+if CONFIG.WARMUP_ON_STARTUP:
+    WARMUP.add("imports", lambda: import_modules(
+        ["PIL.Image", "yattag", "babel.dates"]))
+    WARMUP.add("graph_token", GRAPH_CLIENT.tokens.get_token)
+    # the quote service and the report catalogue recover from a failed start on their own
+    WARMUP.add("stock_quote", QUOTE_SERVICE.latest, optional=True)
+    WARMUP.add(
+        "reports",
+        lambda: GRAPH_CLIENT.report_catalogue().load(CONFIG.REPORTS_CHANNELS),
+        optional=True)
+
+
 # Listen for incoming requests on /api/messages.
 async def messages(req: Request) -> Response:
     # Main bot message handler.
@@ -89,14 +166,145 @@ async def messages(req: Request) -> Response:
     activity = Activity().deserialize(body)
     auth_header = req.headers["Authorization"] if "Authorization" in req.headers else ""
 
-    response = await ADAPTER.process_activity(activity, auth_header, BOT.on_turn)
+    TURNS_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    # unhandled exceptions are turned into error responses by the middleware
+    status = "error"
+    try:
+        with TRACER.trace(
+                "POST /api/messages",
+                **{
+                    "activity.type": activity.type or "",
+                    "activity.id": activity.id or "",
+                    "channel.id": activity.channel_id or "",
+                    "conversation.id": activity.conversation.id if activity.conversation else "",
+                }) as span, PROFILER.turn(activity):
+            response = await ADAPTER.process_activity(activity, auth_header, BOT.on_turn)
+            status = str(response.status) if response else "201"
+            span.set(**{"http.status_code": int(status)})
+    finally:
+        TURNS_IN_FLIGHT.dec()
+        TURN_SECONDS.observe(time.perf_counter() - started,
+                             activity.type or "", status)
     if response:
         return json_response(data=response.body, status=response.status)
     return Response(status=201)
 
 
+# Readiness probe: 200 once the warm-up has finished, 503 with the progress otherwise
+async def ready(req: Request) -> Response:
+    report = WARMUP.report()
+    return json_response(data=report, status=200 if report["ready"] else 503)
+
+
+# Counters and gauges the components keep anyway, collected when /metrics is scraped
+def component_metrics() -> list:
+    families = [
+        stats_family("bot_graph_resilience_total", "Graph requests, retries, failures and short-circuited calls", {
+            key: value for key, value in GRAPH_CLIENT.resilience.stats.items() if not key.endswith("_seconds")}),
+        MetricFamily("bot_graph_resilience_wait_seconds_total", "counter",
+                     "Seconds Graph calls waited for the rate limiter and before retries", [
+                         ({"reason": reason},
+                          GRAPH_CLIENT.resilience.stats[f"{reason}_wait_seconds"])
+                         for reason in ("rate_limit", "retry")]),
+        MetricFamily("bot_graph_circuit_open", "gauge", "Graph endpoints whose circuit is open or half-open", [
+            ({"endpoint": endpoint, "state": state}, 1)
+            for endpoint, state in GRAPH_CLIENT.resilience.report()["circuits"].items()]),
+    ]
+    if GRAPH_CLIENT.cache is not None:
+        families += [
+            stats_family("bot_cache_events_total", "Graph cache hits, misses, evictions and coalesced loads",
+                         GRAPH_CLIENT.cache.stats),
+            MetricFamily("bot_cache_entries", "gauge", "Entries in the Graph cache",
+                         [({}, len(GRAPH_CLIENT.cache))]),
+        ]
+    # one family per metric holding the samples of all the pools, a repeated TYPE line fails the whole scrape
+    pools = executor_stats()
+    families += [
+        MetricFamily("bot_executor_jobs_total", "counter", "Worker pool jobs submitted, started, completed and failed", [
+            ({"pool": name, "event": event}, stats[event])
+            for name, stats in pools.items() for event in ("submitted", "started", "completed", "failed")]),
+        MetricFamily("bot_executor_seconds_total", "counter", "Seconds worker pool jobs spent queued and running", [
+            ({"pool": name, "phase": phase}, stats[f"{phase}_seconds_total"])
+            for name, stats in pools.items() for phase in ("wait", "run")]),
+        MetricFamily("bot_executor_jobs", "gauge", "Worker pool jobs queued and running right now", [
+            ({"pool": name, "state": state}, stats[state])
+            for name, stats in pools.items() for state in ("queue_depth", "in_flight")]),
+        MetricFamily("bot_executor_wait_seconds_max", "gauge", "Longest time a worker pool job has been queued", [
+            ({"pool": name}, stats["wait_seconds_max"]) for name, stats in pools.items()]),
+    ]
+    if isinstance(STORAGE, SqliteStorage):
+        families.append(stats_family("bot_state_storage_total", "State storage reads, writes and flushes",
+                                     STORAGE.stats))
+    families.append(MetricFamily("bot_reports_synced_timestamp_seconds", "gauge", "Last sync of the report catalogue", [
+        ({}, GRAPH_CLIENT.report_catalogue().synced_at)]))
+    if TRACER.exporter is not None:
+        families += [
+            stats_family(
+                "bot_traces_total", "Turn traces started, exported and dropped by sampling", TRACER.stats),
+            stats_family("bot_trace_spans_total", "Spans exported and dropped by the trace exporter",
+                         TRACER.exporter.stats),
+        ]
+    if PROFILER.enabled:
+        families.append(stats_family("bot_turn_profiles_total", "Turns profiled, kept and skipped by the profiler",
+                                     PROFILER.stats))
+    if PRESENCE is not None:
+        families.append(stats_family("bot_presence_subscriptions_total", "Presence notifications and subscriptions",
+                                     PRESENCE.stats))
+    return families
+
+
+REGISTRY.register(component_metrics)
+
+
+# Prometheus-style metrics: turn, dialog step and Graph call histograms and the component counters
+async def metrics(req: Request) -> Response:
+    return Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_background_services(app: web.Application):
+    # nothing here may block: the listener only comes up once the start-up hooks return.
+    # The refresh loops run in the lazy mode too, only the warm-up jobs are skipped there
+    QUOTE_SERVICE.start()
+    # acquire the Graph token before the first user turn and keep it fresh
+    GRAPH_CLIENT.tokens.start()
+    WARMUP.start()
+    TRACER.start()
+    if PRESENCE is not None:
+        # subscribed once the listener is up, Graph validates the notification URL while subscribing
+        PRESENCE.start()
+    if isinstance(STORAGE, SqliteStorage):
+        STORAGE.start()
+
+
+async def stop_background_services(app: web.Application):
+    # stop the refresh loops and release the pooled Graph connections on shutdown
+    await WARMUP.stop()
+    if PRESENCE is not None:
+        await PRESENCE.stop()
+    await QUOTE_SERVICE.stop()
+    await GRAPH_CLIENT.close()
+    await TRACER.stop()
+    if isinstance(STORAGE, SqliteStorage):
+        # flush the state written during the last turns before the I/O pool goes down
+        await STORAGE.close()
+    shutdown_executors(wait=False)
+
+
 APP = web.Application(middlewares=[aiohttp_error_middleware])
 APP.router.add_post("/api/messages", messages)
+APP.router.add_get("/ready", ready)
+if CONFIG.METRICS_ENABLED:
+    APP.router.add_get("/metrics", metrics)
+if CONFIG.PROFILE_ADMIN_TOKEN:
+    # retained turn profiles, {name} is {id}.pstats or {id}.folded
+    APP.router.add_get("/admin/profiles", PROFILER.list_handler)
+    APP.router.add_get("/admin/profiles/{name}", PROFILER.download_handler)
+if PRESENCE is not None:
+    # Graph change notifications of the contacts' statuses
+    APP.router.add_post("/api/presence", PRESENCE.notification_handler)
+APP.on_startup.append(start_background_services)
+APP.on_cleanup.append(stop_background_services)
 
 if __name__ == "__main__":
     try:
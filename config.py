@@ -9,3 +9,131 @@ class DefaultConfig:
     PORT = 3978
     APP_ID = os.environ.get("MicrosoftAppId", "")
     APP_PASSWORD = os.environ.get("MicrosoftAppPassword", "")
+
+    # Graph authentication. With CLIENT_SECRET set the non-interactive client credentials flow is used,
+    # otherwise the device flow. TOKEN_CACHE_PATH persists the msal token cache between restarts
+    CLIENT_SECRET = os.environ.get("CLIENT_SECRET", "")
+    TOKEN_CACHE_PATH = os.environ.get("TOKEN_CACHE_PATH", "")
+    TOKEN_REFRESH_MARGIN = float(os.environ.get("TOKEN_REFRESH_MARGIN", 300))
+
+    # base URI of the Graph API, i.e. http://127.0.0.1:8765/ for the local stand-in from tools.fake_graph_server.
+    # With GRAPH_ACCESS_TOKEN set that token is sent as is and no token is acquired from Azure AD
+    GRAPH_RESOURCE_URI = os.environ.get("GRAPH_RESOURCE_URI", "https://graph.microsoft.com/")
+    GRAPH_ACCESS_TOKEN = os.environ.get("GRAPH_ACCESS_TOKEN", "")
+
+    # warm heavy modules, templates, the Graph token and the stock quote up in the background right after
+    # the listener is up. With "0" they are loaded lazily on first use, the token and quote refresh loops
+    # run either way. /ready reports the progress
+    WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") == "1"
+
+    # user and conversation state storage: "sqlite" (durable) or "memory". SQLite writes are collected for
+    # STATE_FLUSH_INTERVAL seconds and committed in one transaction, the database is compacted every
+    # STATE_COMPACT_INTERVAL seconds, dropping state neither read nor written for STATE_RETENTION_DAYS
+    # (0 keeps it forever)
+    STATE_STORAGE = os.environ.get("STATE_STORAGE", "sqlite")
+    STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "bot_state.sqlite3")
+    STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", 0.05))
+    STATE_COMPACT_INTERVAL = float(os.environ.get("STATE_COMPACT_INTERVAL", 3600))
+    STATE_RETENTION_DAYS = float(os.environ.get("STATE_RETENTION_DAYS", 90))
+    STATE_MEMORY_ENTRIES = int(os.environ.get("STATE_MEMORY_ENTRIES", 4096))
+
+    # worker threads for blocking network/disk calls and for CPU-bound work (0 means one per CPU)
+    EXECUTOR_IO_WORKERS = int(os.environ.get("EXECUTOR_IO_WORKERS", 16))
+    EXECUTOR_CPU_WORKERS = int(os.environ.get("EXECUTOR_CPU_WORKERS", 0))
+
+    # Graph HTTP session: pool size (total and per host), keep-alive and timeouts in seconds
+    GRAPH_CONN_LIMIT = int(os.environ.get("GRAPH_CONN_LIMIT", 100))
+    GRAPH_CONN_LIMIT_PER_HOST = int(
+        os.environ.get("GRAPH_CONN_LIMIT_PER_HOST", 20))
+    GRAPH_KEEPALIVE_TIMEOUT = float(
+        os.environ.get("GRAPH_KEEPALIVE_TIMEOUT", 60))
+    GRAPH_CONNECT_TIMEOUT = float(os.environ.get("GRAPH_CONNECT_TIMEOUT", 5))
+    GRAPH_TOTAL_TIMEOUT = float(os.environ.get("GRAPH_TOTAL_TIMEOUT", 30))
+
+    # items per page requested from Graph collections ($top), 0 leaves the page size to Graph
+    GRAPH_PAGE_SIZE = int(os.environ.get("GRAPH_PAGE_SIZE", 200))
+
+    # Graph resilience: retries of throttled (429) and transiently failing calls with jittered exponential
+    # backoff starting at GRAPH_RETRY_BASE_DELAY seconds, calls asked to wait longer than GRAPH_RETRY_MAX_DELAY
+    # aren't retried. The circuit of an endpoint opens after GRAPH_BREAKER_THRESHOLD 5xx failures in a row
+    # for GRAPH_BREAKER_RESET_TIMEOUT seconds. Requests per second and burst size of the client-side rate limiter,
+    # GRAPH_RATE_LIMIT=0 disables it
+    GRAPH_RETRY_ATTEMPTS = int(os.environ.get("GRAPH_RETRY_ATTEMPTS", 3))
+    GRAPH_RETRY_BASE_DELAY = float(os.environ.get("GRAPH_RETRY_BASE_DELAY", 0.5))
+    GRAPH_RETRY_MAX_DELAY = float(os.environ.get("GRAPH_RETRY_MAX_DELAY", 10))
+    GRAPH_BREAKER_THRESHOLD = int(os.environ.get("GRAPH_BREAKER_THRESHOLD", 5))
+    GRAPH_BREAKER_RESET_TIMEOUT = float(os.environ.get("GRAPH_BREAKER_RESET_TIMEOUT", 30))
+    GRAPH_RATE_LIMIT = float(os.environ.get("GRAPH_RATE_LIMIT", 50))
+    GRAPH_RATE_BURST = float(os.environ.get("GRAPH_RATE_BURST", 100))
+
+    # combine Graph lookups issued within GRAPH_BATCH_WINDOW seconds into $batch calls
+    GRAPH_BATCHING = os.environ.get("GRAPH_BATCHING", "1") == "1"
+    GRAPH_BATCH_WINDOW = float(os.environ.get("GRAPH_BATCH_WINDOW", 0.005))
+
+    # in-process cache of directory data. Set CACHE_MAX_ENTRIES to 0 to disable it.
+    # TTLs are in seconds, the negative TTL applies to "Not Available"-like placeholders
+    CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 2048))
+    CACHE_TTL_DIRECTORY = float(os.environ.get("CACHE_TTL_DIRECTORY", 6 * 3600))
+    CACHE_TTL_PRESENCE = float(os.environ.get("CACHE_TTL_PRESENCE", 30))
+    CACHE_TTL_AUTOREPLY = float(os.environ.get("CACHE_TTL_AUTOREPLY", 300))
+    CACHE_TTL_NEGATIVE = float(os.environ.get("CACHE_TTL_NEGATIVE", 60))
+
+    # profile photo thumbnails: in-memory limit and an optional folder to persist them across restarts
+    THUMBNAIL_MEMORY_ENTRIES = int(os.environ.get("THUMBNAIL_MEMORY_ENTRIES", 512))
+    THUMBNAIL_CACHE_DIR = os.environ.get("THUMBNAIL_CACHE_DIR", "")
+
+    # seconds after which PersonDialog revalidates its decision tree in the background
+    TREE_MAX_STALENESS = float(os.environ.get("TREE_MAX_STALENESS", 300))
+
+    # seconds between stock quote refreshes while the exchange is open and closed
+    QUOTE_OPEN_INTERVAL = float(os.environ.get("QUOTE_OPEN_INTERVAL", 60))
+    QUOTE_CLOSED_INTERVAL = float(os.environ.get("QUOTE_CLOSED_INTERVAL", 1800))
+
+    # ChemCourier report catalogue: seconds between delta syncs, seconds after which a download link
+    # is fetched again (Graph links expire in about an hour) and the channel folders listed on startup
+    REPORTS_SYNC_INTERVAL = float(os.environ.get("REPORTS_SYNC_INTERVAL", 300))
+    REPORTS_LINK_TTL = float(os.environ.get("REPORTS_LINK_TTL", 1800))
+    REPORTS_CHANNELS = [
+        channel for channel in os.environ.get("REPORTS_CHANNELS", "Deco,Industry").split(",") if channel]
+
+    # keep the statuses of the PersonDialog contacts current with Graph change notifications instead of polling.
+    # PRESENCE_NOTIFICATION_URL is the public HTTPS address of the /api/presence route, PRESENCE_CLIENT_STATE
+    # the secret Graph sends back with every notification. Subscriptions live for PRESENCE_SUBSCRIPTION_LIFETIME
+    # seconds (an hour at most) and are renewed PRESENCE_RENEW_MARGIN seconds before they expire
+    PRESENCE_SUBSCRIPTIONS = os.environ.get("PRESENCE_SUBSCRIPTIONS", "0") == "1"
+    PRESENCE_NOTIFICATION_URL = os.environ.get("PRESENCE_NOTIFICATION_URL", "")
+    PRESENCE_CLIENT_STATE = os.environ.get("PRESENCE_CLIENT_STATE", "")
+    PRESENCE_SUBSCRIPTION_LIFETIME = float(os.environ.get("PRESENCE_SUBSCRIPTION_LIFETIME", 3600))
+    PRESENCE_RENEW_MARGIN = float(os.environ.get("PRESENCE_RENEW_MARGIN", 600))
+
+    # serve the turn, dialog step and Graph call histograms and the component counters on /metrics
+    # in the Prometheus text format
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+
+    # turn tracing, from the incoming activity down to the Graph calls and the worker pool jobs.
+    # TRACE_EXPORTER is "file" (OTLP/JSON lines appended to TRACE_FILE_PATH), "otlp" (posted to the OTLP/HTTP
+    # collector at TRACE_OTLP_ENDPOINT with the comma-separated key=value TRACE_OTLP_HEADERS) or "" to disable it.
+    # TRACE_SAMPLE_RATE of the turns are kept, the ones slower than TRACE_SLOW_THRESHOLD seconds and the failed ones
+    # are always kept
+    TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "")
+    TRACE_FILE_PATH = os.environ.get("TRACE_FILE_PATH", "traces.jsonl")
+    TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+    TRACE_OTLP_HEADERS = dict(
+        pair.split("=", 1) for pair in os.environ.get("TRACE_OTLP_HEADERS", "").split(",") if "=" in pair)
+    TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.01))
+    TRACE_SLOW_THRESHOLD = float(os.environ.get("TRACE_SLOW_THRESHOLD", 2.0))
+    TRACE_SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "fao-helper-bot")
+
+    # cProfile capture of the turns: PROFILE_SAMPLE_RATE of the turns are profiled from their start and the rest
+    # from the moment they have run for PROFILE_SLOW_THRESHOLD seconds, 0 disables either. The PROFILE_KEEP slowest
+    # profiles (0 disables the profiling) are served as pstats and folded stacks on /admin/profiles to requests
+    # carrying "Authorization: Bearer PROFILE_ADMIN_TOKEN", the routes are off without a token
+    PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.0))
+    PROFILE_SLOW_THRESHOLD = float(os.environ.get("PROFILE_SLOW_THRESHOLD", 0.0))
+    PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 20))
+    PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN", "")
+    if min(PROFILE_SAMPLE_RATE, PROFILE_SLOW_THRESHOLD, PROFILE_KEEP) < 0:
+        raise ValueError("PROFILE_SAMPLE_RATE, PROFILE_SLOW_THRESHOLD and PROFILE_KEEP can't be negative")
+
+    # max number of Graph lookups PersonDialog runs at once while assembling cards
+    PERSON_CARD_CONCURRENCY = int(os.environ.get("PERSON_CARD_CONCURRENCY", 10))
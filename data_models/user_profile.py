@@ -3,16 +3,24 @@ from typing import List
 
 class UserProfile:
     """Class used to store user data as part of a user_state.
+    Keeps track of its own changes, so the user state is only written when the profile has actually changed,
+    and is serialized into a compact versioned list instead of an attribute dict.
 
     Attributes:
     email (str): User's email. Defaults to None.
     phone (str): User's phone number (mobile). Defaults to None.
-    names (List[str]): names of employees who can cover for the user while they are out of office.
+    names (Tuple[str]): names of employees who can cover for the user while they are out of office.
     Defaults to None.
-    areas (List[str]): areas of expertise associated with employees covering for the user. Defaults to None.
+    areas (Tuple[str]): areas of expertise associated with employees covering for the user. Defaults to None.
     lang (str): target language of the user. Defaults to "RU".
+    dirty (bool): whether the profile has changed since it was loaded or last saved
     """
 
+    # version of the serialized form, bump it when changing FIELDS and teach _restore the previous layout
+    VERSION = 1
+    FIELDS = ("email", "phone", "names", "areas", "lang")
+    __slots__ = FIELDS + ("dirty",)
+
     def __init__(
             self,
             email: str = None,
@@ -20,7 +28,7 @@ class UserProfile:
             names: List[str] = None,
             areas: List[str] = None,
             lang: str = "RU"):
-        """inits the UserProfile instance
+        """inits the UserProfile instance. A new profile is dirty, i.e. it will be saved
 
         Args:
             email (str, optional): User's email. Defaults to None.
@@ -32,6 +40,62 @@ class UserProfile:
         """
         self.email: str = email
         self.phone: str = phone
-        self.names: List[str] = names
-        self.areas: List[str] = areas
+        self.names = names
+        self.areas = areas
         self.lang: str = lang
+        self.dirty = True
+
+    def __setattr__(self, name: str, value):
+        """Sets an attribute and marks the profile dirty if its value has changed.
+        Lists are stored as tuples, so they can't be changed in place unnoticed"""
+        if name in ("names", "areas") and value is not None:
+            value = tuple(value)
+        if name != "dirty" and getattr(self, name, None) != value:
+            object.__setattr__(self, "dirty", True)
+        object.__setattr__(self, name, value)
+
+    def mark_clean(self):
+        """Marks the profile as saved"""
+        object.__setattr__(self, "dirty", False)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, UserProfile) and self.__getstate__() == other.__getstate__()
+
+    def __getstate__(self) -> list:
+        """Returns the compact serialized form used by jsonpickle
+
+        Returns:
+            list: [VERSION, email, phone, names, areas, lang]
+        """
+        # tuples would be tagged by jsonpickle, lists are stored as plain json arrays
+        return [self.VERSION] + [
+            list(value) if isinstance(value, tuple) else value
+            for value in (getattr(self, field) for field in self.FIELDS)]
+
+    def __setstate__(self, state):
+        """Restores the profile from its serialized form. A restored profile is clean
+
+        Args:
+            state: list produced by __getstate__ or the attribute dict written before the profile was versioned
+        """
+        self._restore(state)
+        self.mark_clean()
+
+    def _restore(self, state):
+        """Fills the attributes in from any of the known serialized layouts
+
+        Args:
+            state: list produced by __getstate__ or the attribute dict written before the profile was versioned
+
+        Raises:
+            ValueError: raised if the serialized form is of an unknown version
+        """
+        if isinstance(state, dict):
+            values = [state.get(field) for field in self.FIELDS]
+            values[-1] = values[-1] or "RU"
+        elif state and state[0] == 1:
+            values = state[1:]
+        else:
+            raise ValueError(f"Unknown UserProfile version: {state[:1]}")
+        for field, value in zip(self.FIELDS, values):
+            setattr(self, field, value)
@@ -1,6 +1,5 @@
 from typing import List
 from botbuilder.dialogs import (
-    WaterfallDialog,
     WaterfallStepContext,
     DialogTurnResult,
     ComponentDialog,
@@ -12,11 +11,11 @@ from botbuilder.core import MessageFactory, CardFactory, ConversationState, User
 from botbuilder.schema import Attachment, Activity, ActivityTypes
 import re
 import json
-import os
 from datetime import datetime
 from graph_client import GraphClient
-from yattag import Doc
 from data_models import UserProfile
+from helpers.card_templates import get_registry
+from helpers.dialog_helper import TimedWaterfallDialog
 
 
 class AutoreplyDialog(ComponentDialog):
@@ -26,7 +25,8 @@ class AutoreplyDialog(ComponentDialog):
 
     Attributes:
         DONE_OPTION(str): word a user has to send to the bot to cancel the dialog at any stage
-        CARD_PATH(list): path to an Adaptive Card json template
+        CARD_NAME(str): name of the Adaptive Card template
+        templates(CardTemplateRegistry): registry holding the preloaded Adaptive Card templates
         client(GraphClient): MS Graph client instance associated with this dialog. Used to perform all calls to the Graph API
         user_state(UserState): user state storage object
         accessor(StatePropertyAccessor): State property accessors are used to read or write state properties,
@@ -50,7 +50,8 @@ class AutoreplyDialog(ComponentDialog):
         super().__init__(dialog_id or AutoreplyDialog.__name__)
 
         self.DONE_OPTION = 'завершить'
-        self.CARD_PATH = ["cards_templates", "Autoreply_card"]
+        self.CARD_NAME = "Autoreply_card"
+        self.templates = get_registry()
         self.client = client
         self.user_state = user_state
         self.accessor = self.user_state.create_property("UserProfile")
@@ -58,7 +59,7 @@ class AutoreplyDialog(ComponentDialog):
 
         # add validator if it flies
         self.add_dialog(TextPrompt("fake", AutoreplyDialog.validation_wrapper))
-        self.add_dialog(WaterfallDialog(
+        self.add_dialog(TimedWaterfallDialog(
             "WFDiag", [
                 self.card_step,
                 self.final_step,
@@ -77,14 +78,15 @@ class AutoreplyDialog(ComponentDialog):
             DialogTurnResult: result of calling the prompt stack manipulation method.
             Contains the users' response.
         """
-        self.user_info: UserProfile = await self.accessor.get(step_context.context, UserProfile)
+        # the profile lives in the user state, never on the dialog shared by all the conversations
+        user_info: UserProfile = await self.accessor.get(step_context.context, UserProfile)
         msg = "Я помогу тебе установить автоответ и ничего не забыть! Для этого заполни, пожалуйста, маленькую форму ниже или отправь 'Завершить'"
         await step_context.context.send_activity(msg)
         # не забыть удалить messageback из джейсона карты, т.к. код уже заточен
         # под postback
         card_msg = Activity(
             type=ActivityTypes.message,
-            attachments=[self._populate_with_data(rel_path=self.CARD_PATH)],
+            attachments=[self._populate_with_data(card_name=self.CARD_NAME, user_info=user_info)],
         )
         prompt_options = PromptOptions(
             prompt=None,
@@ -97,7 +99,7 @@ class AutoreplyDialog(ComponentDialog):
         return await step_context.prompt("fake", options=prompt_options)
 
     async def final_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
-        """Writes the user input to the user_info attribute and sets the autoreply.
+        """Writes the user input to the user's profile and sets the autoreply.
 
         Args:
             step_context (WaterfallStepContext): the context for the current dialog turn
@@ -121,12 +123,13 @@ class AutoreplyDialog(ComponentDialog):
             msg_json['area3'],
             msg_json['area4']]
 
-        self.user_info.areas = areas
-        self.user_info.names = names
-        self.user_info.lang = msg_json['language']
-        self.user_info.phone = msg_json['phone']
-        await self.accessor.set(step_context.context, self.user_info)
-        await self.user_state.save_changes(step_context.context)
+        user_info: UserProfile = await self.accessor.get(step_context.context, UserProfile)
+        user_info.areas = areas
+        user_info.names = names
+        user_info.lang = msg_json['language']
+        user_info.phone = msg_json['phone']
+        # DialogBot.on_turn saves the user state once the turn is over, and only if the profile has changed
+        await self.accessor.set(step_context.context, user_info)
 
         msg = self._message_constructor(
             msg_json['reason'],
@@ -261,6 +264,8 @@ class AutoreplyDialog(ComponentDialog):
         eng_temp = (
             f"Dear colleagues,<br>please be informed that from {startdate} to {enddate} I will be {reasons_dict[reason]['ENG']}."
             f" {repl_dict['ENG']} {phone_dict['ENG']}")
+        from yattag import Doc
+
         doc, tag, text = Doc().tagtext()
         with tag('html'):
             with tag('body'):
@@ -279,18 +284,20 @@ class AutoreplyDialog(ComponentDialog):
 
     def _populate_with_data(
             self,
-            rel_path: list,
+            card_name: str,
+            user_info: UserProfile,
             startdate=None,
             enddate=None,
             phone=None,
             lang=None,
             rep_names: list = None,
             rep_areas: list = None) -> Attachment:
-        """Pre-fills the Adaptive card template based on the info from the user_info attribute
+        """Pre-fills the Adaptive card template based on the info from the user's profile
         so the user doesn't have to make all the inputs in case of input mistakes
 
         Args:
-            rel_path (list): path to the Adaptive card json file structured as a list [folder, filename]
+            card_name (str): name of the Adaptive card template
+            user_info (UserProfile): profile of the user the card is sent to
             startdate (datetime.date, optional): Start date of an autoreply. Defaults to None.
             enddate (datetime.date, optional): End date of an rutoreply. Defaults to None.
             phone (str, optional): phone number. Defaults to None.
@@ -310,36 +317,28 @@ class AutoreplyDialog(ComponentDialog):
         if enddate is None:
             enddate = self.today
         if rep_names is None:
-            rep_names = self.user_info.names
+            rep_names = user_info.names
         if rep_areas is None:
-            rep_areas = self.user_info.areas
+            rep_areas = user_info.areas
         if lang is None:
-            lang = self.user_info.lang
+            lang = user_info.lang
         if phone is None:
-            phone = self.user_info.phone
-
-        # constructing the full path and accesing the name.
-        # This whole "folder-filename" as a list thing is needed to make a
-        # filepath OS-agnostic
-        this_file = os.getcwd()
-        full_path = os.path.join(this_file, *rel_path)
-        with open(full_path, "r", encoding='utf-8') as card_file:
-            card_json = json.load(card_file)
+            phone = user_info.phone
 
         start = datetime.strftime(startdate, "%Y-%m-%d")
         end = datetime.strftime(enddate, "%Y-%m-%d")
 
-        card_json['body'][2]["min"] = start
-        card_json['body'][2]["value"] = start
-        card_json['body'][4]["min"] = end
-        card_json['body'][4]["value"] = end
-        card_json['body'][6]['value'] = phone
+        slots = {
+            "startdate": {"min": start, "value": start},
+            "enddate": {"min": end, "value": end},
+            "phone": {"value": phone},
+            "language": {"value": lang},
+        }
         if rep_names:
             for i in range(4):
-                card_json['body'][8]['columns'][0]['items'][i]['value'] = rep_names[i]
-                card_json['body'][8]['columns'][1]['items'][i]['value'] = rep_areas[i]
-        card_json['body'][10]['value'] = lang
-        return CardFactory.adaptive_card(card_json)
+                slots[f"name{i + 1}"] = {"value": rep_names[i]}
+                slots[f"area{i + 1}"] = {"value": rep_areas[i]}
+        return CardFactory.adaptive_card(self.templates.render(card_name, slots))
 
     @staticmethod
     async def phone_validator(num_to_validate: str) -> bool:
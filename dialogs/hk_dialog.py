@@ -1,7 +1,6 @@
 from graph_client import GraphClient
 from typing import List
 from botbuilder.dialogs import (
-    WaterfallDialog,
     WaterfallStepContext,
     DialogTurnResult,
     ComponentDialog,
@@ -11,6 +10,7 @@ from botbuilder.dialogs.choices import Choice
 from botbuilder.dialogs.choices.list_style import ListStyle
 from botbuilder.core import MessageFactory
 from graph_client import GraphClient
+from helpers.dialog_helper import TimedWaterfallDialog
 import re
 
 
@@ -22,6 +22,8 @@ class HKDialog(ComponentDialog):
             DONE_OPTION(str): word a user has to send to the bot to cancel the dialog at any stage
             LAST_OPTION(str): word a user has to send to the bot to get the latest available report
             SELECTED_CHANNEL(str): Key name to store this dialogs state info in the StepContext
+            QUERY(str): Key name to store the file name prefix of the selected channel in the StepContext
+            MAX_PERIOD(str): Key name to store the latest available report of the selected channel in the StepContext
             DRIVE_ID(str): id of the drive resource where the report files reside
             SITE_ID(str): id of the Sharepoint site where the report files reside
             client(GraphClient): MS Graph client instance associated with this dialog. Used to perform all calls to the Graph API
@@ -44,9 +46,9 @@ class HKDialog(ComponentDialog):
         self.SELECTED_CHANNEL = 'value-selectedChannel'
         self.DRIVE_ID = "b!iRCqps0M3E6-aQPU3EqrwtQWpaUslmNGiehCSqvs_PgkFFzTCYK_Sa7Y0KpehzLj"
         self.SITE_ID = "tikkurila.sharepoint.com,a6aa1089-0ccd-4edc-be69-03d4dc4aabc2,a5a516d4-962c-4663-89e8-424aabecfcf8"
+        self.QUERY = 'value-query'
+        self.MAX_PERIOD = 'value-maxPeriod'
         self.client = client
-        self._query = ""
-        self._max_period = ""
 
         self.options_list = {
             "Деко": "Deco",
@@ -56,7 +58,7 @@ class HKDialog(ComponentDialog):
 
         self.add_dialog(ChoicePrompt('channels'))
         self.add_dialog(TextPrompt('dates', HKDialog.query_validator))
-        self.add_dialog(WaterfallDialog(
+        self.add_dialog(TimedWaterfallDialog(
             "WFDiag", [
                 self.channel_step,
                 self.dates_step,
@@ -117,26 +119,27 @@ class HKDialog(ComponentDialog):
         if selected == self.DONE_OPTION:
             return await step_context.end_dialog()
 
-        max_period = await self.client.get_latest(channel=self.options_list[selected])
-        self._max_period = max_period[0:-4]
-        self._query = self.options_list[selected]
+        latest = await self.client.get_latest(channel=self.options_list[selected])
+        # kept in the dialog state, the dialog instance is shared by all the conversations
+        max_period = step_context.values[self.MAX_PERIOD] = latest[0:-4]
+        query = step_context.values[self.QUERY] = self.options_list[selected]
 
         message = (
             f"Введите максимум 4 периода через запятую в следующем формате: 2019Q1, 2019Q2 и т.п."
             f"Для получения данных за полный год выбирайте четвертый квартал."
             f"Чтобы получить только самый последний отчет, отправьте слово '{self.LAST_OPTION}' и только его"
             f"(запрос вида '2018Q2, {self.LAST_OPTION}' не сработает).  \n"
-            f"Последний доступный отчет: {self._max_period}.  \n Чтобы завершить диалог, отправьте '{self.DONE_OPTION}'")
+            f"Последний доступный отчет: {max_period}.  \n Чтобы завершить диалог, отправьте '{self.DONE_OPTION}'")
 
         retry_message = (
             f"Пожалуйста, введите данные в правильном формате и на дату не позднее последней доступной."
-            f"Напоминаю, последний доступный отчет: {self._max_period}\n\n"
+            f"Напоминаю, последний доступный отчет: {max_period}\n\n"
             f"Правильный формат данных: 2019Q1, 2019Q2.\n\nЧтобы завершить диалог, отправьте '{self.DONE_OPTION}'")
 
         prompt_options = PromptOptions(
             prompt=MessageFactory.text(message),
             retry_prompt=MessageFactory.text(retry_message),
-            validations=self._max_period.replace(self._query, ""),
+            validations=max_period.replace(query, ""),
         )
 
         return await step_context.prompt('dates', options=prompt_options)
@@ -154,9 +157,9 @@ class HKDialog(ComponentDialog):
         if selected == self.DONE_OPTION:
             return await step_context.end_dialog()
         if selected == self.LAST_OPTION:
-            selected = self._max_period.replace("Deco", "").replace("Ind", "")
+            selected = step_context.values[self.MAX_PERIOD].replace("Deco", "").replace("Ind", "")
 
-        for_graph = self._choice_to_list(prefix=self._query, selected=selected)
+        for_graph = self._choice_to_list(prefix=step_context.values[self.QUERY], selected=selected)
         for_message = await self.client.get_links(site_id=self.SITE_ID, drive_id=self.DRIVE_ID, checklist=for_graph)
         for_message = [
             "[" + key + "](" + for_message[key] + ")" for key in for_message]
@@ -1,6 +1,5 @@
 from typing import List
 from botbuilder.dialogs import (
-    WaterfallDialog,
     WaterfallStepContext,
     DialogTurnResult,
     ComponentDialog,
@@ -8,6 +7,7 @@ from botbuilder.dialogs import (
 from botbuilder.dialogs.prompts import ChoicePrompt, PromptOptions
 from botbuilder.dialogs.choices import Choice, FoundChoice
 from botbuilder.core import MessageFactory
+from helpers.dialog_helper import TimedWaterfallDialog
 
 
 class LinksDialog(ComponentDialog):
@@ -35,7 +35,7 @@ class LinksDialog(ComponentDialog):
 
         self.add_dialog(ChoicePrompt('links_options'))
         self.add_dialog(
-            WaterfallDialog("LinksWF",
+            TimedWaterfallDialog("LinksWF",
                             [
                                 self.selection_step,
                                 self.loop_step,
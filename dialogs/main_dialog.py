@@ -1,6 +1,5 @@
 from botbuilder.dialogs import (
     ComponentDialog,
-    WaterfallDialog,
     WaterfallStepContext,
     DialogTurnResult,
 )
@@ -8,6 +7,9 @@ from botbuilder.core import MessageFactory, UserState
 
 from data_models import UserProfile
 from dialogs.top_level_dialog import TopLevelDialog
+from graph_client import GraphClient
+from helpers.quotes import QuoteService
+from helpers.dialog_helper import TimedWaterfallDialog
 
 
 class MainDialog(ComponentDialog):
@@ -15,13 +17,17 @@ class MainDialog(ComponentDialog):
     Inherits from ComponentsDialog class
     """
 
-    def __init__(self, user_state: UserState):
+    def __init__(self, user_state: UserState, client: GraphClient = None, quote_service: QuoteService = None):
         """inits the MainDialog instance, creates the TopLevelDialog from which all the branching occurs
 
         Args:
             user_state (UserState): user state storage object. Each user bot communicates with
             will have its own isolated storage object that can be used to persist information
             about the user across the entire conversation(s) with that user.
+            client (GraphClient, optional): MS Graph client passed down to the TopLevelDialog.
+            Defaults to None.
+            quote_service (QuoteService, optional): service keeping the latest stock quote,
+            passed down to the TopLevelDialog. Defaults to None.
         """
         super(MainDialog, self).__init__(MainDialog.__name__)
 
@@ -30,9 +36,11 @@ class MainDialog(ComponentDialog):
         self.add_dialog(
             TopLevelDialog(
                 dialog_id=TopLevelDialog.__name__,
-                user_state=self.user_state))
+                user_state=self.user_state,
+                client=client,
+                quote_service=quote_service))
         self.add_dialog(
-            WaterfallDialog("WFDialog", [self.initial_step, self.final_step])
+            TimedWaterfallDialog("WFDialog", [self.initial_step, self.final_step])
         )
 
         self.initial_dialog_id = "WFDialog"
@@ -1,35 +1,38 @@
-from typing import Iterable, List
+from typing import List
 from botbuilder.dialogs import (
-    WaterfallDialog,
     WaterfallStepContext,
     DialogTurnResult,
     ComponentDialog,
 )
-from botbuilder.dialogs.prompts import ChoicePrompt, PromptOptions, TextPrompt, PromptValidatorContext
-from botbuilder.dialogs.choices import Choice, FoundChoice
+from botbuilder.dialogs.prompts import ChoicePrompt, PromptOptions
+from botbuilder.dialogs.choices import Choice
 from botbuilder.dialogs.choices.list_style import ListStyle
 from botbuilder.schema import Attachment, Activity, ActivityTypes
 from botbuilder.core import MessageFactory, CardFactory
 from graph_client import GraphClient
-from functools import reduce
-import os
-import operator
-import json
+from config import DefaultConfig
+from helpers.decision_tree import DecisionTreeStore
+from helpers.card_templates import get_registry
+from helpers.dialog_helper import TimedWaterfallDialog
+import asyncio
 
 
 class PersonDialog(ComponentDialog):
     """This is a dialog designed to guide a user through a decision tree
-    to help them choose the right person to contact with their inquiry
+    to help them choose the right person to contact with their inquiry.
+    The same pair of steps is repeated for every level, so the tree can be of any depth.
 
         Attributes:
             DONE_OPTION(str): word a user has to send to the bot to cancel the dialog at any stage
+            SELECTED_PATH(str): Key name to store the options selected so far in the StepContext
             SITE_ID(str): id of the Sharepoint site where the json file describing the tree structure resides
             DRIVE_ID(str): id of the drive resource where the json file describing the tree structure resides
-            selected_keys(list): list of jsoon keys selected by the user
             client(GraphClient): MS Graph client instance associated with this dialog. Used to perform all calls to the Graph API
-            json_path(str): json file describing a tree structure being navigated by the user
-            options_list(list): a list containing all the top level choices available to the user.
-            Can be also viewed as a list of the top-level keys in the tree structure
+            tree_store(DecisionTreeStore): shared, periodically revalidated copy of the tree json
+            and its compiled index
+            MAX_CONCURRENCY(int): max number of Graph lookups run at once while assembling the cards
+            CARD_NAME(str): name of the Adaptive Card template
+            templates(CardTemplateRegistry): registry holding the preloaded Adaptive Card templates
             initial_dialog_id(str): UID for this dialog
     """
 
@@ -43,35 +46,36 @@ class PersonDialog(ComponentDialog):
         super().__init__(dialog_id or PersonDialog.__name__)
 
         self.DONE_OPTION = "завершить"
-        self.EXCEL_LINK = ""
+        self.SELECTED_PATH = "value-selectedPath"
         self.SITE_ID = "tikkurila.sharepoint.com,a6aa1089-0ccd-4edc-be69-03d4dc4aabc2,a5a516d4-962c-4663-89e8-424aabecfcf8"
         self.DRIVE_ID = "b!iRCqps0M3E6-aQPU3EqrwtQWpaUslmNGiehCSqvs_PjR9APmWaAIRJ2s7cN4zjqu"
+        self.MAX_CONCURRENCY = DefaultConfig.PERSON_CARD_CONCURRENCY
+        self.CARD_NAME = "Person_card"
+        self.templates = get_registry()
 
-        self.selected_keys = []
         self.client = client
-        self.json_path = None
-
-        self.options_list = ["ФАО", "Бухгалтерия", self.DONE_OPTION]
+        self.tree_store = DecisionTreeStore(
+            client,
+            self.SITE_ID,
+            self.DRIVE_ID,
+            "FunctionalAreas/selector_dialog_tree.json",
+            DefaultConfig.TREE_MAX_STALENESS,
+        )
 
-        self.add_dialog(ChoicePrompt('level1'))
-        self.add_dialog(ChoicePrompt('level2'))
-        self.add_dialog(ChoicePrompt('level3'))
-        self.add_dialog(ChoicePrompt('level4'))
+        self.add_dialog(ChoicePrompt('level'))
 
-        self.add_dialog(WaterfallDialog(
+        self.add_dialog(TimedWaterfallDialog(
             "WFDiag", [
-                self.dep_step,
-                self.type_step,
-                self.subtype_step,
-                self.lvl4_step,
-                self.final_step,
+                self.level_step,
+                self.choice_step,
             ]
         ))
 
         self.initial_dialog_id = "WFDiag"
 
-    async def dep_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
-        """Prompts the user to choose the department to which their question is related and stores the choice.
+    async def level_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
+        """Prompts the user to choose one of the options available at the current level of the tree.
+        The path selected so far is passed in the dialog options, the root is an empty list.
         Validates the input and re-promts the user if the validation is not passed.
 
         Args:
@@ -81,167 +85,64 @@ class PersonDialog(ComponentDialog):
             DialogTurnResult: result of calling the prompt stack manipulation method.
             Contains the users' response.
         """
-        self.selected_keys = []
-
-        message = (
-            f"К какому отделу относится ваш вопрос? Подсказка: ФАО отвечает за всевозможные "
-            f"согласования и расчеты, бухгалтерия - за правильный документооборот."
-            f"Чтобы завершить работу с ботом, выберите '{self.DONE_OPTION}'.")
-
-        options = self.options_list.copy()
-        path_link = await self.client.download_file(
-            self.SITE_ID,
-            self.DRIVE_ID,
-            "FunctionalAreas/selector_dialog_tree.json:/content"
-        )
-
-        self.json_path = json.loads(path_link.decode("utf-8"))
-
-        prompt_options = PromptOptions(
-            prompt=MessageFactory.text(message),
-            retry_prompt=MessageFactory.text(
-                "Пожалуйста, выберите вариант из списка."),
-            choices=self._to_choices(options),
-            style=ListStyle.suggested_action,
-        )
-        return await step_context.prompt('level1', options=prompt_options)
-
-    async def type_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
-        """Prompts the user to choose the functional area to which their question is related and stores the choice.
-        Validates the input and re-promts the user if the validation is not passed.
-
-        Args:
-            step_context (WaterfallStepContext): the context for the current dialog turn
-
-        Returns:
-            DialogTurnResult: result of calling the prompt stack manipulation method.
-            Contains the users' response.
-        """
-        selected = step_context.result.value
-
-        if selected == self.DONE_OPTION:
-            return await step_context.end_dialog()
-
-        self.selected_keys.append(selected)
-
-        message = f"К какой части функционала {selected} относится ваш вопрос? Выберите вариант из списка. "
-        f"Чтобы завершить работу с ботом, выберите '{self.DONE_OPTION}'."
-        options = list(self._dict_traverser(
-            self.selected_keys, self.json_path).keys())
+        path: List[str] = step_context.options if step_context.options is not None else []
+        index = await self.tree_store.get_index()
+        if path not in index:
+            # the tree has been changed since the previous step, start over
+            path = []
+        step_context.values[self.SELECTED_PATH] = path
+
+        options = list(index.node(path).children)
         options.append(self.DONE_OPTION)
 
         prompt_options = PromptOptions(
-            prompt=MessageFactory.text(message),
+            prompt=MessageFactory.text(self._level_message(path)),
             retry_prompt=MessageFactory.text(
                 "Пожалуйста, выберите вариант из списка."),
             choices=self._to_choices(options),
-
+            style=ListStyle.suggested_action if len(path) == 0 else None,
         )
-        return await step_context.prompt('level2', options=prompt_options)
+        return await step_context.prompt('level', options=prompt_options)
 
-    async def subtype_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
-        """Prompts the user to choose further details of a functional area to which their question is related and stores the choice.
-        Validates the input and re-promts the user if the validation is not passed.
+    async def choice_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
+        """Stores the choice of the user. If a terminal node is reached, sends one or more Adaptive cards
+        containing the information on the best employee to contact, otherwise goes one level deeper.
 
         Args:
             step_context (WaterfallStepContext): the context for the current dialog turn
 
         Returns:
-            DialogTurnResult: result of calling the prompt stack manipulation method.
-            Contains the users' response.
+            DialogTurnResult: result of calling the selected stack manipulation method.
         """
         selected = step_context.result.value
 
         if selected == self.DONE_OPTION:
             return await step_context.end_dialog()
 
-        self.selected_keys.append(selected)
-
-        # if we already reached the end of a branch, silently go to the next stage,
-        # no additional prompt is needed
-        json_node = self._dict_traverser(self.selected_keys, self.json_path)
-        if "@tikkurila.com" in "\t".join(json_node):
-            return await step_context.next(json_node)
-
-        message = f"Ваш выбор: {selected}. Пожалуйста конкретизируйте его, выбрав вариант из списка, "
-        f"или выберите '{self.DONE_OPTION}', чтобы закончить работу с ботом."
-        options = list(json_node.keys())
-        options.append(self.DONE_OPTION)
-
-        prompt_options = PromptOptions(
-            prompt=MessageFactory.text(message),
-            retry_prompt=MessageFactory.text(
-                "Пожалуйста, выберите вариант из списка."),
-            choices=self._to_choices(options),
-
-        )
-        return await step_context.prompt('level3', options=prompt_options)
-
-    async def lvl4_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
-        """Prompts the user to choose further details of a functional area to which their question is related and stores the choice.
-        Validates the input and re-promts the user if the validation is not passed.
-
-        Args:
-            step_context (WaterfallStepContext): the context for the current dialog turn
+        path = step_context.values[self.SELECTED_PATH] + [selected]
+        index = await self.tree_store.get_index()
+        if path not in index:
+            return await step_context.replace_dialog("WFDiag", [])
 
-        Returns:
-            DialogTurnResult: result of calling the prompt stack manipulation method.
-            Contains the users' response.
-        """
-        selected = step_context.result
+        node = index.node(path)
+        if not node.is_leaf:
+            return await step_context.replace_dialog("WFDiag", path)
 
-        if selected == self.DONE_OPTION:
+        if not node.emails:
+            await step_context.context.send_activity(
+                MessageFactory.text("К сожалению, по этому вопросу контактное лицо пока не указано."))
             return await step_context.end_dialog()
 
-        if not isinstance(selected, FoundChoice):
-            return await step_context.next(selected)
-
-        self.selected_keys.append(selected.value)
-
-        json_node = self._dict_traverser(self.selected_keys, self.json_path)
-
-        # if we already reached the end of a branch, silently go to the next stage,
-        # no additional prompt is needed
-        if "@tikkurila.com" in "\t".join(json_node):
-            return await step_context.next(json_node)
-
-        message = f"{selected.value} - в этом не так-то просто разобраться! "
-        f"Осталось сделать последнее уточнение и выбрать вариант из списка:"
-        options = list(json_node.keys())
-
-        prompt_options = PromptOptions(
-            prompt=MessageFactory.text(message),
-            retry_prompt=MessageFactory.text(
-                "Пожалуйста, выберите вариант из списка."),
-            choices=self._to_choices(options),
-
-        )
-        return await step_context.prompt('level4', options=prompt_options)
-
-    async def final_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
-        """Sends one or more Adaptive cards containing the information on the best employee to contact
-        given the previous choices of the user
-
-        Args:
-            step_context (WaterfallStepContext): the context for the current dialog turn
-
-        Returns:
-            DialogTurnResult: result of calling the end_dialog stack manipulation method.
-        """
-        selected = step_context.result
-
-        # if the email was already identified on the previous steps, use it
-        # if not - identify it first
-        if not isinstance(selected, FoundChoice):
-            emails = selected
-        else:
-            self.selected_keys.append(selected.value)
-            emails = self._dict_traverser(self.selected_keys, self.json_path)
-
-        messages = [await self._populate_adaptive(i) for i in emails]
+        # all lookups for all the cards share one limit, so the whole answer
+        # costs roughly one Graph round-trip. The statuses of all the people are fetched in a single call
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+        presences = asyncio.ensure_future(
+            self._bounded(semaphore, self.client.get_presences(node.emails), {}))
+        messages = await asyncio.gather(
+            *[self._populate_adaptive(i, semaphore, presences) for i in node.emails])
         card_msg = Activity(
             type=ActivityTypes.message,
-            attachments=messages,
+            attachments=list(messages),
         )
 
         await step_context.context.send_activities(
@@ -251,9 +152,31 @@ class PersonDialog(ComponentDialog):
 
         return await step_context.end_dialog()
 
-    def _dict_traverser(self, lookup: Iterable, nested: dict) -> str:
-        # traverses the tree based on the list of keys
-        return reduce(operator.getitem, lookup, nested)
+    def _level_message(self, path: List[str]) -> str:
+        """Constructs the prompt message for the given level of the tree
+
+        Args:
+            path (List[str]): options selected so far
+
+        Returns:
+            str: prompt message
+        """
+        if len(path) == 0:
+            return (
+                f"К какому отделу относится ваш вопрос? Подсказка: ФАО отвечает за всевозможные "
+                f"согласования и расчеты, бухгалтерия - за правильный документооборот."
+                f"Чтобы завершить работу с ботом, выберите '{self.DONE_OPTION}'.")
+        if len(path) == 1:
+            return (
+                f"К какой части функционала {path[-1]} относится ваш вопрос? Выберите вариант из списка. "
+                f"Чтобы завершить работу с ботом, выберите '{self.DONE_OPTION}'.")
+        if len(path) == 2:
+            return (
+                f"Ваш выбор: {path[-1]}. Пожалуйста конкретизируйте его, выбрав вариант из списка, "
+                f"или выберите '{self.DONE_OPTION}', чтобы закончить работу с ботом.")
+        return (
+            f"{path[-1]} - в этом не так-то просто разобраться! "
+            f"Осталось сделать еще одно уточнение и выбрать вариант из списка:")
 
     def _to_choices(self, choices: list) -> List[Choice]:
         """Converts the list of strings to the list of instances of Choice objects
@@ -267,39 +190,76 @@ class PersonDialog(ComponentDialog):
             choice_list.append(Choice(value=choice))
         return choice_list
 
-    async def _populate_adaptive(self, email: str) -> Attachment:
+    @staticmethod
+    async def _bounded(semaphore: asyncio.Semaphore, coro, fallback):
+        """Awaits a Graph lookup under the concurrency limit and replaces any failure with a fallback value
+
+        Args:
+            semaphore (asyncio.Semaphore): limit shared by all the lookups of the current answer
+            coro (coroutine): Graph lookup to await
+            fallback: value to return if the lookup raises
+
+        Returns:
+            result of the lookup or the fallback value
+        """
+        async with semaphore:
+            try:
+                return await coro
+            except Exception:
+                return fallback
+
+    @staticmethod
+    async def _status(email: str, presences: asyncio.Future) -> str:
+        """Waits for the bulk lookup and takes the status of an employee from it
+
+        Args:
+            email (str): an email of the employee
+            presences (asyncio.Future): bulk lookup resolving to statuses keyed by the email
+
+        Returns:
+            str: current status of the employee or "No info"
+        """
+        return (await presences).get(email, "No info")
+
+    async def _populate_adaptive(
+            self, email: str, semaphore: asyncio.Semaphore = None, presences: asyncio.Future = None) -> Attachment:
         """Fetches the data from the Graph API and populates the Adaptive card
-        with this information
+        with this information. All the lookups are run concurrently.
 
         Args:
             email (str): an email of the employee to be used in Graph calls
+            semaphore (asyncio.Semaphore, optional): limit shared with the lookups for other cards.
+            A new one is created if not provided. Defaults to None.
+            presences (asyncio.Future, optional): bulk lookup of the statuses of all the people on the cards.
+            The status is fetched on its own if not provided. Defaults to None.
 
         Returns:
             Attachment: An Attachment instance ready to be attached to a message
         """
-        manager = await self.client.get_manager(email)
-        status = await self.client.get_presence(email)
-        autoreply = await self.client.get_autorepl_date(email)
-        picture = await self.client.get_picture_for_adap(email)
-        name, title, mail = await self.client.get_user(email)
-
-        # constructing the full path and accesing the name.
-        # This whole "folder-filename" as a list thing is needed to make a
-        # filepath OS-agnostic
-        rel_path = ["cards_templates", "Person_card"]
-        this_file = os.getcwd()
-        full_path = os.path.join(this_file, *rel_path)
-        with open(full_path, "r") as card_file:
-            card_json = json.load(card_file)
-
-        card_json["body"][0]['columns'][0]['items'][0]['url'] = picture
-        card_json["body"][0]['columns'][1]['items'][0]['items'][0]['text'] = name
-        card_json["body"][0]['columns'][1]['items'][0]['items'][1]['text'] = title
-        card_json["body"][0]['columns'][1]['items'][0]['items'][2]['text'] = mail
-        card_json["body"][0]['columns'][1]['items'][0][
-            'items'][3]['text'] = f"Текущий статус: {status}"
-        card_json["body"][0]['columns'][1]['items'][1]['items'][0][
-            'text'] = autoreply if autoreply == "" else f"Автоответ до {autoreply}"
-        card_json["body"][1]['text'] = f"Непосредственный руководитель: {manager}"
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+        # waiting for the bulk lookup mustn't take a slot of the limit the lookup itself needs
+        status_lookup = self._bounded(semaphore, self.client.get_presence(email), "No info") \
+            if presences is None else self._status(email, presences)
+        manager, status, autoreply, picture, user = await asyncio.gather(
+            self._bounded(semaphore, self.client.get_manager(email), "Not Available"),
+            status_lookup,
+            self._bounded(semaphore, self.client.get_autorepl_date(email), ""),
+            self._bounded(semaphore, self.client.get_picture_for_adap(email), None),
+            self._bounded(semaphore, self.client.get_user(email), ["Not Available" for i in range(3)]),
+        )
+        if picture is None:
+            picture = await self.client.get_placeholder_picture()
+        name, title, mail = user
+
+        card_json = self.templates.render(self.CARD_NAME, {
+            "photo": {"url": picture},
+            "name": {"text": name},
+            "title": {"text": title},
+            "email": {"text": mail},
+            "status": {"text": f"Текущий статус: {status}"},
+            "autoreply": {"text": autoreply if autoreply == "" else f"Автоответ до {autoreply}"},
+            "manager": {"text": f"Непосредственный руководитель: {manager}"},
+        })
 
         return CardFactory.adaptive_card(card_json)
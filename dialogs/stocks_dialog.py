@@ -1,6 +1,3 @@
-import yfinance as yf
-import json
-import os
 from typing import List
 from botbuilder.dialogs import (
     DialogTurnResult,
@@ -10,31 +7,43 @@ from botbuilder.dialogs import (
 )
 from botbuilder.core import MessageFactory, CardFactory
 from botbuilder.schema import Attachment, Activity, ActivityTypes
+from helpers.card_templates import get_registry
+from helpers.quotes import QuoteService, QuoteSnapshot, YahooQuoteSource
+from helpers.dialog_helper import TimedWaterfallDialog
+from config import DefaultConfig
 
 
 class StocksDialog(ComponentDialog):
     """A dialog sending Tikkurila's stock price to the user
 
         Attributes:
-            CARD_PATH(list): path to an Adaptive Card json template
+            CARD_NAME(str): name of the Adaptive Card template
+            templates(CardTemplateRegistry): registry holding the preloaded Adaptive Card templates
+            quote_service(QuoteService): service keeping the latest stock quote
             initial_dialog_id(str): UID for this dialog
     """
 
-    def __init__(self, dialog_id: str):
+    def __init__(self, dialog_id: str, quote_service: QuoteService = None):
         """inits the StocksDialog instance
 
         Args:
             dialog_id (str): a unique name identifying specific dialog.
+            quote_service (QuoteService, optional): service keeping the latest stock quote.
+            A service pulling the quotes from Yahoo Finance is created if not provided. Defaults to None.
         """
         super().__init__(dialog_id or StocksDialog.__name__)
 
-        self.CARD_PATH = ["cards_templates", "Stock_card"]
+        self.CARD_NAME = "Stock_card"
+        self.templates = get_registry()
+        if quote_service is None:
+            quote_service = QuoteService(
+                YahooQuoteSource(),
+                DefaultConfig.QUOTE_OPEN_INTERVAL,
+                DefaultConfig.QUOTE_CLOSED_INTERVAL)
+        self.quote_service = quote_service
 
         self.add_dialog(
-            WaterfallDialog(WaterfallDialog.__name__,
-                            [
-                                self.only_step
-                            ])
+            TimedWaterfallDialog(WaterfallDialog.__name__, [self.only_step])
         )
 
         self.initial_dialog_id = WaterfallDialog.__name__
@@ -47,79 +56,73 @@ class StocksDialog(ComponentDialog):
             - min price (inside a day)
             - diff to the previous close price
 
+        The card is rendered from the latest snapshot kept by the quote service,
+        only the very first request after the start has to wait for the upstream.
+
         Args:
             step_context (WaterfallStepContext): the context for the current dialog turn
 
         Returns:
             DialogTurnResult: result of calling the end_dialog stack manipulation method.
         """
-        message = "В следующем сообщении будет отправлен курс акции Тиккурила. Это может занять около 5 секунд"
-        await step_context.context.send_activity(
-            MessageFactory.text(message)
-        )
+        if self.quote_service.snapshot is None:
+            message = "В следующем сообщении будет отправлен курс акции Тиккурила. Это может занять около 5 секунд"
+            await step_context.context.send_activity(
+                MessageFactory.text(message)
+            )
+        try:
+            snapshot = await self.quote_service.latest()
+        except Exception:
+            await step_context.context.send_activity(MessageFactory.text(
+                "Не удалось получить курс акции😿 Попробуйте еще раз позднее"))
+            return await step_context.end_dialog()
 
         card_msg = Activity(
             type=ActivityTypes.message,
-            attachments=[self._populate_with_data(self.CARD_PATH)],
+            attachments=[self._populate_with_data(
+                self.CARD_NAME, snapshot, self.quote_service.is_stale(snapshot))],
         )
         await step_context.context.send_activity(card_msg)
 
         return await step_context.end_dialog()
 
-    def _populate_with_data(self, rel_path: list) -> Attachment:
-        """pulls the stock data from the Yahoo Finance API, populates the Adaptive card with that data
-        and creates an Attachment instance with that Card
+    def _populate_with_data(self, card_name: str, snapshot: QuoteSnapshot, stale: bool = False) -> Attachment:
+        """populates the Adaptive card with the stock data and creates an Attachment instance with that Card
 
         Args:
-            rel_path (list): path to the Adaptive card json file structured as a list [folder, filename]
+            card_name (str): name of the Adaptive card template
+            snapshot (QuoteSnapshot): stock quote to show
+            stale (bool, optional): whether the quote has missed its scheduled refresh. Defaults to False.
 
         Returns:
             Attachment: An Attachment instance ready to be attached to a message
         """
-        tikk = yf.Ticker("TIK1V.HE")
-        res = tikk.history(period='2d')
-
-        open_price = res.tail(1)['Open'][0]
-        high_price = res.tail(1)['High'][0]
-        low_price = res.tail(1)['Low'][0]
-        # if we already have a closing price - use it, otherwise take an open
-        # price
-        actual_price = res.tail(1)['Close'][0] if res.tail(
-            1)['Close'][0] > 0 else res.tail(1)['Open'][0]
-
-        day = res.tail(1).index[0]
-        day = day.to_pydatetime()
-        day = day.date().strftime("%B %d %Y")
-
-        diff_open = res.diff()['Close'][1] if res.diff()[
-            'Close'][1] != 0 else res.diff()['Open'][1]
-        diff_open = round(diff_open, 2)
-
         # construct a string comparing the price with the previous day
-        diff_percent = round((diff_open / actual_price) * 100, 2)
-        if diff_open > 0:
+        if snapshot.change > 0:
             symbol, color = "▲", "Good"
-        elif diff_open < 0:
+        elif snapshot.change < 0:
             symbol, color = "▼", "Attention"
         else:
             symbol, color = "►", "Default"
-        diff_percent_str = "(" + str(diff_percent) + "%)"
-
-        price_string = " ".join([symbol, str(diff_open), diff_percent_str])
+        diff_percent_str = "(" + str(snapshot.change_percent) + "%)"
 
-        this_file = os.getcwd()
-        full_path = os.path.join(this_file, *rel_path)
-        with open(full_path, "r") as card_file:
-            card_json = json.load(card_file)
+        price_string = " ".join(
+            [symbol, str(snapshot.change), diff_percent_str])
+        day = snapshot.day
+        if stale:
+            day += " (данные могут быть устаревшими)"
 
         # atm there is no dynamic templating for Python Adaptive cards SDK,
-        # hence the brute force approach
-        card_json["body"][0]["items"][1]["text"] = day
-        card_json["body"][1]["items"][0]["columns"][0]["items"][0]["text"] = actual_price
-        card_json["body"][1]["items"][0]["columns"][0]["items"][1]["text"] = price_string
-        card_json["body"][1]["items"][0]["columns"][0]["items"][1]["color"] = color
-        card_json["body"][1]["items"][0]["columns"][1]["items"][0]["facts"][0]["value"] = open_price
-        card_json["body"][1]["items"][0]["columns"][1]["items"][0]["facts"][1]["value"] = high_price
-        card_json["body"][1]["items"][0]["columns"][1]["items"][0]["facts"][2]["value"] = low_price
+        # hence the named slots
+        card_json = self.templates.render(card_name, {
+            "date": {"text": day},
+            "price": {"text": str(snapshot.price)},
+            "change": {"text": price_string, "color": color},
+            "facts": {"facts": [
+                {"title": "Open", "value": str(snapshot.open)},
+                {"title": "High", "value": str(snapshot.high)},
+                {"title": "Low", "value": str(snapshot.low)},
+            ]},
+        })
 
         return CardFactory.adaptive_card(card_json)
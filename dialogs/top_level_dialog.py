@@ -1,6 +1,5 @@
 from botbuilder.core import MessageFactory, UserState
 from botbuilder.dialogs import (
-    WaterfallDialog,
     DialogTurnResult,
     WaterfallStepContext,
     ComponentDialog,
@@ -17,6 +16,8 @@ from dialogs.hk_dialog import HKDialog
 from dialogs.pers_sel_dialog import PersonDialog
 from dialogs.autoreply_dialog import AutoreplyDialog
 from graph_client import GraphClient
+from helpers.quotes import QuoteService
+from helpers.dialog_helper import TimedWaterfallDialog
 
 
 class TopLevelDialog(ComponentDialog):
@@ -25,6 +26,7 @@ class TopLevelDialog(ComponentDialog):
     Attributes:
 
         SELECTED_WAY(str): Key name to store this dialogs state info in the StepContext
+        CHOSEN_STORAGE(str): Key name to store the storage object name of the chosen branch in the StepContext
         DONE_OPTION(str): word a user has to send to the bot to cancel the dialog at any stage
         client(GraphClient): MS Graph client instance associated with this dialog. Used to perform all calls to the Graph API
         user_state(UserState): user state storage object
@@ -34,7 +36,8 @@ class TopLevelDialog(ComponentDialog):
         initial_dialog_id: UID for this dialog
     """
 
-    def __init__(self, user_state: UserState, dialog_id: str):
+    def __init__(self, user_state: UserState, dialog_id: str, client: GraphClient = None,
+                 quote_service: QuoteService = None):
         """inits the TopLevelDialog instance.
 
         Args:
@@ -42,14 +45,18 @@ class TopLevelDialog(ComponentDialog):
             will have its own isolated storage object that can be used to persist information
             about the user across the entire conversation(s) with that user.
             dialog_id (str): a unique name identifying specific dialog.
+            client (GraphClient, optional): MS Graph client shared by all the branches.
+            A new instance is created if not provided. Defaults to None.
+            quote_service (QuoteService, optional): service keeping the latest stock quote. Defaults to None.
         """
         super(TopLevelDialog, self).__init__(
             dialog_id or TopLevelDialog.__name__)
 
         self.SELECTED_WAY = "value-selectedWay"
+        self.CHOSEN_STORAGE = "value-chosenStorage"
         self.DONE_OPTION = "Завершить"
 
-        self.client = GraphClient()
+        self.client = client if client is not None else GraphClient()
         self.user_state = user_state
 
         self.options_dict = {
@@ -66,7 +73,7 @@ class TopLevelDialog(ComponentDialog):
 
         self.add_dialog(ChoicePrompt("top_level_choice"))
         self.add_dialog(LinksDialog(LinksDialog.__name__))
-        self.add_dialog(StocksDialog(StocksDialog.__name__))
+        self.add_dialog(StocksDialog(StocksDialog.__name__, quote_service))
         self.add_dialog(HKDialog(self.client, HKDialog.__name__))
         self.add_dialog(PersonDialog(self.client, PersonDialog.__name__))
         self.add_dialog(
@@ -76,7 +83,7 @@ class TopLevelDialog(ComponentDialog):
                 AutoreplyDialog.__name__))
 
         self.add_dialog(
-            WaterfallDialog(
+            TimedWaterfallDialog(
                 "top_level_WFDialog",
                 [
                     self.selection_step,
@@ -97,7 +104,7 @@ class TopLevelDialog(ComponentDialog):
         """
         for key in self.options_dict:
             if self.options_dict[key][0] == selection:
-                self.chosen = self.options_dict[key][2]
+                step_context.values[self.CHOSEN_STORAGE] = self.options_dict[key][2]
                 return await step_context.begin_dialog(self.options_dict[key][1])
 
     async def selection_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
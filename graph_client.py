@@ -1,22 +1,357 @@
-import os
-from io import BytesIO
-from PIL import Image, ImageOps
-from babel.dates import format_date
+import asyncio
 from datetime import datetime
 import config
 import json
-import pyperclip
 import base64
-import webbrowser
-import requests
-import msal
+import re
+import sys
+import time
+import aiohttp
+from typing import Dict, List
 from urllib.parse import urlparse, urljoin
+from helpers.metrics import GRAPH_SECONDS
+from helpers.report_catalogue import ReportCatalogue
+from helpers.resilience import CircuitOpenError, Resilience
+from helpers.token_manager import TokenManager
+from helpers.tracing import TRACER
+from helpers.ttl_cache import TTLCache, cached
+from helpers.thumbnails import ThumbnailStore, to_data_uri
 site_id = "tikkurila.sharepoint.com,a6aa1089-0ccd-4edc-be69-03d4dc4aabc2,a5a516d4-962c-4663-89e8-424aabecfcf8"
 drive_id = "b!iRCqps0M3E6-aQPU3EqrwtQWpaUslmNGiehCSqvs_PgkFFzTCYK_Sa7Y0KpehzLj"
 AUTHORITY_URL = "https://login.microsoftonline.com/tikkurila.onmicrosoft.com"
-RESOURCE_URI = "https://graph.microsoft.com/"
+# the scopes are always requested for Graph, only the base URI the calls are sent to is configurable
+SCOPE_URI = "https://graph.microsoft.com"
+RESOURCE_URI = config.DefaultConfig.GRAPH_RESOURCE_URI
 RESOURCE = RESOURCE_URI + "v1.0"
-full_for_latest = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/root:/Deco:/children?$expand=listItem($expand=fields)"
+full_for_latest = f"{RESOURCE}/sites/{site_id}/drives/{drive_id}/root:/Deco:/children?$expand=listItem($expand=fields)"
+
+
+class GraphResponse:
+    """A fully read response of a single Graph call. The body is read before the
+    underlying aiohttp response is released, so the instance can be safely passed around.
+
+    Attributes:
+        status_code (int): HTTP status code of the response
+        headers (dict): response headers
+        content (bytes): raw response body
+    """
+
+    def __init__(self, status_code: int, headers: dict, content: bytes):
+        """inits the GraphResponse instance
+
+        Args:
+            status_code (int): HTTP status code of the response
+            headers (dict): response headers
+            content (bytes): raw response body
+        """
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        """Parses the response body as json
+
+        Returns:
+            parsed json body
+        """
+        return json.loads(self.content.decode("utf-8"))
+
+
+class GraphError(ValueError):
+    """Raised when Graph answers with an error status
+
+    Attributes:
+        status_code (int): HTTP status code of the response
+    """
+
+    def __init__(self, status_code: int):
+        """inits the GraphError instance
+
+        Args:
+            status_code (int): HTTP status code of the response
+        """
+        super().__init__(f"Some connection problems. Error code: {status_code}")
+        self.status_code = status_code
+
+
+class GraphPager:
+    """Async iterator over the items of a Graph collection, following @odata.nextLink page by page.
+    The next page is requested as soon as the current one arrives, so it downloads while the current one
+    is being consumed. A caller may stop at any item, closing the pager then cancels the prefetch.
+    More details on paging are available here - https://docs.microsoft.com/en-us/graph/paging
+
+    Usage:
+        async with client.iter_collection(path, select=["id", "name"]) as pager:
+            async for item in pager:
+                ...
+
+    Attributes:
+        client (GraphClient): client used to request the pages
+        prefetch (bool): whether to request the next page before the current one is consumed
+        pages (int): number of pages received so far
+        delta_link (str): @odata.deltaLink of the last page of a delta query, None otherwise
+    """
+
+    def __init__(self, client: "GraphClient", url: str, version: str = "v1.0", prefetch: bool = True):
+        """inits the GraphPager instance. No request is made until the first item is asked for
+
+        Args:
+            client (GraphClient): client used to request the pages
+            url (str): path relative to the API version or full URI of the first page
+            version (str, optional): Which Graph endpoint to use. Only two valid options: "beta" and "v1.0".
+            Defaults to "v1.0".
+            prefetch (bool, optional): whether to request the next page before the current one is consumed.
+            Defaults to True.
+        """
+        self.client = client
+        self.prefetch = prefetch
+        self.pages = 0
+        self.delta_link = None
+        self._version = version
+        self._next_url = url
+        self._items = iter(())
+        self._pending = None
+
+    def __aiter__(self) -> "GraphPager":
+        return self
+
+    async def __anext__(self) -> dict:
+        """Returns the next item, waiting for the next page once the current one is consumed
+
+        Raises:
+            GraphError: raised if Graph answers a page request with an error status
+            StopAsyncIteration: raised after the last item of the last page
+
+        Returns:
+            dict: next item of the collection
+        """
+        while True:
+            try:
+                return next(self._items)
+            except StopIteration:
+                pass
+            self._request_next()
+            if self._pending is None:
+                raise StopAsyncIteration
+            task, self._pending = self._pending, None
+            page = await task
+            self.pages += 1
+            self._items = iter(page.get("value", []))
+            self._next_url = page.get("@odata.nextLink")
+            self.delta_link = page.get("@odata.deltaLink", self.delta_link)
+            if self.prefetch:
+                self._request_next()
+
+    async def __aenter__(self) -> "GraphPager":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Stops the iteration, cancelling the prefetched page request if there is one"""
+        self._next_url = None
+        self._items = iter(())
+        if self._pending is not None:
+            self._pending.cancel()
+            try:
+                await self._pending
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._pending = None
+
+    async def collect(self) -> list:
+        """Returns all the remaining items of the collection
+
+        Returns:
+            list: items of all the remaining pages
+        """
+        try:
+            return [item async for item in self]
+        finally:
+            await self.close()
+
+    def _request_next(self):
+        """Requests the next page unless it has been requested already or there is none"""
+        if self._pending is None and self._next_url is not None:
+            self._pending = asyncio.ensure_future(self._fetch(self._next_url))
+            self._next_url = None
+
+    async def _fetch(self, url: str) -> dict:
+        """Requests a single page
+
+        Args:
+            url (str): path relative to the API version or full URI of the page
+
+        Raises:
+            GraphError: raised if Graph answers with an error status
+
+        Returns:
+            dict: parsed page
+        """
+        call = await self.client._request("GET", await self.client._api_endpoint(url, self._version))
+        if call.status_code != 200:
+            raise GraphError(call.status_code)
+        return call.json()
+
+
+class GraphBatcher:
+    """Collects Graph requests issued within a short window (i.e. within the same turn)
+    and sends them as JSON $batch calls, then splits the responses back to the individual callers.
+    More details on batching are available here - https://docs.microsoft.com/en-us/graph/json-batching
+
+    Attributes:
+        MAX_BATCH_SIZE (int): max number of sub-requests Graph accepts in one $batch call
+        client (GraphClient): client used to send the $batch calls
+        window (float): time in seconds during which the requests are collected before sending
+    """
+
+    MAX_BATCH_SIZE = 20
+
+    def __init__(self, client: "GraphClient", window: float):
+        """inits the GraphBatcher instance
+
+        Args:
+            client (GraphClient): client used to send the $batch calls
+            window (float): time in seconds during which the requests are collected before sending
+        """
+        self.client = client
+        self.window = window
+        # pending requests are grouped by API version as beta and v1.0 have
+        # separate $batch endpoints
+        self._pending = {}
+        self._flush_task = None
+
+    async def submit(self, method: str, path: str, version: str = "v1.0", payload: dict = None) -> GraphResponse:
+        """Queues a request to be sent with the next $batch call and waits for its response
+
+        Args:
+            method (str): HTTP method, i.e. "GET" or "POST"
+            path (str): path relative to the API version, i.e. "/users/{email}/presence"
+            version (str, optional): Which Graph endpoint to use. Only two valid options: "beta" and "v1.0".
+            Defaults to "v1.0".
+            payload (dict, optional): json body of the request. Defaults to None.
+
+        Returns:
+            GraphResponse: response to this particular request
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(version, []).append(
+            (method, path, payload, future))
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        """Waits for the collection window to pass and sends everything collected so far"""
+        await asyncio.sleep(self.window)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+        chunks = []
+        for version, requests in pending.items():
+            for i in range(0, len(requests), self.MAX_BATCH_SIZE):
+                chunks.append(
+                    (version, requests[i:i + self.MAX_BATCH_SIZE]))
+        await asyncio.gather(*[self._send(version, chunk) for version, chunk in chunks])
+
+    async def _send(self, version: str, chunk: list):
+        """Sends a chunk of requests and resolves the futures of the callers
+
+        Args:
+            version (str): API version all the requests in the chunk belong to
+            chunk (list): list of (method, path, payload, future) tuples
+        """
+        try:
+            if len(chunk) == 1:
+                # a batch of one only adds overhead
+                method, path, payload, future = chunk[0]
+                url = await self.client._api_endpoint(path, version)
+                responses = [await self.client._request(method, url, json=payload)]
+            else:
+                responses = await self._send_batch(version, chunk)
+        except Exception as err:
+            for *_, future in chunk:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for (*_, future), response in zip(chunk, responses):
+            if not future.done():
+                future.set_result(response)
+
+    async def _send_batch(self, version: str, chunk: list) -> list:
+        """Sends a single $batch call
+
+        Args:
+            version (str): API version all the requests in the chunk belong to
+            chunk (list): list of (method, path, payload, future) tuples
+
+        Returns:
+            list: GraphResponse instances in the same order as the chunk
+        """
+        requests = []
+        for i, (method, path, payload, _) in enumerate(chunk):
+            request = {"id": str(i), "method": method, "url": path}
+            if payload is not None:
+                request["body"] = payload
+                request["headers"] = {"Content-Type": "application/json"}
+            requests.append(request)
+        url = await self.client._api_endpoint("/$batch", version)
+        resilience = self.client.resilience
+        # Graph throttles the requests of a batch one by one, the throttled ones are sent again in a new batch
+        responses = [None] * len(chunk)
+        pending = list(range(len(chunk)))
+        for attempt in range(resilience.max_retries + 1):
+            batch = await self.client._request(
+                "POST", url, json={"requests": [requests[i] for i in pending]},
+                idempotent=all(chunk[i][0] == "GET" for i in pending), cost=len(pending))
+            if batch.status_code != 200:
+                # the whole batch failed, so does every request in it
+                for i in pending:
+                    responses[i] = batch
+                break
+            by_id = {item["id"]: item for item in batch.json().get("responses", [])}
+            retry = []
+            for i in pending:
+                responses[i] = self._to_response(by_id.get(str(i)))
+                if responses[i].status_code == 429:
+                    resilience.throttled(responses[i])
+                if resilience.should_retry(responses[i], chunk[i][0] == "GET"):
+                    retry.append(i)
+            if not retry or attempt == resilience.max_retries:
+                break
+            delay = max(resilience.delay(attempt, responses[i]) for i in retry)
+            resilience.stats["retries"] += len(retry)
+            resilience.stats["retry_wait_seconds"] += delay
+            await asyncio.sleep(delay)
+            pending = retry
+        return responses
+
+    @staticmethod
+    def _to_response(item: dict) -> GraphResponse:
+        """Converts a single item of the $batch response to a GraphResponse
+
+        Args:
+            item (dict): item from the "responses" list of a $batch response
+
+        Returns:
+            GraphResponse: response to the corresponding request
+        """
+        if item is None:
+            return GraphResponse(502, {}, b"")
+        headers = item.get("headers", {})
+        body = item.get("body")
+        if body is None:
+            content = b""
+        elif isinstance(body, str) and not headers.get("Content-Type", "").startswith("application/json"):
+            # binary content such as photos comes base64-encoded
+            try:
+                content = base64.b64decode(body, validate=True)
+            except ValueError:
+                content = body.encode("utf-8")
+        else:
+            content = json.dumps(body).encode("utf-8")
+        return GraphResponse(item.get("status", 502), headers, content)
 
 
 class GraphClient:
@@ -24,46 +359,225 @@ class GraphClient:
     A class used to interface with the Microsoft Graph API.
     It relies on an Microsoft Authentication library (msal). More detailed information re different authentication
     flows is available here - https://docs.microsoft.com/en-us/azure/active-directory/develop/msal-authentication-flows
+
+    Attributes:
+        MAX_PRESENCE_IDS (int): max number of users Graph accepts in one getPresencesByUserId call
+        resource_uri (str): base URI of the Graph API the calls are made to
+        live_presence (PresenceSubscriptions): statuses kept current by change notifications or None
     """
 
-    def __init__(self):
-        """Inits the GraphClient instance
+    MAX_PRESENCE_IDS = 650
 
-        Raises:
-            ValueError: raised if no response or error reponse are received from MS servers
-            and hence the device flow can't be initiated.
+    def __init__(self, resource_uri: str = None, access_token: str = None):
+        """Inits the GraphClient instance. No network calls are made here,
+        tokens are acquired and refreshed by the token manager.
+
+        Args:
+            resource_uri (str, optional): base URI of the Graph API, i.e. the one of a local stand-in.
+            Defaults to GRAPH_RESOURCE_URI from config.py.
+            access_token (str, optional): token sent as is instead of acquiring one.
+            Defaults to GRAPH_ACCESS_TOKEN from config.py.
         """
+        settings = config.DefaultConfig
+        self.resource_uri = resource_uri or RESOURCE_URI
+        if not self.resource_uri.endswith("/"):
+            self.resource_uri += "/"
         # scope is defined explicitly to have a visibility of the exact access
         # rights
         scope = [
-            RESOURCE_URI + "/" + "Files.ReadWrite",
-            RESOURCE_URI + "/" + "Sites.ReadWrite.All",
-            RESOURCE_URI + "/" + "Calendars.ReadWrite",
-            RESOURCE_URI + "/" + "MailboxSettings.ReadWrite",
+            SCOPE_URI + "/" + "Files.ReadWrite",
+            SCOPE_URI + "/" + "Sites.ReadWrite.All",
+            SCOPE_URI + "/" + "Calendars.ReadWrite",
+            SCOPE_URI + "/" + "MailboxSettings.ReadWrite",
         ]
-        app = msal.PublicClientApplication(
-            config.client_id, authority=AUTHORITY_URL)
-
-        # TODO switch to Integrated Windows Authentication flow in prod. RN it
-        # is device_flow which isn't scalable
-        flow = app.initiate_device_flow(scopes=scope)
-        if "user_code" not in flow:
-            raise ValueError(
-                "Fail to create device flow. Err: %s" %
-                json.dumps(
-                    flow, indent=4))
-        pyperclip.copy(flow['user_code'])
-        webbrowser.open(flow['verification_uri'])
-        # acquiring token and updating headers for all requsets in a current
-        # session
-        token = app.acquire_token_by_device_flow(flow)
-        self.session = requests.Session()
-        self.session.headers.update(
-            {'Authorization': 'Bearer ' + token['access_token']})
+        self.tokens = TokenManager(
+            config.client_id,
+            AUTHORITY_URL,
+            scope,
+            SCOPE_URI,
+            client_secret=settings.CLIENT_SECRET,
+            cache_path=settings.TOKEN_CACHE_PATH,
+            refresh_margin=settings.TOKEN_REFRESH_MARGIN,
+            static_token=access_token or settings.GRAPH_ACCESS_TOKEN,
+        )
+        # the session is bound to the event loop, hence it's created lazily on
+        # the first call made from inside the running loop
+        self.session = None
+        self.cache = TTLCache(
+            maxsize=settings.CACHE_MAX_ENTRIES,
+            ttls={
+                "user": settings.CACHE_TTL_DIRECTORY,
+                "manager": settings.CACHE_TTL_DIRECTORY,
+                "photo": settings.CACHE_TTL_DIRECTORY,
+                "presence": settings.CACHE_TTL_PRESENCE,
+                "user_id": settings.CACHE_TTL_DIRECTORY,
+                "autoreply": settings.CACHE_TTL_AUTOREPLY,
+            },
+            negative_ttl=settings.CACHE_TTL_NEGATIVE,
+        ) if settings.CACHE_MAX_ENTRIES > 0 else None
+        self.thumbnails = ThumbnailStore(
+            settings.THUMBNAIL_CACHE_DIR, settings.THUMBNAIL_MEMORY_ENTRIES)
+        self.batcher = GraphBatcher(
+            self, settings.GRAPH_BATCH_WINDOW) if settings.GRAPH_BATCHING else None
+        self.resilience = Resilience(
+            max_retries=settings.GRAPH_RETRY_ATTEMPTS,
+            base_delay=settings.GRAPH_RETRY_BASE_DELAY,
+            max_delay=settings.GRAPH_RETRY_MAX_DELAY,
+            rate=settings.GRAPH_RATE_LIMIT,
+            burst=settings.GRAPH_RATE_BURST,
+            failure_threshold=settings.GRAPH_BREAKER_THRESHOLD,
+            reset_timeout=settings.GRAPH_BREAKER_RESET_TIMEOUT,
+        )
+        # report catalogues keyed by (site_id, drive_id), created on first use
+        self._catalogues = {}
+        # presence table kept current by change notifications, set up by the app if subscriptions are enabled
+        self.live_presence = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Returns the shared connection-pooled session, creating it on first use
+
+        Returns:
+            aiohttp.ClientSession: session used for all calls to the Graph API
+        """
+        if self.session is None or self.session.closed:
+            settings = config.DefaultConfig
+            connector = aiohttp.TCPConnector(
+                limit=settings.GRAPH_CONN_LIMIT,
+                limit_per_host=settings.GRAPH_CONN_LIMIT_PER_HOST,
+                keepalive_timeout=settings.GRAPH_KEEPALIVE_TIMEOUT,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=settings.GRAPH_TOTAL_TIMEOUT,
+                sock_connect=settings.GRAPH_CONNECT_TIMEOUT,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout)
+        return self.session
+
+    async def close(self):
+        """Stops the token refresh and the report syncs and closes the shared session releasing all pooled connections"""
+        await self.tokens.stop()
+        for catalogue in self._catalogues.values():
+            await catalogue.stop()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def _request(self, method: str, url: str, idempotent: bool = None, cost: int = 1, **kwargs) -> GraphResponse:
+        """Performs an HTTP call using the shared session. The call goes through the client-side rate limiter
+        and the circuit breaker of its endpoint, throttled and transiently failing calls are retried.
+        The time of the call, its retries included, is recorded per endpoint and final status
+
+        Args:
+            method (str): HTTP method, i.e. "GET" or "POST"
+            url (str): full URI to call
+            idempotent (bool, optional): whether repeating the call can't do any harm.
+            Defaults to True for all the methods but POST.
+            cost (int, optional): number of requests the call counts as, i.e. the size of a $batch call. Defaults to 1.
+            **kwargs: passed as-is to aiohttp.ClientSession.request, i.e. json=payload
+
+        Returns:
+            GraphResponse: fully read response. Network errors, timeouts and calls to endpoints whose
+            circuit is open are reported with the 503 status code so callers can fall back to their placeholders.
+        """
+        if idempotent is None:
+            idempotent = method != "POST"
+        endpoint = self._endpoint_key(method, url)
+        started = time.perf_counter()
+        try:
+            response = await self.resilience.call(
+                endpoint, lambda: self._send(method, url, endpoint, **kwargs), idempotent, cost)
+        except CircuitOpenError as err:
+            response = GraphResponse(503, {}, str(err).encode("utf-8"))
+        GRAPH_SECONDS.observe(time.perf_counter() - started, endpoint, str(response.status_code))
+        return response
+
+    async def _send(self, method: str, url: str, endpoint: str = None, **kwargs) -> GraphResponse:
+        """Makes a single attempt of an HTTP call, traced as a client span named after the endpoint,
+        so no ids or emails get into the traces
+
+        Args:
+            method (str): HTTP method, i.e. "GET" or "POST"
+            url (str): full URI to call
+            endpoint (str, optional): endpoint key of the call. Defaults to the one derived from the URI.
+            **kwargs: passed as-is to aiohttp.ClientSession.request, i.e. json=payload
+
+        Returns:
+            GraphResponse: fully read response, network errors and timeouts are reported with the 503 status code
+        """
+        with TRACER.span(endpoint or self._endpoint_key(method, url), kind=3, **{"http.method": method}) as span:
+            response = await self._send_attempt(method, url, **kwargs)
+            span.set(**{"http.status_code": response.status_code})
+            return response
+
+    async def _send_attempt(self, method: str, url: str, **kwargs) -> GraphResponse:
+        """Makes a single attempt of an HTTP call, getting a new token if Graph rejects the current one
+
+        Args:
+            method (str): HTTP method, i.e. "GET" or "POST"
+            url (str): full URI to call
+            **kwargs: passed as-is to aiohttp.ClientSession.request, i.e. json=payload
+
+        Returns:
+            GraphResponse: fully read response, network errors and timeouts are reported with the 503 status code
+        """
+        session = await self._get_session()
+        for attempt in range(2):
+            headers = {'Authorization': 'Bearer ' + await self.tokens.get_token()}
+            try:
+                async with session.request(method, url, headers=headers, **kwargs) as response:
+                    content = await response.read()
+                    result = GraphResponse(
+                        response.status, dict(response.headers), content)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                return GraphResponse(503, {}, str(err).encode("utf-8"))
+            if result.status_code != 401 or attempt == 1:
+                return result
+            # the token has been revoked or has expired earlier than expected
+            self.tokens.invalidate()
+
+    @staticmethod
+    def _endpoint_key(method: str, url: str) -> str:
+        """Returns the key of the endpoint a call belongs to, with the ids and paths taken out of the URI,
+        i.e. "GET /v1.0/users/{id}/presence" for "GET https://graph.microsoft.com/v1.0/users/a@b.c/presence"
+
+        Args:
+            method (str): HTTP method
+            url (str): full URI
+
+        Returns:
+            str: endpoint key
+        """
+        # root:/Deco:/children addresses an item by its path
+        segments = re.sub(r"/root:/[^:]*:?", "/root:{path}:", urlparse(url).path).split("/")
+        for i in range(1, len(segments)):
+            if segments[i - 1] in ("users", "sites", "drives", "items", "groups"):
+                segments[i] = "{id}"
+        return method + " " + "/".join(segments)
+
+    async def _call(self, method: str, path: str, version: str = "v1.0", payload: dict = None,
+                    batch: bool = False) -> GraphResponse:
+        """Calls the Graph endpoint either directly or as part of the next $batch call
+
+        Args:
+            method (str): HTTP method, i.e. "GET" or "POST"
+            path (str): path relative to the API version, i.e. "/users/{email}/presence"
+            version (str, optional): Which Graph endpoint to use. Only two valid options: "beta" and "v1.0".
+            Defaults to "v1.0".
+            payload (dict, optional): json body of the request. Defaults to None.
+            batch (bool, optional): whether the request may be combined with others into a $batch call.
+            Defaults to False.
+
+        Returns:
+            GraphResponse: fully read response
+        """
+        if batch and self.batcher is not None:
+            return await self.batcher.submit(method, path, version, payload)
+        url = await self._api_endpoint(path, version)
+        return await self._request(method, url, json=payload)
 
     async def _api_endpoint(self, url: str, version="v1.0") -> str:
         """Convert a relative path such as /me/photo/$value to a full URI based
-        on the current RESOURCE and API_VERSION settings in config.py.
+        on the resource_uri of the client, GRAPH_RESOURCE_URI from config.py by default.
 
         Args:
             url (str): [description]
@@ -75,7 +589,39 @@ class GraphClient:
         """
         if urlparse(url).scheme in ["http", "https"]:
             return url  # url is already complete
-        return urljoin(f"{RESOURCE_URI}{version}/", url.lstrip("/"))
+        return urljoin(f"{self.resource_uri}{version}/", url.lstrip("/"))
+
+    def iter_collection(
+            self,
+            path: str,
+            version: str = "v1.0",
+            select: list = None,
+            top: int = None,
+            prefetch: bool = True) -> GraphPager:
+        """Streams the items of a Graph collection page by page
+
+        Args:
+            path (str): path relative to the API version or full URI of the collection, may include a query
+            version (str, optional): Which Graph endpoint to use. Only two valid options: "beta" and "v1.0".
+            Defaults to "v1.0".
+            select (list, optional): properties to return ($select). Defaults to all of them.
+            top (int, optional): page size ($top). Defaults to GRAPH_PAGE_SIZE from config.py, 0 leaves it to Graph.
+            prefetch (bool, optional): whether to request the next page before the current one is consumed.
+            Defaults to True.
+
+        Returns:
+            GraphPager: async iterator over the items
+        """
+        if top is None:
+            top = config.DefaultConfig.GRAPH_PAGE_SIZE
+        query = []
+        if select:
+            query.append("$select=" + ",".join(select))
+        if top:
+            query.append(f"$top={top}")
+        if query:
+            path += ("&" if "?" in path else "?") + "&".join(query)
+        return GraphPager(self, path, version, prefetch)
 
     async def file_loader(self, site_id: str, drive_id: str, query: str) -> str:
         """Returns a full URI to download a file from a Sharepoint site
@@ -103,11 +649,50 @@ class GraphClient:
             bytes: file content in bytes
         """
         link = await self.file_loader(site_id, drive_id, query)
-        call = self.session.get(link)
+        call = await self._request("GET", link)
         return call.content
 
+    async def get_item_meta(self, site_id: str, drive_id: str, path: str) -> dict:
+        """Returns the id and the version metadata of a file or a folder from a Sharepoint site without downloading it
+
+        Args:
+            site_id (str): Sharepoint site where the file resides
+            drive_id (str): drive containing the desired driveItem
+            path (str): path to the file, i.e. "FunctionalAreas/selector_dialog_tree.json"
+
+        Raises:
+            ValueError: raised if no response or error reponse are received from MS server
+
+        Returns:
+            dict: dictionary with the id, eTag, cTag and lastModifiedDateTime keys
+        """
+        query = f"{path}?$select=id,eTag,cTag,lastModifiedDateTime"
+        url = await self.file_loader(site_id, drive_id, query)
+        call = await self._request("GET", url)
+        if call.status_code == 200:
+            return call.json()
+        raise ValueError(
+            f"Some connection problems. Error code: {call.status_code}")
+
+    def report_catalogue(self, site_id: str = site_id, drive_id: str = drive_id) -> ReportCatalogue:
+        """Returns the index of the ChemCourier report folders of a drive, creating it on first use
+
+        Args:
+            site_id (str, optional): Sharepoint site where the report folders reside. Defaults to the ChemCourier site.
+            drive_id (str, optional): drive containing the report folders. Defaults to the ChemCourier drive.
+
+        Returns:
+            ReportCatalogue: report index kept current with delta queries
+        """
+        if (site_id, drive_id) not in self._catalogues:
+            settings = config.DefaultConfig
+            self._catalogues[(site_id, drive_id)] = ReportCatalogue(
+                self, site_id, drive_id, settings.REPORTS_SYNC_INTERVAL, settings.REPORTS_LINK_TTL)
+        return self._catalogues[(site_id, drive_id)]
+
     async def get_latest(self, channel: str) -> str:
-        """Returns the name of the latest file from the Sharepoint folder
+        """Returns the name of the latest file from the Sharepoint folder.
+        Looked up in the report catalogue, the folder is only listed the first time it's asked for
 
         Args:
             channel (str): address of the folder where we are serching for the latest element
@@ -117,21 +702,13 @@ class GraphClient:
 
         Returns:
             str: name of the latest file from the Sharepoint folder.
-            Latest is defined as having the latest "last changes" date.
+            Latest is defined as the one marked in the "Latest" column of the document library.
         """
-        query = f"{channel}:/children?$expand=listItem($expand=fields($select=Latest))"
-        latest_file = await self.file_loader(site_id, drive_id, query)
-        call = self.session.get(latest_file)
-        if call.status_code == 200:
-            for i in call.json()['value']:
-                if i['listItem']['fields']['Latest']:
-                    return i['name']
-        else:
-            raise ValueError(
-                f"Some connection problems. Error code: {call.status_code}")
+        return await self.report_catalogue().latest(channel)
 
     async def get_links(self, site_id: str, drive_id: str, checklist: list) -> dict:
-        """Returns the dictionary of filenames and corresponding download links, selected according to checklist argument
+        """Returns the dictionary of filenames and corresponding download links, selected according to checklist argument.
+        Looked up in the report catalogue, only the links about to expire are fetched again
 
         Args:
             site_id (str): Sharepoint site to download from
@@ -145,19 +722,79 @@ class GraphClient:
             dict: dictionary with filenames and download links, such as {name:link}
         """
         channel = checklist[0].split("2")[0]  # year always starts with a 2
-        query = f"{channel}:/children?$expand=listItem"
-        url = await self.file_loader(site_id, drive_id, query)
-        call = self.session.get(url)
-        res = {}
-        if call.status_code == 200:
-            for i in call.json()['value']:
-                if i['name'] in checklist:
-                    res[i['name']] = i['@microsoft.graph.downloadUrl']
-            return res
+        return await self.report_catalogue(site_id, drive_id).links(channel, checklist)
+
+    async def get_folder_items(self, site_id: str, drive_id: str, path: str) -> list:
+        """Lists a Sharepoint folder with the "Latest" column of the document library and the download links
+
+        Args:
+            site_id (str): Sharepoint site where the folder resides
+            drive_id (str): drive containing the folder
+            path (str): path to the folder, i.e. "Deco"
+
+        Raises:
+            GraphError: raised if no response or error reponse are received from MS server
+
+        Returns:
+            list: driveItems of the folder
+        """
+        query = f"/sites/{site_id}/drives/{drive_id}/root:/{path}:/children?$expand=listItem($expand=fields($select=Latest))"
+        pager = self.iter_collection(
+            query, select=["id", "name", "file", "parentReference", "@microsoft.graph.downloadUrl"])
+        return await pager.collect()
+
+    async def get_drive_items(self, site_id: str, drive_id: str, item_ids: list) -> list:
+        """Fetches driveItems by id with the "Latest" column of the document library and the download links.
+        The requests are combined into $batch calls
+
+        Args:
+            site_id (str): Sharepoint site where the items reside
+            drive_id (str): drive containing the items
+            item_ids (list): ids of the driveItems
+
+        Returns:
+            list: driveItems found, the ones which no longer exist are left out
+        """
+        calls = await asyncio.gather(*[
+            self._call(
+                "GET",
+                f"/sites/{site_id}/drives/{drive_id}/items/{item_id}?$expand=listItem($expand=fields($select=Latest))",
+                "v1.0", batch=True)
+            for item_id in item_ids])
+        return [call.json() for call in calls if call.status_code == 200]
+
+    async def get_drive_delta(self, site_id: str, drive_id: str, delta_link: str = None) -> tuple:
+        """Returns the changes made to a drive since the delta link was issued.
+        Without a delta link no changes are returned, only the link tracking the changes from now on
+
+        Args:
+            site_id (str): Sharepoint site where the drive resides
+            drive_id (str): drive to track
+            delta_link (str, optional): link returned by the previous call. Defaults to None.
+
+        Raises:
+            GraphError: raised if no response or error reponse are received from MS server
+
+        Returns:
+            tuple: (changed driveItems, delta link for the next call).
+            Both are None if the delta link has expired and the drive has to be listed anew
+        """
+        if delta_link is None:
+            pager = self.iter_collection(
+                f"/sites/{site_id}/drives/{drive_id}/root/delta?token=latest",
+                select=["id", "name", "file", "deleted", "parentReference"])
         else:
-            raise ValueError(
-                f"Some connection problems. Error code: {call.status_code}")
+            # the delta link keeps the options of the query it was issued for
+            pager = GraphPager(self, delta_link)
+        try:
+            items = await pager.collect()
+        except GraphError as error:
+            if error.status_code == 410:
+                return None, None
+            raise
+        return items, pager.delta_link
 
+    @cached("manager", lambda manager: manager == "Not Available")
     async def get_manager(self, email: str) -> str:
         """Returns a name of a manager of an employee (defined by email arg)
 
@@ -167,13 +804,13 @@ class GraphClient:
         Returns:
             str: name of a manager or "Not Available" in case Azure AD lacks the data
         """
-        url = await self._api_endpoint(f"/{email}/manager", "v1.0")
-        res = self.session.get(url)
+        res = await self._call("GET", f"/users/{email}/manager", "v1.0", batch=True)
         if res.status_code == 200:
             return res.json()['displayName']
         else:
             return "Not Available"
 
+    @cached("autoreply")
     async def get_autorepl_date(self, email: str) -> str:
         """Returns the date till which the autoreply is active for the user specified in the email argument.
         If no autoreply is set, returns an empty string
@@ -185,14 +822,16 @@ class GraphClient:
             str: string representation of a date until which autoreply is active, formatted like %d.%m.%Y.
             If autoreply is not set - an empty string.
         """
-        url = await self._api_endpoint(f"/users/{email}/getMailTips", "v1.0")
         payload = {
             "EmailAddresses": [
                 email
             ],
             "MailTipsOptions": "automaticReplies, mailboxFullStatus"
         }
-        res = self.session.post(url=url, json=payload).json()
+        from babel.dates import format_date
+
+        res = await self._call("POST", f"/users/{email}/getMailTips", "v1.0", payload, batch=True)
+        res = res.json() if res.status_code == 200 else {}
         try:
             repl_date = res['value'][0]['automaticReplies']['scheduledEndTime']['dateTime']
             repl_date = repl_date.split("T")[0]
@@ -212,13 +851,89 @@ class GraphClient:
         Returns:
             str: current status of an employee. If no data is available for any reason the value is set to "No info"
         """
-        url = await self._api_endpoint(f"/users/{email}/presence", "beta")
-        res = self.session.get(url)
+        return (await self.get_presences([email]))[email]
+
+    async def get_presences(self, emails: List[str]) -> Dict[str, str]:
+        """Returns the current statuses of several employees at once. Statuses cached within the last
+        CACHE_TTL_PRESENCE seconds are reused, the rest are fetched with a single getPresencesByUserId call.
+        More details are available here - https://docs.microsoft.com/en-us/graph/api/cloudcommunications-getpresencesbyuserid
+
+        Args:
+            emails (List[str]): emails of the people whose statuses we are fetching
+
+        Returns:
+            Dict[str, str]: statuses keyed by the email as passed, "No info" if no data is available for any reason
+        """
+        statuses = {}
+        missing = []
+        for email in emails:
+            # statuses pushed by the change notifications are the freshest ones and cost no calls at all
+            status = self.live_presence.get(email) if self.live_presence is not None else None
+            if status is None and self.cache is not None:
+                status = self.cache.get("presence", email.lower())
+            if status is None:
+                missing.append(email)
+            else:
+                statuses[email] = status
+        if not missing:
+            return statuses
+
+        ids = await self.get_user_ids(missing)
+        by_id = await self.get_presences_by_ids([user_id for user_id in ids.values() if user_id is not None])
+        for email in missing:
+            status = by_id.get(ids.get(email), "No info")
+            statuses[email] = status
+            if self.cache is not None:
+                self.cache.set(
+                    "presence", email.lower(), status,
+                    self.cache.negative_ttl if status == "No info" else None)
+        return statuses
+
+    async def get_presences_by_ids(self, user_ids: List[str]) -> Dict[str, str]:
+        """Fetches the current statuses of users by their Azure AD object ids, up to MAX_PRESENCE_IDS per call
+
+        Args:
+            user_ids (List[str]): object ids of the users
+
+        Returns:
+            Dict[str, str]: statuses keyed by the object id, the ones Graph hasn't returned are left out
+        """
+        by_id = {}
+        for i in range(0, len(user_ids), self.MAX_PRESENCE_IDS):
+            res = await self._call(
+                "POST", "/communications/getPresencesByUserId", "v1.0", {"ids": user_ids[i:i + self.MAX_PRESENCE_IDS]})
+            if res.status_code == 200:
+                for presence in res.json().get("value", []):
+                    by_id[presence["id"]] = presence["availability"] + ", " + presence["activity"]
+        return by_id
+
+    async def get_user_ids(self, emails: List[str]) -> Dict[str, str]:
+        """Resolves emails to Azure AD object ids. The ids are cached, the missing ones are looked up
+        with requests combined into $batch calls
+
+        Args:
+            emails (List[str]): emails of the users
+
+        Returns:
+            Dict[str, str]: object ids keyed by the email as passed, None for unknown users
+        """
+        ids = await asyncio.gather(*[self._get_user_id(email) for email in emails])
+        return dict(zip(emails, ids))
+
+    @cached("user_id", lambda user_id: user_id is None)
+    async def _get_user_id(self, email: str) -> str:
+        """Looks up the Azure AD object id of a user
+
+        Args:
+            email (str): email of the user
+
+        Returns:
+            str: object id or None if the user can't be found
+        """
+        res = await self._call("GET", f"/users/{email}?$select=id", "v1.0", batch=True)
         if res.status_code == 200:
-            res = res.json()
-            return res['availability'] + ", " + res['activity']
-        else:
-            return "No info"
+            return res.json()["id"]
+        return None
 
     async def get_picture_for_adap(self, email: str) -> str:
         """Returns a base64-encoded picture of an employee specified in the email argument.
@@ -231,34 +946,57 @@ class GraphClient:
             str: base-64 encoded image of size (96,96) to be used in the Adaptive cards.
             If there is no image for the selected employee uses a placeholder image instead.
         """
-        url = await self._api_endpoint(f"/users/{email}/photo/$value", "v1.0")
-        url1 = await self._api_endpoint(f"/users/{email}/photos/96x96/$value", "v1.0")
-        res1 = self.session.get(url1)
+        data_uri = await self._get_photo(email)
+        if data_uri is None:
+            data_uri = await self.get_placeholder_picture()
+        return data_uri
+
+    @cached("photo", lambda data_uri: data_uri is None)
+    async def _get_photo(self, email: str) -> str:
+        """Fetches a picture of an employee specified in the email argument.
+        The photo is downloaded only if there is no stored thumbnail for its current eTag.
+
+        Args:
+            email (str): an email of a user whose picture we are fetching
+
+        Returns:
+            str: base-64 encoded image of size (96,96) or None if there is no picture available
+        """
+        meta = await self._call("GET", f"/users/{email}/photo", "v1.0", batch=True)
+        if meta.status_code != 200:
+            return None
+        etag = meta.json().get("@odata.mediaEtag")
+        if etag is not None:
+            data_uri = await self.thumbnails.get(email, etag)
+            if data_uri is not None:
+                return data_uri
+
+        res1 = await self._call("GET", f"/users/{email}/photos/96x96/$value", "v1.0", batch=True)
         # try to fetch 96x96 image directly, if not possible - resize it
         # accordingly
         if res1.status_code == 200:
-            base = base64.b64encode(res1.content).decode()
-            data_uri = "data:image/png;base64," + base
-            return data_uri
-
-        res = self.session.get(url)
-        if res.status_code == 200:
-            with Image.open(BytesIO(res.content)) as img:
-                img = ImageOps.fit(img, (96, 96), centering=(0.5, 0.0))
-                buffered = BytesIO()
-                img.save(buffered, format="JPEG")
-                base = base64.b64encode(buffered.getvalue()).decode()
-            data_uri = "data:image/png;base64," + base
+            data_uri = to_data_uri(
+                res1.content, res1.headers.get("Content-Type", "image/jpeg"))
         else:
-            this_file = os.getcwd()
-            full_path = os.path.join(this_file, *
-                                     ["cards_templates", "placeholder.png"])
-            with open(full_path, "rb") as f:
-                base = base64.b64encode(f.read()).decode()
-            data_uri = "data:image/png;base64," + base
+            res = await self._call("GET", f"/users/{email}/photo/$value", "v1.0", batch=True)
+            if res.status_code != 200:
+                return None
+            data_uri = await self.thumbnails.resize(res.content)
+
+        if etag is not None:
+            await self.thumbnails.put(email, etag, data_uri)
         return data_uri
 
+    async def get_placeholder_picture(self) -> str:
+        """Returns a base64-encoded placeholder picture used for employees without a photo
+
+        Returns:
+            str: base-64 encoded placeholder image to be used in the Adaptive cards
+        """
+        return self.thumbnails.placeholder
+
     # User.Read.All scope would be neccessary
+    @cached("user", lambda user: user[0] == "Not Available")
     async def get_user(self, email: str) -> list:
         """Fetches the user name and job title data. If any of them is not available
         uses a "Not Available" placeholder instead
@@ -269,8 +1007,7 @@ class GraphClient:
         Returns:
             list: [name, title, email], any missing element is replaced with the "Not Available placeholder"
         """
-        url = await self._api_endpoint(f"/users/{email}?$select=displayName,jobTitle", "v1.0")
-        res = self.session.get(url)
+        res = await self._call("GET", f"/users/{email}?$select=displayName,jobTitle", "v1.0", batch=True)
         if res.status_code == 200:
             res = res.json()
             return [res['displayName'], res['jobTitle']
@@ -278,6 +1015,68 @@ class GraphClient:
         else:
             return ["Not Available" for i in range(3)]
 
+    async def create_subscription(
+            self,
+            resource: str,
+            notification_url: str,
+            client_state: str,
+            expiration: datetime,
+            change_type: str = "updated") -> dict:
+        """Subscribes to the change notifications of a resource. Graph validates the notification URL
+        before answering, so the route has to be up by then.
+        More details are available here - https://docs.microsoft.com/en-us/graph/api/subscription-post-subscriptions
+
+        Args:
+            resource (str): resource to watch, i.e. "/communications/presences?$filter=id in ('...')"
+            notification_url (str): public HTTPS URL the notifications are posted to
+            client_state (str): secret sent back with every notification
+            expiration (datetime): UTC time at which the subscription expires
+            change_type (str, optional): changes to be notified of. Defaults to "updated".
+
+        Raises:
+            GraphError: raised if no response or error reponse are received from MS server
+
+        Returns:
+            dict: subscription with the id and expirationDateTime keys
+        """
+        payload = {
+            "changeType": change_type,
+            "notificationUrl": notification_url,
+            "resource": resource,
+            "expirationDateTime": expiration.strftime("%Y-%m-%dT%H:%M:%S.0000000Z"),
+            "clientState": client_state,
+        }
+        res = await self._call("POST", "/subscriptions", "v1.0", payload)
+        if res.status_code != 201:
+            raise GraphError(res.status_code)
+        return res.json()
+
+    async def renew_subscription(self, subscription_id: str, expiration: datetime) -> bool:
+        """Extends a subscription
+
+        Args:
+            subscription_id (str): id of the subscription
+            expiration (datetime): new UTC time at which the subscription expires
+
+        Returns:
+            bool: True if the subscription has been extended, False if it no longer exists or Graph has failed
+        """
+        payload = {"expirationDateTime": expiration.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")}
+        res = await self._call("PATCH", f"/subscriptions/{subscription_id}", "v1.0", payload)
+        return res.status_code == 200
+
+    async def delete_subscription(self, subscription_id: str) -> bool:
+        """Cancels a subscription
+
+        Args:
+            subscription_id (str): id of the subscription
+
+        Returns:
+            bool: True if the subscription has been deleted or didn't exist
+        """
+        res = await self._call("DELETE", f"/subscriptions/{subscription_id}", "v1.0")
+        return res.status_code in (204, 404)
+
     # TODO add the country selection so users form different countries get
     # different timezones
     async def set_autoreply(self, email: str, message: str, startdate: str, enddate: str) -> bool:
@@ -307,11 +1106,11 @@ class GraphClient:
                 }
             }
         }
-        response = self.session.patch(url=url, json=payload)
+        response = await self._request("PATCH", url, json=payload)
         if response.status_code == 200:
             return True
         else:
-            print(response.status_code, response.json())
+            print(f"\n [GraphClient] autoreply update failed with status {response.status_code}", file=sys.stderr)
             return False
 
     async def set_oof(self, email: str, subject: str, startdate: str, enddate: str) -> bool:
@@ -341,7 +1140,7 @@ class GraphClient:
             "showAs": "oof",
             "isAllDay": True
         }
-        response = self.session.post(url=url, json=payload)
+        response = await self._request("POST", url, json=payload)
         if response.status_code == 201:
             return True
         else:
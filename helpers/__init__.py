@@ -1,3 +1,21 @@
 from . import dialog_helper
+from . import executors
+from . import ttl_cache
+from . import decision_tree
+from . import card_templates
+from . import thumbnails
+from . import quotes
+from . import token_manager
+from . import warmup
+from . import sqlite_storage
+from . import tracked_state
+from . import report_catalogue
+from . import resilience
+from . import presence_subscriptions
+from . import metrics
+from . import profiler
 
-__all__ = ["dialog_helper"]
+__all__ = ["dialog_helper", "executors", "ttl_cache", "decision_tree", "card_templates", "thumbnails", "quotes",
+           "token_manager", "warmup", "sqlite_storage",
+           "tracked_state", "report_catalogue", "resilience",
+           "presence_subscriptions", "metrics", "profiler"]
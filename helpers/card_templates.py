@@ -0,0 +1,190 @@
+import copy
+import json
+import os
+import sys
+import time
+from typing import Callable
+
+TEMPLATES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cards_templates")
+
+
+class CardTemplate:
+    """A parsed and validated Adaptive card template
+
+    Attributes:
+        name(str): template name, i.e. the file name in the templates folder
+        card(dict): parsed card json. Must never be modified, use CardTemplateRegistry.render instead
+        slots(dict): paths to all the elements having an "id", keyed by that id
+        mtime(float): modification time of the file the template was loaded from
+    """
+
+    def __init__(self, name: str, card: dict, mtime: float):
+        """inits the CardTemplate instance and indexes its slots
+
+        Args:
+            name (str): template name
+            card (dict): parsed card json
+            mtime (float): modification time of the file the template was loaded from
+
+        Raises:
+            ValueError: raised if the json is not an Adaptive card or has duplicate element ids
+        """
+        if not isinstance(card, dict) or card.get("type") != "AdaptiveCard" or not isinstance(card.get("body"), list):
+            raise ValueError(f"{name} is not a valid Adaptive card")
+        self.name = name
+        self.card = card
+        self.mtime = mtime
+        self.slots = {}
+        self._index_slots(card, ())
+
+    def _index_slots(self, node, path: tuple):
+        """Walks the card json and records the path to every element with an "id"
+
+        Args:
+            node: current json node
+            path (tuple): keys and indexes leading to the node
+        """
+        if isinstance(node, dict):
+            if "id" in node and path:
+                if node["id"] in self.slots:
+                    raise ValueError(
+                        f"{self.name} has a duplicate element id: {node['id']}")
+                self.slots[node["id"]] = path
+            children = node.items()
+        elif isinstance(node, list):
+            children = enumerate(node)
+        else:
+            return
+        for key, child in children:
+            self._index_slots(child, path + (key,))
+
+
+class CardTemplateRegistry:
+    """Loads and validates all Adaptive card templates once, reloads them when the files change
+    and hands out filled-in copies. Only the containers on the way to the filled slots are copied,
+    the rest of the json is shared with the template.
+
+    Attributes:
+        directory(str): folder containing the templates
+        reload_interval(float): min number of seconds between checks for changed files
+        templates(dict): CardTemplate instances keyed by name
+    """
+
+    def __init__(
+            self,
+            directory: str = TEMPLATES_DIR,
+            reload_interval: float = 5.0,
+            clock: Callable[[], float] = time.monotonic):
+        """inits the CardTemplateRegistry instance and loads all the templates
+
+        Args:
+            directory (str, optional): folder containing the templates. Defaults to the cards_templates folder.
+            reload_interval (float, optional): min number of seconds between checks for changed files. Defaults to 5.0.
+            clock (Callable[[], float], optional): monotonic time source. Defaults to time.monotonic.
+
+        Raises:
+            ValueError: raised if any of the templates is invalid
+        """
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.templates = {}
+        self._clock = clock
+        self._checked_at = clock()
+        for name in self._template_names():
+            self.templates[name] = self._load(name)
+
+    def _template_names(self) -> list:
+        """Lists the template files, skipping images and other non-json assets
+
+        Returns:
+            list: template names
+        """
+        return [name for name in os.listdir(self.directory)
+                if os.path.isfile(os.path.join(self.directory, name))
+                and os.path.splitext(name)[1] in ("", ".json")]
+
+    def _load(self, name: str) -> CardTemplate:
+        """Reads, parses and validates a single template
+
+        Args:
+            name (str): template name
+
+        Returns:
+            CardTemplate: loaded template
+        """
+        full_path = os.path.join(self.directory, name)
+        mtime = os.path.getmtime(full_path)
+        with open(full_path, "r", encoding="utf-8") as card_file:
+            return CardTemplate(name, json.load(card_file), mtime)
+
+    def _reload_changed(self):
+        """Reloads the templates whose files have changed. Broken files are reported
+        and the previous version of the template is kept"""
+        self._checked_at = self._clock()
+        for name in self._template_names():
+            template = self.templates.get(name)
+            try:
+                full_path = os.path.join(self.directory, name)
+                if template is None or os.path.getmtime(full_path) != template.mtime:
+                    self.templates[name] = self._load(name)
+            except (OSError, ValueError) as error:
+                print(f"\n [CardTemplateRegistry] can't reload {name}: {error}", file=sys.stderr)
+
+    def get(self, name: str) -> CardTemplate:
+        """Returns a template, checking for changed files at most once per reload_interval
+
+        Args:
+            name (str): template name
+
+        Returns:
+            CardTemplate: current version of the template
+        """
+        if self._clock() - self._checked_at > self.reload_interval:
+            self._reload_changed()
+        return self.templates[name]
+
+    def render(self, name: str, slots: dict) -> dict:
+        """Returns a copy of the template with the slots filled in
+
+        Args:
+            name (str): template name
+            slots (dict): properties to set keyed by the element id,
+            i.e. {"name": {"text": "John"}, "photo": {"url": "data:..."}}
+
+        Raises:
+            KeyError: raised if the template has no element with one of the given ids
+
+        Returns:
+            dict: filled-in card json
+        """
+        template = self.get(name)
+        card = dict(template.card)
+        copied = {(): card}
+        for slot_id, properties in slots.items():
+            path = template.slots[slot_id]
+            node = card
+            for i, key in enumerate(path):
+                child = copied.get(path[:i + 1])
+                if child is None:
+                    child = copy.copy(node[key])
+                    node[key] = child
+                    copied[path[:i + 1]] = child
+                node = child
+            node.update(properties)
+        return card
+
+
+_registry = None
+
+
+def get_registry() -> CardTemplateRegistry:
+    """Returns the registry shared by all the dialogs, loading the templates on first use
+
+    Returns:
+        CardTemplateRegistry: shared registry
+    """
+    global _registry
+    if _registry is None:
+        _registry = CardTemplateRegistry()
+    return _registry
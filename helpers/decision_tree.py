@@ -0,0 +1,194 @@
+import asyncio
+import json
+import sys
+import time
+from typing import Callable
+
+
+class DecisionTreeStore:
+    """Keeps a parsed, shared copy of the decision tree json stored on a Sharepoint site.
+    The copy is revalidated in the background using the driveItem's cTag/eTag,
+    so the file is downloaded again only when it has actually changed.
+
+    Attributes:
+        client(GraphClient): MS Graph client used to check and download the file
+        site_id(str): id of the Sharepoint site where the json file resides
+        drive_id(str): id of the drive resource where the json file resides
+        path(str): path to the json file inside the drive
+        max_staleness(float): seconds after which the copy is revalidated
+        tree(dict): parsed decision tree or None if it hasn't been loaded yet
+        index(TreeIndex): the tree compiled for navigation or None if it hasn't been loaded yet
+        version(str): cTag (or eTag/lastModifiedDateTime) of the loaded copy
+    """
+
+    def __init__(
+            self,
+            client,
+            site_id: str,
+            drive_id: str,
+            path: str,
+            max_staleness: float,
+            clock: Callable[[], float] = time.monotonic):
+        """inits the DecisionTreeStore instance
+
+        Args:
+            client (GraphClient): MS Graph client used to check and download the file
+            site_id (str): id of the Sharepoint site where the json file resides
+            drive_id (str): id of the drive resource where the json file resides
+            path (str): path to the json file inside the drive
+            max_staleness (float): seconds after which the copy is revalidated
+            clock (Callable[[], float], optional): monotonic time source. Defaults to time.monotonic.
+        """
+        self.client = client
+        self.site_id = site_id
+        self.drive_id = drive_id
+        self.path = path
+        self.max_staleness = max_staleness
+        self.tree = None
+        self.index = None
+        self.version = None
+        self._clock = clock
+        self._checked_at = 0.0
+        self._refresh_task = None
+
+    async def get(self) -> dict:
+        """Returns the parsed decision tree. Only the very first call waits for the download,
+        stale copies are returned as-is while the revalidation runs in the background.
+
+        Returns:
+            dict: parsed decision tree
+        """
+        if self.tree is None:
+            await self._refresh_once()
+        elif self._clock() - self._checked_at > self.max_staleness and self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._refresh_in_background())
+        return self.tree
+
+    async def get_index(self) -> "TreeIndex":
+        """Returns the compiled decision tree, following the same revalidation rules as the get method
+
+        Returns:
+            TreeIndex: compiled decision tree
+        """
+        await self.get()
+        return self.index
+
+    async def refresh(self):
+        """Checks the file version and downloads the file if it has changed"""
+        meta = await self.client.get_item_meta(self.site_id, self.drive_id, self.path)
+        version = meta.get("cTag") or meta.get("eTag") or meta.get("lastModifiedDateTime")
+        if self.tree is None or version is None or version != self.version:
+            content = await self.client.download_file(
+                self.site_id, self.drive_id, f"{self.path}:/content")
+            tree = json.loads(content.decode("utf-8"))
+            # the index is compiled before publishing so readers never see a
+            # tree and an index of different versions
+            index = TreeIndex(tree)
+            self.tree, self.index = tree, index
+            self.version = version
+        self._checked_at = self._clock()
+
+    async def _refresh_once(self):
+        """Runs a single refresh shared by all concurrent callers"""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self.refresh())
+        task = self._refresh_task
+        try:
+            await asyncio.shield(task)
+        finally:
+            if self._refresh_task is task:
+                self._refresh_task = None
+
+    async def _refresh_in_background(self):
+        """Refreshes the copy, keeping the previous one if anything goes wrong"""
+        try:
+            await self.refresh()
+        except Exception as error:
+            print(f"\n [DecisionTreeStore] refresh failed: {error}", file=sys.stderr)
+            # don't retry on every turn while the upstream is failing
+            self._checked_at = self._clock()
+        finally:
+            self._refresh_task = None
+
+
+class TreeNode:
+    """A single node of a compiled decision tree
+
+    Attributes:
+        children(tuple): names of the options available at this node, in the order of the json file
+        is_leaf(bool): True if the node is terminal, i.e. holds contacts instead of further options
+        emails(tuple): emails of the contacts of a leaf, or all the contacts below an inner node
+    """
+
+    __slots__ = ("children", "is_leaf", "emails")
+
+    def __init__(self, children: tuple, is_leaf: bool, emails: tuple):
+        """inits the TreeNode instance
+
+        Args:
+            children (tuple): names of the options available at this node
+            is_leaf (bool): True if the node is terminal
+            emails (tuple): emails of the contacts of the node
+        """
+        self.children = children
+        self.is_leaf = is_leaf
+        self.emails = emails
+
+
+class TreeIndex:
+    """Decision tree compiled once into a flat index keyed by path, so every navigation
+    step is a single dictionary lookup regardless of the depth of the tree
+
+    Attributes:
+        nodes(dict): TreeNode instances keyed by the path as a tuple of option names, the root is ()
+    """
+
+    def __init__(self, tree: dict):
+        """inits the TreeIndex instance
+
+        Args:
+            tree (dict): parsed decision tree json
+        """
+        self.nodes = {}
+        self._compile((), tree)
+
+    def __contains__(self, path) -> bool:
+        return tuple(path) in self.nodes
+
+    def node(self, path) -> TreeNode:
+        """Returns the node at the given path
+
+        Args:
+            path (Iterable[str]): option names selected so far
+
+        Raises:
+            KeyError: raised if the path doesn't exist in the tree
+
+        Returns:
+            TreeNode: node at the given path
+        """
+        return self.nodes[tuple(path)]
+
+    def _compile(self, path: tuple, subtree) -> tuple:
+        """Adds the subtree to the index
+
+        Args:
+            path (tuple): path of the subtree's root
+            subtree: dict for inner nodes, list of emails (or any other value) for leaves
+
+        Returns:
+            tuple: all the emails found in the subtree
+        """
+        if isinstance(subtree, dict):
+            emails = []
+            for key, child in subtree.items():
+                for email in self._compile(path + (key,), child):
+                    if email not in emails:
+                        emails.append(email)
+            emails = tuple(emails)
+            self.nodes[path] = TreeNode(tuple(subtree.keys()), False, emails)
+        else:
+            values = subtree if isinstance(subtree, list) else [subtree]
+            emails = tuple(i for i in values if isinstance(i, str) and "@" in i)
+            self.nodes[path] = TreeNode((), True, emails)
+        return emails
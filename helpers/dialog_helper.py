@@ -1,5 +1,11 @@
+import time
+
 from botbuilder.core import StatePropertyAccessor, TurnContext
-from botbuilder.dialogs import Dialog, DialogSet, DialogTurnStatus
+from botbuilder.dialogs import Dialog, DialogSet, DialogTurnResult, DialogTurnStatus, WaterfallDialog, WaterfallStepContext
+
+from helpers.metrics import STEP_SECONDS
+from helpers.profiler import note_step
+from helpers.tracing import TRACER
 
 
 class DialogHelper:
@@ -7,10 +13,36 @@ class DialogHelper:
     async def run_dialog(
         dialog: Dialog, turn_context: TurnContext, accessor: StatePropertyAccessor
     ):
-        dialog_set = DialogSet(accessor)
-        dialog_set.add(dialog)
+        with TRACER.span("run_dialog", dialog=dialog.id):
+            dialog_set = DialogSet(accessor)
+            dialog_set.add(dialog)
+
+            dialog_context = await dialog_set.create_context(turn_context)
+            results = await dialog_context.continue_dialog()
+            if results.status == DialogTurnStatus.Empty:
+                await dialog_context.begin_dialog(dialog.id)
+
+
+class TimedWaterfallDialog(WaterfallDialog):
+    """WaterfallDialog recording the time of every step in the bot_dialog_step_seconds histogram,
+    labelled with the class and the name of the step method, i.e. ("StocksDialog", "only_step"),
+    and tracing every step as a span of the turn. The steps are also noted for the turn profiler
+    """
+
+    async def on_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
+        """Runs a step and records its time and its span, the failed steps included
+
+        Args:
+            step_context (WaterfallStepContext): the context for the current dialog turn
 
-        dialog_context = await dialog_set.create_context(turn_context)
-        results = await dialog_context.continue_dialog()
-        if results.status == DialogTurnStatus.Empty:
-            await dialog_context.begin_dialog(dialog.id)
+        Returns:
+            DialogTurnResult: result of the step
+        """
+        dialog, _, step = self._steps[step_context.index].__qualname__.rpartition(".")
+        note_step(dialog or self.id, step)
+        started = time.perf_counter()
+        try:
+            with TRACER.span(f"{dialog or self.id}.{step}", step_index=step_context.index):
+                return await super().on_step(step_context)
+        finally:
+            STEP_SECONDS.observe(time.perf_counter() - started, dialog or self.id, step)
@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from config import DefaultConfig
+from helpers.tracing import TRACER
+
+
+class ManagedExecutor:
+    """Thread pool for blocking work that keeps track of its queue depth and of the time
+    the jobs spend waiting for a free worker
+
+    Attributes:
+        name(str): name of the pool, i.e. "io" or "cpu"
+        max_workers(int): number of worker threads
+        stats(dict): submitted/started/completed/failed counters and wait/run time totals in seconds
+    """
+
+    def __init__(self, name: str, max_workers: int):
+        """inits the ManagedExecutor instance
+
+        Args:
+            name (str): name of the pool, i.e. "io" or "cpu"
+            max_workers (int): number of worker threads
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.stats = {
+            "submitted": 0,
+            "started": 0,
+            "completed": 0,
+            "failed": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "run_seconds_total": 0.0,
+        }
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"bot-{name}")
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a free worker"""
+        return self.stats["submitted"] - self.stats["started"]
+
+    @property
+    def in_flight(self) -> int:
+        """Number of jobs currently being run"""
+        return self.stats["started"] - self.stats["completed"] - self.stats["failed"]
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Runs a blocking callable in the pool without blocking the event loop
+
+        Args:
+            func (Callable): blocking callable
+            *args: positional arguments for the callable
+            **kwargs: keyword arguments for the callable
+
+        Returns:
+            result of the callable
+        """
+        with self._lock:
+            self.stats["submitted"] += 1
+        loop = asyncio.get_running_loop()
+        job = functools.partial(self._measured, time.perf_counter(), func, args, kwargs)
+        with TRACER.span(f"{self.name}: {getattr(func, '__qualname__', type(func).__name__)}"):
+            return await loop.run_in_executor(self._pool, job)
+
+    def _measured(self, submitted_at: float, func: Callable, args: tuple, kwargs: dict):
+        """Runs the callable inside a worker thread and records the wait and run times
+
+        Args:
+            submitted_at (float): perf_counter value at the moment of submission
+            func (Callable): blocking callable
+            args (tuple): positional arguments for the callable
+            kwargs (dict): keyword arguments for the callable
+
+        Returns:
+            result of the callable
+        """
+        started_at = time.perf_counter()
+        wait = started_at - submitted_at
+        with self._lock:
+            self.stats["started"] += 1
+            self.stats["wait_seconds_total"] += wait
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], wait)
+        outcome = "failed"
+        try:
+            result = func(*args, **kwargs)
+            outcome = "completed"
+            return result
+        finally:
+            with self._lock:
+                self.stats[outcome] += 1
+                self.stats["run_seconds_total"] += time.perf_counter() - started_at
+
+    def shutdown(self, wait: bool = True):
+        """Stops the worker threads
+
+        Args:
+            wait (bool, optional): whether to wait for the running jobs. Defaults to True.
+        """
+        self._pool.shutdown(wait=wait)
+
+
+_executors = {}
+
+
+def get_executor(name: str) -> ManagedExecutor:
+    """Returns one of the shared pools, creating it on first use.
+    "io" is meant for blocking network and disk calls, "cpu" for number crunching such as image resizing
+
+    Args:
+        name (str): "io" or "cpu"
+
+    Returns:
+        ManagedExecutor: shared pool
+    """
+    executor = _executors.get(name)
+    if executor is None:
+        sizes = {
+            "io": DefaultConfig.EXECUTOR_IO_WORKERS,
+            "cpu": DefaultConfig.EXECUTOR_CPU_WORKERS or os.cpu_count() or 2,
+        }
+        executor = _executors[name] = ManagedExecutor(name, sizes[name])
+    return executor
+
+
+async def run_io(func: Callable, *args, **kwargs):
+    """Runs a blocking network or disk call in the shared I/O pool
+
+    Args:
+        func (Callable): blocking callable
+        *args: positional arguments for the callable
+        **kwargs: keyword arguments for the callable
+
+    Returns:
+        result of the callable
+    """
+    return await get_executor("io").run(func, *args, **kwargs)
+
+
+async def run_cpu(func: Callable, *args, **kwargs):
+    """Runs a CPU-bound callable in the shared CPU pool
+
+    Args:
+        func (Callable): CPU-bound callable
+        *args: positional arguments for the callable
+        **kwargs: keyword arguments for the callable
+
+    Returns:
+        result of the callable
+    """
+    return await get_executor("cpu").run(func, *args, **kwargs)
+
+
+def executor_stats() -> dict:
+    """Returns the metrics of all the pools created so far
+
+    Returns:
+        dict: stats keyed by the pool name, including the current queue depth and in-flight jobs
+    """
+    return {
+        name: dict(executor.stats, queue_depth=executor.queue_depth, in_flight=executor.in_flight)
+        for name, executor in _executors.items()
+    }
+
+
+def shutdown_executors(wait: bool = True):
+    """Stops all the pools created so far
+
+    Args:
+        wait (bool, optional): whether to wait for the running jobs. Defaults to True.
+    """
+    for executor in _executors.values():
+        executor.shutdown(wait=wait)
+    _executors.clear()
@@ -0,0 +1,393 @@
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+# seconds, from a cache hit to a Graph call stuck behind throttling
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class MetricFamily(NamedTuple):
+    """Samples of a single metric collected at scrape time
+
+    Attributes:
+        name(str): metric name, i.e. "bot_cache_events_total"
+        kind(str): "counter" or "gauge"
+        help(str): one-line description
+        samples(List[Tuple[dict, float]]): (labels, value) pairs
+    """
+    name: str
+    kind: str
+    help: str
+    samples: List[Tuple[dict, float]]
+
+
+def _labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    """Formats a label set in the Prometheus text format
+
+    Args:
+        names (Tuple[str, ...]): label names
+        values (tuple): label values in the same order
+        extra (str, optional): already formatted label appended at the end, i.e. 'le="0.5"'. Defaults to "".
+
+    Returns:
+        str: i.e. '{endpoint="GET /v1.0/users/{id}",status="200"}' or "" without labels
+    """
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\")
+        value = value.replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    """Formats a sample value
+
+    Args:
+        value (float): value
+
+    Returns:
+        str: integers without the fractional part, the rest with up to 6 significant digits
+    """
+    return str(int(value)) if float(value).is_integer() else f"{value:.6g}"
+
+
+class Counter:
+    """Monotonic counter with an optional set of labels
+
+    Attributes:
+        name(str): metric name, should end with _total
+        help(str): one-line description
+        label_names(Tuple[str, ...]): names of the labels
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+        """inits the Counter instance
+
+        Args:
+            name (str): metric name, should end with _total
+            help (str): one-line description
+            label_names (Tuple[str, ...], optional): names of the labels. Defaults to none.
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        """Adds to the counter
+
+        Args:
+            *labels: label values in the order of label_names
+            amount (float, optional): value to add. Defaults to 1.
+        """
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        """Returns the current value
+
+        Args:
+            *labels: label values in the order of label_names
+
+        Returns:
+            float: value, 0 if it has never been set
+        """
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        """Formats the samples in the Prometheus text format
+
+        Returns:
+            List[str]: lines
+        """
+        return [f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+                for labels, value in list(self._values.items())]
+
+
+class Gauge(Counter):
+    """Value which goes up and down, i.e. the number of turns being handled"""
+
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        """Sets the gauge
+
+        Args:
+            value (float): new value
+            *labels: label values in the order of label_names
+        """
+        self._values[labels] = value
+
+    def dec(self, *labels, amount: float = 1):
+        """Subtracts from the gauge
+
+        Args:
+            *labels: label values in the order of label_names
+            amount (float, optional): value to subtract. Defaults to 1.
+        """
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets. An observation costs a binary search and two additions,
+    the cumulative bucket counts are only computed when the metrics are scraped
+
+    Attributes:
+        name(str): metric name, i.e. "bot_turn_seconds"
+        help(str): one-line description
+        label_names(Tuple[str, ...]): names of the labels
+        buckets(Tuple[float, ...]): upper bounds of the buckets in ascending order, +Inf is implied
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """inits the Histogram instance
+
+        Args:
+            name (str): metric name, i.e. "bot_turn_seconds"
+            help (str): one-line description
+            label_names (Tuple[str, ...], optional): names of the labels. Defaults to none.
+            buckets (Tuple[float, ...], optional): upper bounds of the buckets. Defaults to DEFAULT_BUCKETS.
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [count of every bucket and of +Inf, sum]
+        self._series = {}
+
+    def observe(self, value: float, *labels):
+        """Records an observation
+
+        Args:
+            value (float): observed value, i.e. seconds
+            *labels: label values in the order of label_names
+        """
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [
+                [0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *labels) -> "_Timer":
+        """Returns a context manager observing the time spent inside it
+
+        Args:
+            *labels: label values in the order of label_names
+
+        Returns:
+            _Timer: context manager
+        """
+        return _Timer(self, labels)
+
+    def count(self, *labels) -> int:
+        """Returns the number of observations
+
+        Args:
+            *labels: label values in the order of label_names
+
+        Returns:
+            int: number of observations
+        """
+        series = self._series.get(labels)
+        return sum(series[0]) if series is not None else 0
+
+    def render(self) -> List[str]:
+        """Formats the samples in the Prometheus text format
+
+        Returns:
+            List[str]: lines
+        """
+        lines = []
+        bounds = [_number(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = 'le="' + bound + '"'
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(
+                f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}")
+            lines.append(
+                f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    """Context manager observing the time spent inside it in a histogram"""
+
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        self.histogram.observe(elapsed, *self.labels)
+
+
+class Registry:
+    """Set of metrics rendered together in the Prometheus text format.
+    Instruments are updated on the hot path, collectors are called at scrape time only and are meant for
+    the stats dicts the components keep anyway, so exposing them costs nothing between scrapes
+
+    Attributes:
+        instruments(Dict[str, object]): counters, gauges and histograms keyed by the name
+        collectors(List[Callable[[], Iterable[MetricFamily]]]): callables returning the metrics collected at scrape time
+    """
+
+    def __init__(self):
+        """inits the Registry instance"""
+        self.instruments = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        """Returns the counter with the given name, creating it on first use
+
+        Args:
+            name (str): metric name
+            help (str): one-line description
+            label_names (Tuple[str, ...], optional): names of the labels. Defaults to none.
+
+        Returns:
+            Counter: counter
+        """
+        return self._instrument(Counter, name, help, label_names)
+
+    def gauge(self, name: str, help: str, label_names: Tuple[str, ...] = ()) -> Gauge:
+        """Returns the gauge with the given name, creating it on first use
+
+        Args:
+            name (str): metric name
+            help (str): one-line description
+            label_names (Tuple[str, ...], optional): names of the labels. Defaults to none.
+
+        Returns:
+            Gauge: gauge
+        """
+        return self._instrument(Gauge, name, help, label_names)
+
+    def histogram(self, name: str, help: str, label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """Returns the histogram with the given name, creating it on first use
+
+        Args:
+            name (str): metric name
+            help (str): one-line description
+            label_names (Tuple[str, ...], optional): names of the labels. Defaults to none.
+            buckets (Tuple[float, ...], optional): upper bounds of the buckets. Defaults to DEFAULT_BUCKETS.
+
+        Returns:
+            Histogram: histogram
+        """
+        return self._instrument(Histogram, name, help, label_names, buckets)
+
+    def register(self, collector: Callable[[], Iterable[MetricFamily]]):
+        """Adds a callable returning metrics collected at scrape time
+
+        Args:
+            collector (Callable[[], Iterable[MetricFamily]]): returns the metric families
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        """Formats all the metrics in the Prometheus text format. A failing collector is reported
+        as a comment, so the rest of the metrics are still served
+
+        Returns:
+            str: exposition text
+        """
+        lines = []
+        for instrument in list(self.instruments.values()):
+            lines += [f"# HELP {instrument.name} {instrument.help}",
+                      f"# TYPE {instrument.name} {instrument.kind}"]
+            lines += instrument.render()
+        for collector in self.collectors:
+            try:
+                families = list(collector())
+            except Exception as error:
+                lines.append(
+                    f"# collector {getattr(collector, '__name__', collector)} failed: {error}")
+                continue
+            for family in families:
+                names = tuple(
+                    sorted({name for labels, _ in family.samples for name in labels}))
+                lines += [f"# HELP {family.name} {family.help}",
+                          f"# TYPE {family.name} {family.kind}"]
+                lines += [
+                    f"{family.name}{_labels(names, tuple(labels.get(name, '') for name in names))} {_number(value)}"
+                    for labels, value in family.samples]
+        return "\n".join(lines) + "\n"
+
+    def _instrument(self, cls, name: str, *args):
+        """Returns the instrument with the given name, creating it on first use
+
+        Args:
+            cls: Counter, Gauge or Histogram
+            name (str): metric name
+            *args: constructor arguments after the name
+
+        Raises:
+            ValueError: raised if the name is taken by an instrument of another kind
+
+        Returns:
+            instrument
+        """
+        instrument = self.instruments.get(name)
+        if instrument is None:
+            with self._lock:
+                instrument = self.instruments.setdefault(
+                    name, cls(name, *args))
+        if type(instrument) is not cls:
+            raise ValueError(
+                f"Metric {name} is already registered as a {instrument.kind}")
+        return instrument
+
+
+def stats_family(name: str, help: str, stats: Dict[str, float], label: str = "event", kind: str = "counter",
+                 **labels) -> MetricFamily:
+    """Turns a stats dict kept by a component into a metric family, one sample per key
+
+    Args:
+        name (str): metric name, i.e. "bot_cache_events_total"
+        help (str): one-line description
+        stats (Dict[str, float]): stats dict, i.e. {"hits": 10, "misses": 2}
+        label (str, optional): label the keys go to. Defaults to "event".
+        kind (str, optional): "counter" or "gauge". Defaults to "counter".
+        **labels: labels added to every sample, i.e. pool="io"
+
+    Returns:
+        MetricFamily: metric family
+    """
+    return MetricFamily(name, kind, help, [(dict(labels, **{label: key}), value) for key, value in stats.items()])
+
+
+REGISTRY = Registry()
+
+# instruments of the hot path, shared by the app, the dialogs and the Graph client
+TURN_SECONDS = REGISTRY.histogram(
+    "bot_turn_seconds", "Time to handle a POST to /api/messages", ("activity_type", "status"))
+TURNS_IN_FLIGHT = REGISTRY.gauge(
+    "bot_turns_in_flight", "Turns being handled right now")
+TURN_ERRORS = REGISTRY.counter(
+    "bot_turn_errors_total", "Turns failed with an unhandled error", ("error",))
+STEP_SECONDS = REGISTRY.histogram(
+    "bot_dialog_step_seconds", "Time spent in a waterfall step, including the dialogs it begins", ("dialog", "step"))
+GRAPH_SECONDS = REGISTRY.histogram(
+    "bot_graph_request_seconds", "Time of a Graph call including its retries", ("endpoint", "status"))
@@ -0,0 +1,272 @@
+import asyncio
+import hmac
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List
+
+from aiohttp.web import Request, Response
+
+
+class PresenceSubscriptions:
+    """Keeps the statuses of a set of contacts current with Graph change notifications instead of polling.
+    The contacts are subscribed to in groups of up to MAX_IDS, the subscriptions are renewed before they expire
+    and the contact list is reread on every renewal, so people added to the tree are picked up.
+    Notifications carrying the status (rich notifications) are applied as they are, for the others the changed
+    statuses are fetched with a single bulk call per short window. A status is only served while the subscription
+    covering it is alive, otherwise the callers fall back to polling.
+    More details on presence subscriptions are available here -
+    https://docs.microsoft.com/en-us/graph/api/resources/webhooks
+
+    Attributes:
+        MAX_IDS (int): max number of users a single presence subscription can watch
+        client (GraphClient): client used for all the Graph calls
+        contacts (Callable[[], Awaitable[List[str]]]): returns the emails of the people to watch
+        notification_url (str): public HTTPS URL of the notification route
+        client_state (str): secret Graph sends back with every notification
+        lifetime (float): seconds a subscription is created or renewed for. Graph allows at most an hour for presence
+        renew_margin (float): seconds before the expiry at which the subscriptions are renewed
+        refresh_window (float): seconds during which changed ids are collected before the bulk fetch
+        statuses (Dict[str, str]): statuses keyed by the object id
+        stats (dict): notifications/rejected/applied/fetched/subscribed/renewed/failures counters
+    """
+
+    MAX_IDS = 650
+
+    def __init__(
+            self,
+            client,
+            contacts: Callable[[], Awaitable[List[str]]],
+            notification_url: str,
+            client_state: str,
+            lifetime: float = 3600,
+            renew_margin: float = 600,
+            refresh_window: float = 0.5,
+            clock: Callable[[], float] = time.time):
+        """inits the PresenceSubscriptions instance. No network calls are made here.
+
+        Args:
+            client (GraphClient): client used for all the Graph calls
+            contacts (Callable[[], Awaitable[List[str]]]): returns the emails of the people to watch
+            notification_url (str): public HTTPS URL of the notification route
+            client_state (str): secret Graph sends back with every notification
+            lifetime (float, optional): seconds a subscription is created or renewed for. Defaults to 3600.
+            renew_margin (float, optional): seconds before the expiry at which the subscriptions are renewed.
+            Defaults to 600.
+            refresh_window (float, optional): seconds during which changed ids are collected. Defaults to 0.5.
+            clock (Callable[[], float], optional): unix time source. Defaults to time.time.
+        """
+        self.client = client
+        self.contacts = contacts
+        self.notification_url = notification_url
+        self.client_state = client_state
+        self.lifetime = lifetime
+        self.renew_margin = renew_margin
+        self.refresh_window = refresh_window
+        self.statuses = {}
+        self.stats = {
+            "notifications": 0, "rejected": 0, "applied": 0, "fetched": 0, "subscribed": 0, "renewed": 0, "failures": 0}
+        self._clock = clock
+        # object ids keyed by the lowercased email
+        self._ids = {}
+        # (ids, expires_at) keyed by the subscription id
+        self._subscriptions = {}
+        self._covered_until = {}
+        self._changed = set()
+        self._refresh_task = None
+        self._task = None
+
+    def get(self, email: str) -> str:
+        """Returns the status of a contact if it's kept current by a live subscription
+
+        Args:
+            email (str): email of the contact
+
+        Returns:
+            str: status or None if the contact isn't watched or its subscription has lapsed
+        """
+        user_id = self._ids.get(email.lower())
+        if user_id is None or self._covered_until.get(user_id, 0.0) <= self._clock():
+            return None
+        return self.statuses.get(user_id)
+
+    def handle(self, body: dict) -> int:
+        """Applies a batch of notifications posted to the notification route. Never waits for Graph,
+        so the route answers well within the time Graph allows
+
+        Args:
+            body (dict): parsed notification payload
+
+        Returns:
+            int: number of the notifications accepted
+        """
+        accepted = 0
+        for notification in body.get("value", []):
+            self.stats["notifications"] += 1
+            known = notification.get("subscriptionId") in self._subscriptions
+            if not known or not hmac.compare_digest(str(notification.get("clientState", "")), self.client_state):
+                self.stats["rejected"] += 1
+                continue
+            accepted += 1
+            data = notification.get("resourceData") or {}
+            user_id = data.get("id")
+            if user_id is None:
+                continue
+            if "availability" in data and "activity" in data:
+                self.statuses[user_id] = data["availability"] + \
+                    ", " + data["activity"]
+                self.stats["applied"] += 1
+            else:
+                self._changed.add(user_id)
+        if self._changed and (self._refresh_task is None or self._refresh_task.done()):
+            self._refresh_task = asyncio.ensure_future(self._refresh_changed())
+        return accepted
+
+    async def notification_handler(self, req: Request) -> Response:
+        """aiohttp handler of the notification route. Echoes the validation token Graph sends while subscribing,
+        accepts the notifications otherwise
+
+        Args:
+            req (Request): request posted by Graph
+
+        Returns:
+            Response: the token as plain text, 202 for notifications or 400 for a malformed body
+        """
+        if "validationToken" in req.query:
+            return Response(text=req.query["validationToken"], content_type="text/plain")
+        try:
+            body = await req.json()
+        except ValueError:
+            return Response(status=400)
+        self.handle(body)
+        return Response(status=202)
+
+    def start(self):
+        """Starts the background loop subscribing to the contacts and renewing the subscriptions"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops the background loop and cancels the subscriptions"""
+        for task in (self._task, self._refresh_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._task = self._refresh_task = None
+        subscriptions, self._subscriptions = self._subscriptions, {}
+        self._covered_until = {}
+        await asyncio.gather(
+            *[self.client.delete_subscription(subscription_id)
+              for subscription_id in subscriptions],
+            return_exceptions=True)
+
+    async def sync(self):
+        """Renews the subscriptions about to expire and subscribes to the contacts not watched yet"""
+        now = self._clock()
+        for subscription_id, (ids, expires_at) in list(self._subscriptions.items()):
+            if expires_at - self.renew_margin > now:
+                continue
+            expiration = now + self.lifetime
+            if await self.client.renew_subscription(subscription_id, self._utc(expiration)):
+                self._track(subscription_id, ids, expiration)
+                self.stats["renewed"] += 1
+            else:
+                # expired or deleted on the Graph side, its contacts are subscribed to anew below
+                self._forget(subscription_id)
+
+        emails = await self.contacts()
+        self._ids.update({
+            email.lower(): user_id for email, user_id in (await self.client.get_user_ids(emails)).items()
+            if user_id is not None})
+        watched = {user_id for ids, _ in self._subscriptions.values()
+                   for user_id in ids}
+        known = {self._ids[email.lower()]
+                 for email in emails if email.lower() in self._ids}
+        wanted = sorted(known - watched)
+        for i in range(0, len(wanted), self.MAX_IDS):
+            await self._subscribe(wanted[i:i + self.MAX_IDS])
+
+    async def _subscribe(self, ids: List[str]):
+        """Subscribes to a group of contacts and fetches their current statuses
+
+        Args:
+            ids (List[str]): object ids of the contacts
+        """
+        expiration = self._clock() + self.lifetime
+        quoted = ",".join(f"'{i}'" for i in ids)
+        resource = f"/communications/presences?$filter=id in ({quoted})"
+        subscription = await self.client.create_subscription(
+            resource, self.notification_url, self.client_state, self._utc(expiration))
+        # tracked first, so the notifications arriving while the statuses are fetched aren't rejected
+        self._track(subscription["id"], ids, expiration)
+        self.statuses.update(await self.client.get_presences_by_ids(ids))
+        self.stats["subscribed"] += 1
+
+    def _track(self, subscription_id: str, ids: List[str], expires_at: float):
+        """Records a live subscription
+
+        Args:
+            subscription_id (str): id of the subscription
+            ids (List[str]): object ids of the contacts it watches
+            expires_at (float): unix time at which it expires
+        """
+        self._subscriptions[subscription_id] = (ids, expires_at)
+        for user_id in ids:
+            self._covered_until[user_id] = expires_at
+
+    def _forget(self, subscription_id: str):
+        """Stops serving the statuses of a subscription which is no longer alive
+
+        Args:
+            subscription_id (str): id of the subscription
+        """
+        ids, _ = self._subscriptions.pop(subscription_id)
+        for user_id in ids:
+            self._covered_until.pop(user_id, None)
+
+    async def _refresh_changed(self):
+        """Fetches the statuses of the contacts changed within the refresh window in a single call"""
+        await asyncio.sleep(self.refresh_window)
+        changed, self._changed = list(self._changed), set()
+        try:
+            fetched = await self.client.get_presences_by_ids(changed)
+        except Exception as error:
+            self.stats["failures"] += 1
+            print(
+                f"\n [PresenceSubscriptions] status refresh failed: {error}", file=sys.stderr)
+            return
+        self.statuses.update(fetched)
+        self.stats["fetched"] += len(fetched)
+
+    async def _run(self):
+        """Keeps the subscriptions alive, retrying in a minute if Graph fails"""
+        while True:
+            try:
+                await self.sync()
+                expiries = [expires_at
+                            for _, expires_at in self._subscriptions.values()]
+                if expiries:
+                    delay = min(expiries) - self.renew_margin - self._clock()
+                else:
+                    delay = self.lifetime
+            except Exception as error:
+                self.stats["failures"] += 1
+                print(
+                    f"\n [PresenceSubscriptions] subscription sync failed: {error}", file=sys.stderr)
+                delay = 60
+            await asyncio.sleep(max(delay, 1))
+
+    @staticmethod
+    def _utc(moment: float) -> datetime:
+        """Converts unix time to a UTC datetime
+
+        Args:
+            moment (float): unix time
+
+        Returns:
+            datetime: UTC datetime
+        """
+        return datetime.fromtimestamp(moment, timezone.utc)
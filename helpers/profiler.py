@@ -0,0 +1,347 @@
+import asyncio
+import contextvars
+import cProfile
+import hashlib
+import heapq
+import hmac
+import itertools
+import marshal
+import os
+import random
+import time
+from typing import List, NamedTuple
+
+from aiohttp.web import Request, Response, json_response
+
+from helpers.tracing import TRACER
+
+
+class TurnProfile(NamedTuple):
+    """Python-level profile of a single turn
+
+    Attributes:
+        id(str): id to download the profile by
+        started_at(float): unix time at which the turn started
+        duration(float): seconds the turn took
+        profiled_from(float): seconds after the start at which profiling began, 0 for the sampled turns
+        reason(str): "sampled" or "slow"
+        metadata(dict): activity type, anonymised user and conversation, trace id, dialog steps run
+            and concurrent turns
+        stats(dict): cProfile stats in the pstats format
+    """
+    id: str
+    started_at: float
+    duration: float
+    profiled_from: float
+    reason: str
+    metadata: dict
+    stats: dict
+
+
+_turn = contextvars.ContextVar("profiled_turn", default=None)
+
+
+def note_step(dialog: str, step: str):
+    """Records a waterfall step run within the current turn, so the profile shows which dialog was slow
+
+    Args:
+        dialog (str): dialog class, i.e. "PersonDialog"
+        step (str): step method, i.e. "choice_step"
+    """
+    scope = _turn.get()
+    if scope is not None and len(scope.steps) < 50:
+        scope.steps.append(f"{dialog}.{step}")
+
+
+class _TurnScope:
+    """Context manager around a single turn, profiling it if it's sampled or once it's slow"""
+
+    def __init__(self, profiler: "TurnProfiler", metadata: dict, sampled: bool):
+        self.profiler = profiler
+        self.metadata = metadata
+        self.sampled = sampled
+        self.steps = []
+        self.profile = None
+        self.profiled_from = 0.0
+        self._handle = None
+        self._token = None
+        self._started_at = time.time()
+        self._started = time.perf_counter()
+
+    def __enter__(self) -> "_TurnScope":
+        self._token = _turn.set(self)
+        self.profiler._in_flight += 1
+        if self.sampled:
+            self.profiler._start(self)
+        elif self.profiler.slow_threshold > 0:
+            # nothing is profiled unless the turn is still running once it's slow
+            self._handle = asyncio.get_running_loop().call_later(
+                self.profiler.slow_threshold, self.profiler._start, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _turn.reset(self._token)
+        self.profiler._in_flight -= 1
+        if self._handle is not None:
+            self._handle.cancel()
+        self.profiler._finish(self, time.perf_counter() - self._started)
+
+
+class TurnProfiler:
+    """Profiles a share of the turns from their start and the slow ones from the moment they cross
+    the latency threshold, so fast turns cost only a timer. cProfile can only watch one turn at a time and,
+    as all the turns share the event loop thread, a profile includes whatever else ran meanwhile;
+    the number of concurrent turns is recorded with it. The keep slowest profiles are retained and can be
+    downloaded through the admin routes as pstats files (snakeviz, flameprof, gprof2dot) or folded stacks
+    (flamegraph.pl, speedscope).
+
+    Attributes:
+        sample_rate(float): share of the turns profiled from their start
+        slow_threshold(float): seconds after which a running turn gets profiled, 0 disables it
+        keep(int): number of the slowest profiles retained, 0 disables the profiling
+        admin_token(str): bearer token of the admin routes, they answer 403 without one
+        stats(dict): turns/profiled/kept/skipped counters
+    """
+
+    def __init__(self, sample_rate: float = 0.0, slow_threshold: float = 0.0, keep: int = 20,
+                 admin_token: str = "", salt: bytes = None):
+        """inits the TurnProfiler instance
+
+        Args:
+            sample_rate (float, optional): share of the turns profiled from their start. Defaults to 0.0.
+            slow_threshold (float, optional): seconds after which a running turn gets profiled. Defaults to 0.0.
+            keep (int, optional): number of the slowest profiles retained. Defaults to 20.
+            admin_token (str, optional): bearer token of the admin routes. Defaults to "".
+            salt (bytes, optional): salt of the user and conversation hashes. Defaults to a random one per process.
+        """
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.keep = keep
+        self.admin_token = admin_token
+        self.stats = {"turns": 0, "profiled": 0, "kept": 0, "skipped": 0}
+        self._salt = salt if salt is not None else os.urandom(16)
+        self._active = None
+        self._in_flight = 0
+        # min-heap of (duration, seq, TurnProfile), the fastest retained profile is replaced first
+        self._kept = []
+        self._seq = itertools.count(1)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any turn can get profiled"""
+        return self.keep > 0 and (self.sample_rate > 0 or self.slow_threshold > 0)
+
+    def turn(self, activity=None):
+        """Wraps the handling of an activity
+
+        Usage:
+            with profiler.turn(activity):
+                await adapter.process_activity(...)
+
+        Args:
+            activity (Activity, optional): incoming activity, its ids are stored anonymised. Defaults to None.
+
+        Returns:
+            context manager
+        """
+        self.stats["turns"] += 1
+        metadata = {}
+        if activity is not None:
+            metadata = {
+                "activity_type": activity.type,
+                "channel": activity.channel_id,
+                "user": self._anonymise(activity.from_property.id if activity.from_property else None),
+                "conversation": self._anonymise(activity.conversation.id if activity.conversation else None),
+            }
+        metadata["trace_id"] = TRACER.current_trace_id()
+        return _TurnScope(self, metadata, self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def profiles(self) -> List[TurnProfile]:
+        """Returns the retained profiles, the slowest first
+
+        Returns:
+            List[TurnProfile]: profiles
+        """
+        return [profile for _, _, profile in sorted(self._kept, reverse=True)]
+
+    def get(self, profile_id: str) -> TurnProfile:
+        """Returns a retained profile
+
+        Args:
+            profile_id (str): id of the profile
+
+        Returns:
+            TurnProfile: profile or None if it isn't retained
+        """
+        return next((profile for _, _, profile in self._kept if profile.id == profile_id), None)
+
+    @staticmethod
+    def pstats_bytes(profile: TurnProfile) -> bytes:
+        """Serializes a profile the way pstats.Stats.dump_stats does, so pstats.Stats(path) loads it
+
+        Args:
+            profile (TurnProfile): profile
+
+        Returns:
+            bytes: content of a .pstats file
+        """
+        return marshal.dumps(profile.stats)
+
+    @staticmethod
+    def folded(profile: TurnProfile, min_share: float = 0.001) -> str:
+        """Converts a profile to folded stacks with the self time in microseconds. cProfile only keeps
+        caller-callee pairs, so the time of a function called from several places is split between
+        the paths in proportion to the time of the calls made along each of them
+
+        Args:
+            profile (TurnProfile): profile
+            min_share (float, optional): paths taking a smaller share of the total time are left out.
+            Defaults to 0.001.
+
+        Returns:
+            str: one "frame;frame;frame microseconds" line per path
+        """
+        stats = profile.stats
+        callees = {}
+        for func, (_, _, _, _, callers) in stats.items():
+            for caller, edge in callers.items():
+                callees.setdefault(caller, []).append((func, edge[3]))
+        roots = [func for func, value in stats.items() if not value[4]]
+        total = sum(stats[func][3] for func in roots) or 1.0
+        lines = {}
+
+        def name(func: tuple) -> str:
+            filename, line, function = func
+            return f"{function} ({os.path.basename(filename)}:{line})" if line else function
+
+        def walk(func: tuple, path: List[tuple], share: float):
+            self_time = stats[func][2] * share
+            frames = path + [func]
+            if self_time / total >= min_share:
+                key = ";".join(name(frame) for frame in frames)
+                lines[key] = lines.get(key, 0.0) + self_time
+            for callee, edge_time in callees.get(func, []):
+                callee_time = stats[callee][3]
+                if callee in frames or not callee_time:
+                    continue
+                callee_share = min(edge_time * share / callee_time, 1.0)
+                if callee_time * callee_share / total >= min_share and len(frames) < 100:
+                    walk(callee, frames, callee_share)
+
+        for root in roots:
+            walk(root, [], 1.0)
+        return "".join(f"{key} {int(value * 1e6)}\n" for key, value in lines.items() if value >= 1e-6)
+
+    async def list_handler(self, req: Request) -> Response:
+        """aiohttp handler listing the retained profiles without their stats
+
+        Args:
+            req (Request): request carrying the admin bearer token
+
+        Returns:
+            Response: json list, the slowest first, or 403
+        """
+        if not self._authorized(req):
+            return Response(status=403)
+        return json_response([
+            dict(profile._asdict(), stats=None, files=[f"{profile.id}.pstats", f"{profile.id}.folded"])
+            for profile in self.profiles()])
+
+    async def download_handler(self, req: Request) -> Response:
+        """aiohttp handler downloading a retained profile as {id}.pstats or {id}.folded
+
+        Args:
+            req (Request): request carrying the admin bearer token and the file name in the name match
+
+        Returns:
+            Response: file, 404 for an unknown one or 403
+        """
+        if not self._authorized(req):
+            return Response(status=403)
+        profile_id, _, extension = req.match_info["name"].rpartition(".")
+        profile = self.get(profile_id)
+        if profile is None or extension not in ("pstats", "folded"):
+            return Response(status=404)
+        disposition = {"Content-Disposition": f'attachment; filename="turn-{req.match_info["name"]}"'}
+        if extension == "pstats":
+            return Response(body=self.pstats_bytes(profile), content_type="application/octet-stream",
+                            headers=disposition)
+        return Response(text=self.folded(profile), content_type="text/plain", headers=disposition)
+
+    def _authorized(self, req: Request) -> bool:
+        """Checks the admin bearer token
+
+        Args:
+            req (Request): incoming request
+
+        Returns:
+            bool: True if an admin token is configured and the request carries it
+        """
+        supplied = req.headers.get("Authorization", "")
+        return bool(self.admin_token) and hmac.compare_digest(supplied, "Bearer " + self.admin_token)
+
+    def _start(self, scope: _TurnScope):
+        """Starts profiling a turn unless another one is being profiled
+
+        Args:
+            scope (_TurnScope): turn to profile
+        """
+        if self.keep <= 0:
+            return
+        if self._active is not None:
+            self.stats["skipped"] += 1
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler, i.e. a debugger, is attached to the thread
+            self.stats["skipped"] += 1
+            return
+        self._active = scope
+        scope.profile = profile
+        scope.profiled_from = time.perf_counter() - scope._started
+        scope.metadata["concurrent_turns"] = self._in_flight
+
+    def _finish(self, scope: _TurnScope, duration: float):
+        """Stops profiling a turn and retains the profile if it's among the slowest ones
+
+        Args:
+            scope (_TurnScope): ended turn
+            duration (float): seconds the turn took
+        """
+        if scope.profile is None:
+            return
+        scope.profile.disable()
+        self._active = None
+        self.stats["profiled"] += 1
+        slow = self.slow_threshold > 0 and duration >= self.slow_threshold
+        if len(self._kept) >= self.keep and (not self._kept or duration <= self._kept[0][0]):
+            return
+        scope.profile.create_stats()
+        seq = next(self._seq)
+        profile = TurnProfile(
+            f"{int(scope._started_at)}-{seq}", scope._started_at, duration, scope.profiled_from,
+            "slow" if slow else "sampled", dict(scope.metadata, steps=scope.steps), scope.profile.stats)
+        self.stats["kept"] += 1
+        if len(self._kept) < self.keep:
+            heapq.heappush(self._kept, (duration, seq, profile))
+        else:
+            heapq.heapreplace(self._kept, (duration, seq, profile))
+
+    def _anonymise(self, value: str) -> str:
+        """Hashes an id with the salt of the process
+
+        Args:
+            value (str): user or conversation id
+
+        Returns:
+            str: 12 hex digits or None
+        """
+        if not value:
+            return None
+        return hashlib.sha256(self._salt + value.encode("utf-8")).hexdigest()[:12]
+
+
+# disabled until the app sets a sample rate or a slow threshold
+PROFILER = TurnProfiler()
@@ -0,0 +1,202 @@
+import asyncio
+import sys
+import time
+from datetime import datetime, time as day_time
+from typing import Callable, NamedTuple
+from zoneinfo import ZoneInfo
+
+from helpers.executors import run_io
+
+
+class QuoteSnapshot(NamedTuple):
+    """Immutable snapshot of a stock quote
+
+    Attributes:
+        day(str): trading day the quote belongs to, formatted like "January 31 2020"
+        price(float): close price or the open price if the market hasn't closed yet
+        open(float): open price
+        high(float): max price inside a day
+        low(float): min price inside a day
+        change(float): diff to the previous close price
+        change_percent(float): diff to the previous close price in percent
+        fetched_at(float): unix time the snapshot was fetched at
+    """
+    day: str
+    price: float
+    open: float
+    high: float
+    low: float
+    change: float
+    change_percent: float
+    fetched_at: float
+
+
+class YahooQuoteSource:
+    """Quote source pulling the data from the Yahoo Finance API
+
+    Attributes:
+        ticker(str): ticker symbol, i.e. "TIK1V.HE"
+    """
+
+    def __init__(self, ticker: str = "TIK1V.HE"):
+        """inits the YahooQuoteSource instance
+
+        Args:
+            ticker (str, optional): ticker symbol. Defaults to "TIK1V.HE".
+        """
+        self.ticker = ticker
+
+    async def fetch(self) -> QuoteSnapshot:
+        """Fetches the latest quote. yfinance is blocking, hence the call is run in the shared I/O pool
+
+        Returns:
+            QuoteSnapshot: latest quote
+        """
+        return await run_io(self._fetch_blocking)
+
+    def _fetch_blocking(self) -> QuoteSnapshot:
+        """Pulls the last two days of history and computes the snapshot
+
+        Returns:
+            QuoteSnapshot: latest quote
+        """
+        import yfinance as yf
+
+        res = yf.Ticker(self.ticker).history(period='2d')
+
+        open_price = res.tail(1)['Open'][0]
+        high_price = res.tail(1)['High'][0]
+        low_price = res.tail(1)['Low'][0]
+        # if we already have a closing price - use it, otherwise take an open
+        # price
+        actual_price = res.tail(1)['Close'][0] if res.tail(
+            1)['Close'][0] > 0 else res.tail(1)['Open'][0]
+
+        day = res.tail(1).index[0]
+        day = day.to_pydatetime()
+        day = day.date().strftime("%B %d %Y")
+
+        diff_open = res.diff()['Close'][1] if res.diff()[
+            'Close'][1] != 0 else res.diff()['Open'][1]
+        diff_open = round(float(diff_open), 2)
+        diff_percent = round((diff_open / actual_price) * 100, 2)
+
+        return QuoteSnapshot(
+            day, float(actual_price), float(open_price), float(high_price), float(low_price),
+            diff_open, float(diff_percent), time.time())
+
+
+class QuoteService:
+    """Refreshes a stock quote in the background and keeps the latest snapshot,
+    so dialogs can render it without waiting for the upstream.
+    Quotes are refreshed often while the exchange is open and rarely otherwise.
+
+    Attributes:
+        source: any object with an async fetch method returning a QuoteSnapshot
+        open_interval(float): seconds between refreshes while the market is open
+        closed_interval(float): seconds between refreshes while the market is closed
+        snapshot(QuoteSnapshot): latest snapshot or None if nothing has been fetched yet
+    """
+
+    MARKET_TZ = ZoneInfo("Europe/Helsinki")
+    MARKET_OPEN = day_time(10, 0)
+    MARKET_CLOSE = day_time(18, 30)
+
+    def __init__(
+            self,
+            source,
+            open_interval: float = 60,
+            closed_interval: float = 1800,
+            clock: Callable[[], float] = time.time):
+        """inits the QuoteService instance
+
+        Args:
+            source: any object with an async fetch method returning a QuoteSnapshot
+            open_interval (float, optional): seconds between refreshes while the market is open. Defaults to 60.
+            closed_interval (float, optional): seconds between refreshes while the market is closed. Defaults to 1800.
+            clock (Callable[[], float], optional): unix time source. Defaults to time.time.
+        """
+        self.source = source
+        self.open_interval = open_interval
+        self.closed_interval = closed_interval
+        self.snapshot = None
+        self._clock = clock
+        self._task = None
+        self._inflight = None
+
+    def market_open(self, now: float = None) -> bool:
+        """Tells whether the exchange is open at the given moment
+
+        Args:
+            now (float, optional): unix time. Defaults to the current time.
+
+        Returns:
+            bool: True on weekdays between the opening and closing time of the exchange
+        """
+        moment = datetime.fromtimestamp(self._clock() if now is None else now, self.MARKET_TZ)
+        return moment.weekday() < 5 and self.MARKET_OPEN <= moment.time() <= self.MARKET_CLOSE
+
+    def interval(self) -> float:
+        """Returns the current refresh interval
+
+        Returns:
+            float: seconds until the next refresh
+        """
+        return self.open_interval if self.market_open() else self.closed_interval
+
+    def is_stale(self, snapshot: QuoteSnapshot) -> bool:
+        """Tells whether the snapshot has missed at least one scheduled refresh
+
+        Args:
+            snapshot (QuoteSnapshot): snapshot to check
+
+        Returns:
+            bool: True if the snapshot is older than two refresh intervals
+        """
+        return self._clock() - snapshot.fetched_at > 2 * self.interval()
+
+    def start(self):
+        """Starts the background refresh loop if it isn't running yet"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops the background refresh loop"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def latest(self) -> QuoteSnapshot:
+        """Returns the latest snapshot. Only waits for the upstream if nothing has been fetched yet
+
+        Returns:
+            QuoteSnapshot: latest snapshot
+        """
+        self.start()
+        if self.snapshot is None:
+            await self.refresh()
+        return self.snapshot
+
+    async def refresh(self):
+        """Fetches a new snapshot and publishes it. Concurrent calls share a single fetch"""
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._fetch())
+        await asyncio.shield(self._inflight)
+
+    async def _fetch(self):
+        """Fetches a new snapshot from the source and publishes it"""
+        self.snapshot = await self.source.fetch()
+
+    async def _run(self):
+        """Refreshes the snapshot on schedule, keeping the previous one if the upstream fails"""
+        while True:
+            if self.snapshot is None or self._clock() - self.snapshot.fetched_at >= self.interval():
+                try:
+                    await self.refresh()
+                except Exception as error:
+                    print(f"\n [QuoteService] refresh failed: {error}", file=sys.stderr)
+            await asyncio.sleep(self.interval())
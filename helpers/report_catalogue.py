@@ -0,0 +1,256 @@
+import asyncio
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+
+class ReportFile(NamedTuple):
+    """A single report file of a ChemCourier channel folder
+
+    Attributes:
+        item_id(str): id of the driveItem
+        name(str): file name, i.e. "Deco2019Q4.pdf"
+        period(str): period the report covers, i.e. "2019Q4", or the bare file name if it doesn't follow the pattern
+        latest(bool): value of the "Latest" column of the document library
+        download_url(str): pre-authenticated download link
+        url_fetched_at(float): unix time at which the download link was received
+    """
+    item_id: str
+    name: str
+    period: str
+    latest: bool
+    download_url: str
+    url_fetched_at: float
+
+
+class ReportCatalogue:
+    """Local index of the ChemCourier report folders of a drive, keyed by channel and period.
+    Every channel folder is listed once, when it's first asked for. After that the index is kept current
+    with Graph delta queries on the drive, so only the items changed since the previous sync are fetched,
+    and looking up the latest report or the links of the requested ones takes no Graph calls at all.
+    More details on delta queries are available here - https://docs.microsoft.com/en-us/graph/api/driveitem-delta
+
+    Attributes:
+        client(GraphClient): client used for all the Graph calls
+        site_id(str): Sharepoint site where the report folders reside
+        drive_id(str): drive containing the report folders
+        sync_interval(float): seconds between delta syncs
+        link_ttl(float): seconds after which a download link is fetched again. Graph links expire in about an hour
+        files(Dict[str, Dict[str, ReportFile]]): report files keyed by the channel and the period
+        delta_link(str): cursor of the next delta query or None before the first channel is loaded
+        synced_at(float): unix time of the last successful sync
+    """
+
+    def __init__(
+            self,
+            client,
+            site_id: str,
+            drive_id: str,
+            sync_interval: float = 300,
+            link_ttl: float = 1800,
+            clock: Callable[[], float] = time.time):
+        """inits the ReportCatalogue instance. No network calls are made here.
+
+        Args:
+            client (GraphClient): client used for all the Graph calls
+            site_id (str): Sharepoint site where the report folders reside
+            drive_id (str): drive containing the report folders
+            sync_interval (float, optional): seconds between delta syncs. Defaults to 300.
+            link_ttl (float, optional): seconds after which a download link is fetched again. Defaults to 1800.
+            clock (Callable[[], float], optional): unix time source. Defaults to time.time.
+        """
+        self.client = client
+        self.site_id = site_id
+        self.drive_id = drive_id
+        self.sync_interval = sync_interval
+        self.link_ttl = link_ttl
+        self.files = {}
+        self.delta_link = None
+        self.synced_at = 0.0
+        self._clock = clock
+        # channel of every folder being tracked keyed by the folder id, and the location of every file
+        self._folders = {}
+        self._locations = {}
+        self._inflight = {}
+        self._task = None
+
+    async def latest(self, channel: str) -> str:
+        """Returns the name of the report marked as the latest one in the channel folder
+
+        Args:
+            channel (str): name of the channel folder, i.e. "Deco"
+
+        Returns:
+            str: file name of the latest report. The one of the latest period if none is marked, None if the folder is empty
+        """
+        await self.load([channel])
+        files = self.files[channel].values()
+        marked = [file for file in files if file.latest]
+        if marked:
+            return marked[0].name
+        return max(files, key=lambda file: file.period).name if files else None
+
+    async def links(self, channel: str, names: List[str]) -> Dict[str, str]:
+        """Returns the download links of the requested reports. Only the links about to expire are fetched again
+
+        Args:
+            channel (str): name of the channel folder, i.e. "Deco"
+            names (List[str]): file names, i.e. ["Deco2019Q3.pdf", "Deco2019Q4.pdf"]
+
+        Returns:
+            Dict[str, str]: download links keyed by the file name, reports missing from the folder are left out
+        """
+        await self.load([channel])
+        found = [
+            file for file in (self.files[channel].get(self._period(channel, name)) for name in names)
+            if file is not None and file.name in names]
+        expired = [file.item_id for file in found if self._clock() - file.url_fetched_at > self.link_ttl]
+        if expired:
+            for item in await self.client.get_drive_items(self.site_id, self.drive_id, expired):
+                self._index(channel, item)
+            found = [self.files[channel].get(file.period, file) for file in found]
+        return {file.name: file.download_url for file in found}
+
+    async def load(self, channels: List[str]):
+        """Lists the channel folders which aren't tracked yet. Concurrent callers share the listing of a folder
+
+        Args:
+            channels (List[str]): names of the channel folders
+        """
+        self.start()
+        await asyncio.gather(*[
+            self._shared(("channel", channel), lambda channel=channel: self._load_channel(channel))
+            for channel in channels if channel not in self.files])
+
+    async def sync(self):
+        """Applies the changes made to the drive since the previous sync. Concurrent calls share a single sync"""
+        await self._shared(("sync",), self._sync)
+
+    def start(self):
+        """Starts the background sync loop if it isn't running yet"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops the background sync loop"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _shared(self, key: tuple, factory: Callable):
+        """Runs the coroutine made by the factory unless the one with the same key is already running
+
+        Args:
+            key (tuple): identifies the work
+            factory (Callable): makes the coroutine doing the work
+
+        Returns:
+            result of the coroutine
+        """
+        task = self._inflight.get(key)
+        if task is None or task.done():
+            task = self._inflight[key] = asyncio.ensure_future(factory())
+        return await asyncio.shield(task)
+
+    async def _run(self):
+        """Syncs the index on schedule, keeping the current one if Graph fails"""
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception as error:
+                print(f"\n [ReportCatalogue] sync failed: {error}", file=sys.stderr)
+
+    async def _load_channel(self, channel: str):
+        """Lists a channel folder and starts tracking it
+
+        Args:
+            channel (str): name of the channel folder
+        """
+        # the cursor is taken before the listing, so nothing changed in between can be missed
+        await self._shared(("cursor",), self._start_cursor)
+        folder = await self.client.get_item_meta(self.site_id, self.drive_id, channel)
+        items = await self.client.get_folder_items(self.site_id, self.drive_id, channel)
+        self.files[channel] = {}
+        self._folders[folder["id"]] = channel
+        for item in items:
+            self._index(channel, item)
+
+    async def _start_cursor(self):
+        """Takes the delta cursor of the current state of the drive unless there is one already"""
+        if self.delta_link is None:
+            _, self.delta_link = await self.client.get_drive_delta(self.site_id, self.drive_id)
+            self.synced_at = self._clock()
+
+    async def _sync(self):
+        """Fetches the changes since the previous sync and applies those made to the tracked folders"""
+        if self.delta_link is None:
+            return
+        changes, delta_link = await self.client.get_drive_delta(self.site_id, self.drive_id, self.delta_link)
+        if delta_link is None:
+            # the cursor has expired, the tracked folders are listed anew
+            channels = list(self.files)
+            self.files, self._folders, self._locations, self.delta_link = {}, {}, {}, None
+            await self.load(channels)
+            return
+        refetch = []
+        for item in changes:
+            if "deleted" in item or item.get("parentReference", {}).get("id") not in self._folders:
+                # deleted or moved out of the tracked folders
+                self._forget(item["id"])
+            elif "file" in item:
+                refetch.append(item["id"])
+        # delta doesn't return the list item columns nor the download links, the changed files are fetched for them
+        if refetch:
+            for item in await self.client.get_drive_items(self.site_id, self.drive_id, refetch):
+                channel = self._folders.get(item.get("parentReference", {}).get("id"))
+                if channel is not None:
+                    self._forget(item["id"])
+                    self._index(channel, item)
+        self.delta_link = delta_link
+        self.synced_at = self._clock()
+
+    def _index(self, channel: str, item: dict):
+        """Adds or replaces a report file in the index
+
+        Args:
+            channel (str): name of the channel folder containing the file
+            item (dict): driveItem with the expanded listItem fields
+        """
+        if "file" not in item:
+            return
+        fields = item.get("listItem", {}).get("fields", {})
+        period = self._period(channel, item["name"])
+        self.files[channel][period] = ReportFile(
+            item["id"], item["name"], period, bool(fields.get("Latest")),
+            item.get("@microsoft.graph.downloadUrl"), self._clock())
+        self._locations[item["id"]] = (channel, period)
+
+    def _forget(self, item_id: str):
+        """Removes a report file from the index if it's there
+
+        Args:
+            item_id (str): id of the driveItem
+        """
+        channel, period = self._locations.pop(item_id, (None, None))
+        file = self.files.get(channel, {}).get(period)
+        if file is not None and file.item_id == item_id:
+            del self.files[channel][period]
+
+    @staticmethod
+    def _period(channel: str, name: str) -> str:
+        """Extracts the period from a file name, i.e. "2019Q4" from "Deco2019Q4.pdf"
+
+        Args:
+            channel (str): name of the channel folder
+            name (str): file name
+
+        Returns:
+            str: period or the file name if it doesn't follow the {channel}{period}.pdf pattern
+        """
+        stem = name.rsplit(".", 1)[0]
+        return stem[len(channel):] if stem.startswith(channel) and len(stem) > len(channel) else name
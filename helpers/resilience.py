@@ -0,0 +1,355 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit of its endpoint is open"""
+
+
+class TokenBucket:
+    """Client-side rate limiter. Callers are let through in arrival order at the configured rate,
+    with bursts of up to the bucket size. The bucket can also be paused, i.e. for the Retry-After period
+    of a throttled response, so no caller hits the throttled service before it's ready again.
+
+    Attributes:
+        rate (float): requests per second, 0 disables the limiter
+        burst (float): max number of requests let through at once
+        tokens (float): requests which can be made right now
+    """
+
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic):
+        """inits the TokenBucket instance
+
+        Args:
+            rate (float): requests per second, 0 disables the limiter
+            burst (float): max number of requests let through at once
+            clock (Callable[[], float], optional): monotonic time source. Defaults to time.monotonic.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self._clock = clock
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Lets no request through for the given time
+
+        Args:
+            seconds (float): pause duration
+        """
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    async def acquire(self, cost: float = 1) -> float:
+        """Waits until the request may be made
+
+        Args:
+            cost (float, optional): number of requests, i.e. the size of a $batch call. Defaults to 1.
+
+        Returns:
+            float: seconds waited
+        """
+        if self.rate <= 0 and self._paused_until <= self._clock():
+            return 0.0
+        started = self._clock()
+        # the lock queues the callers, so they are let through in arrival order
+        async with self._lock:
+            cost = min(cost, self.burst)
+            while True:
+                now = self._clock()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self.rate <= 0:
+                    break
+                self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    break
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+        return self._clock() - started
+
+
+class CircuitBreaker:
+    """Stops calling an endpoint which keeps failing and lets a single probe call through once in a while.
+    After failure_threshold failures in a row the circuit opens and calls are rejected. Once reset_timeout
+    has passed a probe is let through: its success closes the circuit, its failure opens it again.
+
+    Attributes:
+        failure_threshold (int): failures in a row which open the circuit
+        reset_timeout (float): seconds after which an open circuit lets a probe through
+        failures (int): failures in a row so far
+        opened_at (float): time at which the circuit was last opened
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30, clock: Callable[[], float] = time.monotonic):
+        """inits the CircuitBreaker instance
+
+        Args:
+            failure_threshold (int, optional): failures in a row which open the circuit. Defaults to 5.
+            reset_timeout (float, optional): seconds after which an open circuit lets a probe through. Defaults to 30.
+            clock (Callable[[], float], optional): monotonic time source. Defaults to time.monotonic.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._clock = clock
+        self._state = self.CLOSED
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        """Current state: closed, open or half_open"""
+        if self._state == self.OPEN and self._clock() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """Tells whether a call may be made now. In the half-open state only a single probe is allowed
+
+        Returns:
+            bool: True if the call may be made
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release(self):
+        """Gives the probe up without an outcome, i.e. when its call is cancelled, so the next call can probe"""
+        self._probing = False
+
+    def record_success(self):
+        """Closes the circuit"""
+        self.failures = 0
+        self._probing = False
+        self._state = self.CLOSED
+
+    def record_failure(self) -> bool:
+        """Counts a failure, opening the circuit if there have been too many of them or the probe has failed
+
+        Returns:
+            bool: True if the circuit has just been opened
+        """
+        self.failures += 1
+        probe_failed = self._probing
+        self._probing = False
+        if probe_failed or (self._state == self.CLOSED and self.failures >= self.failure_threshold):
+            self._state = self.OPEN
+            self.opened_at = self._clock()
+            return True
+        return False
+
+
+class Resilience:
+    """Retries, circuit breaking and rate limiting for the calls to a throttled HTTP service.
+    Throttled (429) calls are retried after the Retry-After period, which also pauses the rate limiter.
+    Calls failing with 502, 503 or 504 are retried with jittered exponential backoff if they are idempotent
+    or the service has sent a Retry-After header. Every endpoint has a circuit breaker counting 5xx failures.
+    Responses are any objects with the status_code and headers attributes.
+
+    Attributes:
+        RETRY_STATUSES (set): statuses of the failures which may go away on their own
+        max_retries (int): max number of retries after the first attempt
+        base_delay (float): backoff before the first retry in seconds, doubled for every next one
+        max_delay (float): max seconds to wait before a retry. Calls asked to wait longer aren't retried
+        limiter (TokenBucket): client-side rate limiter shared by all the endpoints
+        breakers (dict): circuit breakers keyed by the endpoint
+        stats (dict): requests/retries/throttled/failures/short_circuited/circuits_opened counters
+        and the total seconds spent waiting for the rate limiter and for the retries
+    """
+
+    RETRY_STATUSES = {429, 502, 503, 504}
+
+    def __init__(
+            self,
+            max_retries: int = 3,
+            base_delay: float = 0.5,
+            max_delay: float = 10,
+            rate: float = 0,
+            burst: float = 1,
+            failure_threshold: int = 5,
+            reset_timeout: float = 30,
+            clock: Callable[[], float] = time.monotonic):
+        """inits the Resilience instance
+
+        Args:
+            max_retries (int, optional): max number of retries after the first attempt. Defaults to 3.
+            base_delay (float, optional): backoff before the first retry in seconds. Defaults to 0.5.
+            max_delay (float, optional): max seconds to wait before a retry. Defaults to 10.
+            rate (float, optional): requests per second, 0 disables the limiter. Defaults to 0.
+            burst (float, optional): max number of requests let through at once. Defaults to 1.
+            failure_threshold (int, optional): failures in a row which open a circuit. Defaults to 5.
+            reset_timeout (float, optional): seconds after which an open circuit lets a probe through. Defaults to 30.
+            clock (Callable[[], float], optional): monotonic time source. Defaults to time.monotonic.
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = TokenBucket(rate, burst, clock)
+        self.breakers = {}
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "failures": 0,
+            "short_circuited": 0,
+            "circuits_opened": 0,
+            "rate_limit_wait_seconds": 0.0,
+            "retry_wait_seconds": 0.0,
+        }
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        """Returns the circuit breaker of an endpoint, creating it on first use
+
+        Args:
+            endpoint (str): endpoint key, i.e. "GET /users/{id}/presence"
+
+        Returns:
+            CircuitBreaker: breaker of the endpoint
+        """
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(self._failure_threshold, self._reset_timeout, self._clock)
+        return self.breakers[endpoint]
+
+    def report(self) -> dict:
+        """Returns the counters and the endpoints whose circuits aren't closed
+
+        Returns:
+            dict: counters and {endpoint: state} of the open and half-open circuits
+        """
+        circuits = {endpoint: breaker.state for endpoint, breaker in self.breakers.items()}
+        return dict(self.stats, circuits={
+            endpoint: state for endpoint, state in circuits.items() if state != CircuitBreaker.CLOSED})
+
+    def retry_after(self, response) -> float:
+        """Reads the Retry-After header of a response
+
+        Args:
+            response: response with the headers attribute
+
+        Returns:
+            float: seconds to wait or None if the header is missing or malformed
+        """
+        value = next((v for k, v in response.headers.items() if k.lower() == "retry-after"), None)
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def should_retry(self, response, idempotent: bool) -> bool:
+        """Tells whether a failed call is worth retrying
+
+        Args:
+            response: response with the status_code and headers attributes
+            idempotent (bool): whether repeating the call can't do any harm
+
+        Returns:
+            bool: True for throttled calls and for the failures of idempotent ones or those with a Retry-After header,
+            unless the service asks to wait longer than max_delay
+        """
+        if response.status_code not in self.RETRY_STATUSES:
+            return False
+        retry_after = self.retry_after(response)
+        if retry_after is not None and retry_after > self.max_delay:
+            return False
+        return response.status_code == 429 or idempotent or retry_after is not None
+
+    def delay(self, attempt: int, response) -> float:
+        """Returns the time to wait before the next attempt: the Retry-After period if the service has set it,
+        jittered exponential backoff otherwise
+
+        Args:
+            attempt (int): number of the failed attempt, starting from 0
+            response: failed response
+
+        Returns:
+            float: seconds to wait
+        """
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            # a bit of jitter, so the callers throttled together don't all come back at the same moment
+            return min(retry_after * random.uniform(1, 1.2), self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def throttled(self, response):
+        """Counts a throttled response and pauses the rate limiter for its Retry-After period
+
+        Args:
+            response: response with the 429 status code
+        """
+        self.stats["throttled"] += 1
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            self.limiter.pause(min(retry_after, self.max_delay))
+
+    async def call(self, endpoint: str, send: Callable[[], Awaitable], idempotent: bool = True, cost: float = 1):
+        """Makes a call, retrying it if it fails with a transient error
+
+        Args:
+            endpoint (str): endpoint key the circuit breaker is chosen by
+            send (Callable[[], Awaitable]): makes a single attempt and returns the response
+            idempotent (bool, optional): whether repeating the call can't do any harm. Defaults to True.
+            cost (float, optional): number of requests the call counts as for the rate limiter. Defaults to 1.
+
+        Raises:
+            CircuitOpenError: raised if the circuit of the endpoint is open
+
+        Returns:
+            response of the last attempt
+        """
+        breaker = self.breaker(endpoint)
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                self.stats["short_circuited"] += 1
+                raise CircuitOpenError(f"Circuit of {endpoint} is open")
+            try:
+                self.stats["rate_limit_wait_seconds"] += await self.limiter.acquire(cost)
+                self.stats["requests"] += 1
+                response = await send()
+            except Exception:
+                # an attempt without a response counts as a failure, so a failed probe opens the circuit again
+                self.stats["failures"] += 1
+                if breaker.record_failure():
+                    self.stats["circuits_opened"] += 1
+                raise
+            except BaseException:
+                # a cancelled attempt says nothing about the endpoint, but mustn't keep the probe forever
+                breaker.release()
+                raise
+            if response.status_code >= 500:
+                self.stats["failures"] += 1
+                if breaker.record_failure():
+                    self.stats["circuits_opened"] += 1
+            else:
+                breaker.record_success()
+            if response.status_code == 429:
+                self.throttled(response)
+            if attempt == self.max_retries or not self.should_retry(response, idempotent):
+                return response
+            delay = self.delay(attempt, response)
+            self.stats["retries"] += 1
+            self.stats["retry_wait_seconds"] += delay
+            await asyncio.sleep(delay)
@@ -0,0 +1,475 @@
+import asyncio
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+import jsonpickle
+from botbuilder.core import Storage
+
+from helpers.executors import run_io
+
+# property name under which store items other than dicts are kept whole
+ITEM = ""
+
+
+class SqliteStorage(Storage):
+    """Durable botbuilder Storage backed by a local SQLite database.
+
+    The turn never waits for the disk: writes are checked and applied to an in-memory copy right away
+    and flushed to the database in the background, so all the save_changes calls arriving within
+    flush_interval seconds end up in a single transaction. Reads are served from the in-memory copy,
+    falling back to the database for the keys which aren't there.
+    Items are versioned with eTags: writing an item whose eTag doesn't match the stored one raises a KeyError,
+    like MemoryStorage does, unless the eTag is "*" or missing.
+    The database is compacted periodically, dropping items neither read nor written for retention_days.
+    Uses which write nothing are recorded as a cheap update of the access time, at most once per TOUCH_INTERVAL.
+
+    Attributes:
+        path(str): database file
+        flush_interval(float): seconds the writes are collected for before being flushed
+        compact_interval(float): seconds between compactions
+        retention_days(float): items not used for that many days are dropped on compaction, 0 keeps them forever
+        max_entries(int): max number of flushed items kept in memory
+        stats(dict): reads/misses/writes/skipped/properties_written/touched/flushes/flushed_items/conflicts counters
+    """
+
+    # seconds within which repeated uses of an item record its access time only once
+    TOUCH_INTERVAL = 3600
+
+    def __init__(
+            self,
+            path: str,
+            flush_interval: float = 0.05,
+            compact_interval: float = 3600,
+            retention_days: float = 0,
+            max_entries: int = 4096,
+            clock: Callable[[], float] = time.time):
+        """inits the SqliteStorage instance. The database is opened on first use
+
+        Args:
+            path (str): database file
+            flush_interval (float, optional): seconds the writes are collected for before being flushed.
+            Defaults to 0.05.
+            compact_interval (float, optional): seconds between compactions. Defaults to 3600.
+            retention_days (float, optional): items not used for that many days are dropped on compaction.
+            Defaults to 0, i.e. items are kept forever.
+            max_entries (int, optional): max number of flushed items kept in memory. Defaults to 4096.
+            clock (Callable[[], float], optional): unix time source. Defaults to time.time.
+        """
+        super().__init__()
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.retention_days = retention_days
+        self.max_entries = max_entries
+        self.stats = {"reads": 0, "misses": 0, "writes": 0, "flushes": 0, "flushed_items": 0, "conflicts": 0,
+                      "skipped": 0, "properties_written": 0, "touched": 0}
+        self._clock = clock
+        # key -> (e_tag, {property name: json}) of every known item, None marks a deleted one
+        self._memory = OrderedDict()
+        # key -> (e_tag, {property name: json or None if removed}, replace) or None for deleted items.
+        # Changes waiting for the next flush and the ones being flushed right now
+        self._pending = {}
+        self._flushing = {}
+        # key -> unix time of a use which wrote nothing, waiting for the next flush
+        self._touches = {}
+        # key -> unix time at which the access time was last recorded, for the items in memory
+        self._touched_at = {}
+        self._e_tag = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._failures = 0
+        self._flush_task = None
+        self._compact_task = None
+
+    async def read(self, keys: List[str]) -> Dict[str, object]:
+        """Loads store items
+
+        Args:
+            keys (List[str]): storage keys
+
+        Returns:
+            Dict[str, object]: fresh copies of the found items keyed by the storage key
+        """
+        if not keys:
+            return {}
+        self.stats["reads"] += 1
+        missing = [key for key in keys if key not in self._memory]
+        if missing:
+            self.stats["misses"] += 1
+            rows = await run_io(self._select, missing)
+            for key in missing:
+                # a write may have landed while the database was being queried, it's more recent
+                if key not in self._memory:
+                    self._remember(key, rows.get(key))
+        data = {}
+        for key in keys:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._touch(key)
+                data[key] = self._decode(entry)
+        return data
+
+    async def write(self, changes: Dict[str, object]):
+        """Saves store items. Returns once the changes are visible to reads, not once they're on disk.
+        Only the properties which have changed are serialized and written, an item none of whose
+        properties have changed isn't written at all and keeps its eTag
+
+        Args:
+            changes (Dict[str, object]): items keyed by the storage key
+
+        Raises:
+            Exception: raised if no changes are passed
+            KeyError: raised on an eTag conflict. None of the changes are applied then
+        """
+        if changes is None:
+            raise Exception("Changes are required when writing")
+        if not changes:
+            return
+        missing = [key for key in changes if key not in self._memory]
+        if missing:
+            await self.read(missing)
+        updates = {}
+        for key, change in changes.items():
+            if isinstance(change, dict):
+                new_e_tag = change.get("e_tag")
+            else:
+                new_e_tag = getattr(change, "e_tag", None)
+            entry = self._memory.get(key)
+            if entry is not None and new_e_tag not in (None, "*") and new_e_tag != entry[0]:
+                self.stats["conflicts"] += 1
+                raise KeyError(
+                    "Etag conflict.\nOriginal: %s\r\nCurrent: %s" % (new_e_tag, entry[0]))
+            properties = self._encode(
+                change, entry[1] if entry is not None else {})
+            if entry is not None and properties == entry[1]:
+                self.stats["skipped"] += 1
+                self._touch(key)
+                continue
+            self._e_tag += 1
+            updates[key] = (f"{int(self._clock())}-{self._e_tag}", properties)
+        if not updates:
+            return
+        self.stats["writes"] += 1
+        for key, (e_tag, properties) in updates.items():
+            entry = self._memory.get(key)
+            old = entry[1] if entry is not None else {}
+            changed = {name: text for name, text in properties.items()
+                       if old.get(name) != text}
+            changed.update((name, None)
+                           for name in old if name not in properties)
+            self.stats["properties_written"] += len(changed)
+            self._remember(key, (e_tag, properties))
+            self._pending[key] = self._merge(
+                self._pending.get(key), (e_tag, changed, entry is None))
+            self._touched_at[key] = self._clock()
+        self._schedule_flush()
+
+    async def delete(self, keys: List[str]):
+        """Removes store items
+
+        Args:
+            keys (List[str]): storage keys
+        """
+        for key in keys:
+            self._remember(key, None)
+            self._pending[key] = None
+            self._touches.pop(key, None)
+        self._schedule_flush()
+
+    def start(self):
+        """Starts the periodic compaction if it isn't running yet"""
+        if self._compact_task is None or self._compact_task.done():
+            self._compact_task = asyncio.ensure_future(
+                self._compact_periodically())
+
+    async def close(self):
+        """Stops the compaction, flushes the pending changes and closes the database"""
+        if self._compact_task is not None:
+            self._compact_task.cancel()
+            try:
+                await self._compact_task
+            except asyncio.CancelledError:
+                pass
+            self._compact_task = None
+        await self.flush()
+        await run_io(self._close_db)
+
+    async def flush(self):
+        """Writes all the pending changes to the database in a single transaction.
+        Changes that fail to be written are kept pending and retried on the next flush"""
+        async with self._flush_lock:
+            if not self._pending and not self._touches:
+                return
+            self._flushing, self._pending = self._pending, {}
+            touches, self._touches = self._touches, {}
+            try:
+                await run_io(self._commit, self._flushing, touches)
+                self.stats["flushes"] += 1
+                self.stats["flushed_items"] += len(self._flushing)
+                self.stats["touched"] += len(touches)
+                self._failures = 0
+            except sqlite3.Error as error:
+                self._failures += 1
+                print(
+                    f"\n [SqliteStorage] flush failed, retrying later: {error}", file=sys.stderr)
+                self._touches = {**touches, **self._touches}
+                # changes made during the flush are newer than the failed ones
+                for key, change in self._pending.items():
+                    self._flushing[key] = self._merge(self._flushing[key], change) \
+                        if key in self._flushing else change
+                self._pending = self._flushing
+            finally:
+                self._flushing = {}
+                self._evict()
+
+    def _schedule_flush(self):
+        """Makes sure a flush will run within flush_interval seconds"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        """Collects the writes for flush_interval seconds and flushes them until nothing is pending,
+        backing off while the database keeps failing"""
+        while self._pending or self._touches:
+            await asyncio.sleep(self.flush_interval * 2 ** min(self._failures, 10))
+            await self.flush()
+
+    async def _compact_periodically(self):
+        """Runs the compaction every compact_interval seconds"""
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                removed = await run_io(self._compact)
+                # expired items may still be cached, drop them along with the rest of the clean entries.
+                # The ones being flushed aren't clean yet, a read would get their old rows from the database
+                if removed:
+                    for key in [k for k in self._memory if k not in self._pending and k not in self._flushing]:
+                        del self._memory[key]
+                        self._touched_at.pop(key, None)
+            except sqlite3.Error as error:
+                print(
+                    f"\n [SqliteStorage] compaction failed: {error}", file=sys.stderr)
+
+    def _touch(self, key: str):
+        """Records a use of an item which writes nothing, so the retention counts the uses and not only the writes
+
+        Args:
+            key (str): storage key of a stored item
+        """
+        if self.retention_days <= 0 or key in self._pending:
+            return
+        now = self._clock()
+        if now - self._touched_at.get(key, 0.0) < self.TOUCH_INTERVAL:
+            return
+        self._touched_at[key] = now
+        self._touches[key] = now
+        self._schedule_flush()
+
+    def _encode(self, change: object, stored: Dict[str, str]) -> Dict[str, str]:
+        """Serializes a store item property by property. Properties which track their own changes,
+        like UserProfile, and report none are taken from the stored copy instead of being serialized again
+
+        Args:
+            change (object): store item, usually the state dict of a BotState
+            stored (Dict[str, str]): serialized properties of the stored copy
+
+        Returns:
+            Dict[str, str]: json of every property keyed by the property name
+        """
+        if not isinstance(change, dict):
+            return {ITEM: jsonpickle.encode(change, make_refs=False)}
+        properties = {}
+        for name, value in change.items():
+            if name == "e_tag":
+                continue
+            if getattr(value, "dirty", None) is False and name in stored:
+                properties[name] = stored[name]
+            else:
+                properties[name] = jsonpickle.encode(value, make_refs=False)
+        return properties
+
+    def _decode(self, entry: tuple) -> object:
+        """Restores a fresh copy of a store item
+
+        Args:
+            entry (tuple): (e_tag, properties) pair of the stored copy
+
+        Returns:
+            object: store item with its eTag
+        """
+        e_tag, properties = entry
+        if ITEM in properties:
+            item = jsonpickle.decode(properties[ITEM])
+            item.e_tag = e_tag
+            return item
+        item = {name: jsonpickle.decode(text)
+                for name, text in properties.items()}
+        item["e_tag"] = e_tag
+        return item
+
+    @staticmethod
+    def _merge(older: tuple, newer: tuple) -> tuple:
+        """Combines two pending changes of the same item
+
+        Args:
+            older (tuple): (e_tag, changed properties, replace) of the earlier change or None if it was a deletion
+            newer (tuple): same for the later change. The changed properties map removed ones to None,
+            replace tells whether the properties stored before have to be dropped first
+
+        Returns:
+            tuple: combined change
+        """
+        if newer is None or newer[2]:
+            return newer
+        if older is None:
+            return newer[0], newer[1], True
+        return newer[0], {**older[1], **newer[1]}, older[2]
+
+    def _remember(self, key: str, entry: tuple):
+        """Puts an item into the in-memory copy, evicting the least recently used flushed items
+
+        Args:
+            key (str): storage key
+            entry (tuple): (e_tag, properties) pair or None for a deleted item
+        """
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        """Drops the least recently used items which are already on disk"""
+        excess = len(self._memory) - self.max_entries
+        if excess <= 0:
+            return
+        for key in list(self._memory):
+            if excess <= 0:
+                break
+            if key not in self._pending and key not in self._flushing:
+                del self._memory[key]
+                self._touched_at.pop(key, None)
+                excess -= 1
+
+    def _connect(self) -> sqlite3.Connection:
+        """Opens the database on first use. WAL with synchronous=NORMAL keeps every commit
+        atomic and durable against process crashes without an fsync per transaction
+
+        Returns:
+            sqlite3.Connection: connection shared by the I/O pool threads, guarded by a lock
+        """
+        if self._db is None:
+            db = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS state_items ("
+                "key TEXT PRIMARY KEY, e_tag TEXT NOT NULL, updated_at REAL NOT NULL)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS state_properties ("
+                "key TEXT NOT NULL, name TEXT NOT NULL, document TEXT NOT NULL, PRIMARY KEY (key, name))")
+            self._db = db
+        return self._db
+
+    def _close_db(self):
+        """Closes the database, it's reopened if the storage is used again"""
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _select(self, keys: List[str]) -> Dict[str, tuple]:
+        """Reads items from the database
+
+        Args:
+            keys (List[str]): storage keys
+
+        Returns:
+            Dict[str, tuple]: (e_tag, {property name: json}) pairs of the found items keyed by the storage key
+        """
+        placeholders = ",".join("?" * len(keys))
+        with self._db_lock:
+            db = self._connect()
+            items = db.execute(
+                f"SELECT key, e_tag FROM state_items WHERE key IN ({placeholders})", keys).fetchall()
+            rows = db.execute(
+                f"SELECT key, name, document FROM state_properties WHERE key IN ({placeholders})", keys).fetchall()
+        found = {key: (e_tag, {}) for key, e_tag in items}
+        for key, name, document in rows:
+            if key in found:
+                found[key][1][name] = document
+        return found
+
+    def _commit(self, changes: Dict[str, tuple], touches: Dict[str, float] = None):
+        """Writes a batch of changes in a single transaction
+
+        Args:
+            changes (Dict[str, tuple]): (e_tag, changed properties, replace) or None for deleted items
+            keyed by the storage key
+            touches (Dict[str, float], optional): unix times of the uses which wrote nothing keyed by the storage key.
+            Defaults to None.
+        """
+        now = self._clock()
+        items, cleared, upserts, removed = [], [], [], []
+        accessed = [(at, key) for key, at in (touches or {}).items()
+                    if key not in changes]
+        for key, change in changes.items():
+            if change is None or change[2]:
+                cleared.append((key,))
+            if change is None:
+                continue
+            e_tag, properties, _ = change
+            items.append((key, e_tag, now))
+            for name, text in properties.items():
+                if text is None:
+                    removed.append((key, name))
+                else:
+                    upserts.append((key, name, text))
+        with self._db_lock:
+            db = self._connect()
+            db.execute("BEGIN")
+            try:
+                db.executemany(
+                    "DELETE FROM state_items WHERE key = ?", cleared)
+                db.executemany(
+                    "DELETE FROM state_properties WHERE key = ?", cleared)
+                db.executemany(
+                    "INSERT OR REPLACE INTO state_items (key, e_tag, updated_at) VALUES (?, ?, ?)", items)
+                db.executemany(
+                    "INSERT OR REPLACE INTO state_properties (key, name, document) VALUES (?, ?, ?)", upserts)
+                db.executemany(
+                    "DELETE FROM state_properties WHERE key = ? AND name = ?", removed)
+                db.executemany(
+                    "UPDATE state_items SET updated_at = ? WHERE key = ?", accessed)
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+
+    def _compact(self) -> int:
+        """Drops the expired items, returns the freed pages to the file system and truncates the WAL
+
+        Returns:
+            int: number of dropped items
+        """
+        with self._db_lock:
+            db = self._connect()
+            removed = 0
+            if self.retention_days > 0:
+                cutoff = self._clock() - self.retention_days * 86400
+                db.execute("BEGIN")
+                db.execute(
+                    "DELETE FROM state_properties WHERE key IN "
+                    "(SELECT key FROM state_items WHERE updated_at < ?)", (cutoff,))
+                removed = db.execute(
+                    "DELETE FROM state_items WHERE updated_at < ?", (cutoff,)).rowcount
+                db.execute("COMMIT")
+            db.execute("PRAGMA incremental_vacuum")
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
@@ -0,0 +1,198 @@
+import base64
+import hashlib
+import os
+import sys
+from collections import OrderedDict
+from io import BytesIO
+
+from helpers.executors import run_cpu, run_io
+
+PLACEHOLDER_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cards_templates", "placeholder.png")
+
+
+def to_data_uri(content: bytes, content_type: str = "image/jpeg") -> str:
+    """Encodes an image as a data URI ready to be embedded into an Adaptive card
+
+    Args:
+        content (bytes): image content
+        content_type (str, optional): MIME type of the image. Defaults to "image/jpeg".
+
+    Returns:
+        str: data URI, i.e. "data:image/jpeg;base64,..."
+    """
+    return f"data:{content_type};base64," + base64.b64encode(content).decode()
+
+
+def make_thumbnail(content: bytes, size: tuple = (96, 96)) -> str:
+    """Crops and resizes an image. CPU-bound, hence meant to be run in a worker pool
+
+    Args:
+        content (bytes): full-size image content
+        size (tuple, optional): thumbnail size. Defaults to (96, 96).
+
+    Returns:
+        str: data URI of the JPEG thumbnail
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(content)) as img:
+        img = ImageOps.fit(img.convert("RGB"), size, centering=(0.5, 0.0))
+        buffered = BytesIO()
+        img.save(buffered, format="JPEG")
+    return to_data_uri(buffered.getvalue())
+
+
+class ThumbnailStore:
+    """Keeps ready-to-embed profile photo thumbnails keyed by user and photo eTag,
+    so a photo is downloaded and resized again only after it has been changed.
+    Thumbnails are kept in memory and optionally persisted to a local folder to survive restarts.
+    Resizing runs in the shared CPU pool, disk access in the shared I/O pool.
+
+    Attributes:
+        cache_dir(str): folder for the persisted thumbnails or None to keep them in memory only
+        max_entries(int): max number of thumbnails kept in memory
+    """
+
+    def __init__(self, cache_dir: str = None, max_entries: int = 512):
+        """inits the ThumbnailStore instance
+
+        Args:
+            cache_dir (str, optional): folder for the persisted thumbnails. Defaults to None.
+            max_entries (int, optional): max number of thumbnails kept in memory. Defaults to 512.
+        """
+        self.cache_dir = cache_dir or None
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._placeholder = None
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def placeholder(self) -> str:
+        """Placeholder picture for employees without a photo, encoded only once
+
+        Returns:
+            str: data URI of the placeholder
+        """
+        if self._placeholder is None:
+            with open(PLACEHOLDER_PATH, "rb") as f:
+                self._placeholder = to_data_uri(f.read(), "image/png")
+        return self._placeholder
+
+    async def get(self, email: str, etag: str) -> str:
+        """Returns a stored thumbnail
+
+        Args:
+            email (str): email of the user
+            etag (str): eTag of the user's current photo
+
+        Returns:
+            str: data URI of the thumbnail or None if there is no thumbnail for this version of the photo
+        """
+        key = (email.lower(), etag)
+        data_uri = self._memory.get(key)
+        if data_uri is not None:
+            self._memory.move_to_end(key)
+            return data_uri
+        if self.cache_dir is None:
+            return None
+        data_uri = await run_io(self._read, key)
+        if data_uri is not None:
+            self._remember(key, data_uri)
+        return data_uri
+
+    async def put(self, email: str, etag: str, data_uri: str):
+        """Stores a thumbnail, replacing the ones of the previous versions of the photo
+
+        Args:
+            email (str): email of the user
+            etag (str): eTag of the user's current photo
+            data_uri (str): data URI of the thumbnail
+        """
+        key = (email.lower(), etag)
+        self._remember(key, data_uri)
+        if self.cache_dir is not None:
+            await run_io(self._write, key, data_uri)
+
+    async def resize(self, content: bytes) -> str:
+        """Makes a thumbnail out of a full-size photo in the shared CPU pool
+
+        Args:
+            content (bytes): full-size image content
+
+        Returns:
+            str: data URI of the thumbnail
+        """
+        return await run_cpu(make_thumbnail, content)
+
+    def _remember(self, key: tuple, data_uri: str):
+        """Puts a thumbnail into the in-memory LRU
+
+        Args:
+            key (tuple): (email, etag) pair
+            data_uri (str): data URI of the thumbnail
+        """
+        self._memory[key] = data_uri
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _file_prefix(self, email: str) -> str:
+        """Returns the file name prefix shared by all the thumbnails of a user
+
+        Args:
+            email (str): email of the user in lower case
+
+        Returns:
+            str: file name prefix
+        """
+        return hashlib.sha1(email.encode("utf-8")).hexdigest() + "-"
+
+    def _file_path(self, key: tuple) -> str:
+        """Returns the path of a persisted thumbnail
+
+        Args:
+            key (tuple): (email, etag) pair
+
+        Returns:
+            str: full path to the file
+        """
+        email, etag = key
+        name = self._file_prefix(email) + hashlib.sha1(etag.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+    def _read(self, key: tuple) -> str:
+        """Reads a persisted thumbnail
+
+        Args:
+            key (tuple): (email, etag) pair
+
+        Returns:
+            str: data URI of the thumbnail or None if it isn't persisted
+        """
+        try:
+            with open(self._file_path(key), "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, key: tuple, data_uri: str):
+        """Persists a thumbnail and removes the outdated ones of the same user
+
+        Args:
+            key (tuple): (email, etag) pair
+            data_uri (str): data URI of the thumbnail
+        """
+        full_path = self._file_path(key)
+        prefix = self._file_prefix(key[0])
+        try:
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(prefix) and os.path.join(self.cache_dir, name) != full_path:
+                    os.remove(os.path.join(self.cache_dir, name))
+            tmp_path = full_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data_uri)
+            os.replace(tmp_path, full_path)
+        except OSError as error:
+            print(f"\n [ThumbnailStore] can't persist a thumbnail: {error}", file=sys.stderr)
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Callable, List
+
+from helpers.executors import run_io
+
+
+class TokenManager:
+    """Keeps a valid Graph access token at hand and refreshes it in the background before it expires,
+    so the calls to the Graph API never wait for authentication once the first token is acquired.
+    It relies on an Microsoft Authentication library (msal). More detailed information re different authentication
+    flows is available here - https://docs.microsoft.com/en-us/azure/active-directory/develop/msal-authentication-flows
+
+    If a client secret is configured the non-interactive client credentials flow is used.
+    Otherwise tokens are refreshed silently from the msal token cache, which can be persisted to a local file,
+    and the interactive device flow is only run if the cache holds no usable account.
+    A static token, i.e. the one of a local Graph stand-in, is used as is and never refreshed.
+
+    Attributes:
+        client_id(str): id of the Azure AD application
+        authority(str): authority URL of the tenant
+        scopes(List[str]): scopes requested in the delegated (device) flow
+        resource(str): resource URI the application permissions are requested for in the client credentials flow
+        client_secret(str): secret of the confidential application or None for the public one
+        static_token(str): token used as is instead of acquiring one or None
+        cache_path(str): file the msal token cache is persisted to or None to keep it in memory only
+        refresh_margin(float): seconds before the expiry at which the token is refreshed
+        access_token(str): current access token or None
+        expires_at(float): unix time at which the current token expires
+    """
+
+    def __init__(
+            self,
+            client_id: str,
+            authority: str,
+            scopes: List[str],
+            resource: str,
+            client_secret: str = None,
+            cache_path: str = None,
+            refresh_margin: float = 300,
+            static_token: str = None,
+            clock: Callable[[], float] = time.time):
+        """inits the TokenManager instance. No network calls are made here.
+
+        Args:
+            client_id (str): id of the Azure AD application
+            authority (str): authority URL of the tenant
+            scopes (List[str]): scopes requested in the delegated (device) flow
+            resource (str): resource URI the application permissions are requested for in the client credentials flow
+            client_secret (str, optional): secret of the confidential application. Defaults to None.
+            cache_path (str, optional): file the msal token cache is persisted to. Defaults to None.
+            refresh_margin (float, optional): seconds before the expiry at which the token is refreshed. Defaults to 300.
+            static_token (str, optional): token used as is instead of acquiring one. Defaults to None.
+            clock (Callable[[], float], optional): unix time source. Defaults to time.time.
+        """
+        self.client_id = client_id
+        self.authority = authority
+        self.scopes = scopes
+        self.resource = resource
+        self.client_secret = client_secret or None
+        self.cache_path = cache_path or None
+        self.refresh_margin = refresh_margin
+        self.static_token = static_token or None
+        self.access_token = self.static_token
+        self.expires_at = float("inf") if self.static_token is not None else 0.0
+        self._clock = clock
+        self._app = None
+        self._cache = None
+        self._refresh_task = None
+        self._refresh_forced = False
+        # set once Graph has rejected the current token, so the next refresh can't hand it out again
+        self._stale = False
+        self._loop_task = None
+
+    @property
+    def valid(self) -> bool:
+        """Whether the current token can still be used"""
+        return self.access_token is not None and self._clock() < self.expires_at
+
+    async def get_token(self) -> str:
+        """Returns a valid access token. Only waits if there is no valid token at all,
+        i.e. before the very first acquisition
+
+        Returns:
+            str: access token
+        """
+        if not self.valid:
+            await self.refresh()
+        return self.access_token
+
+    def invalidate(self):
+        """Marks the current token as unusable, i.e. after Graph has rejected it.
+        The next refresh bypasses the msal cache, which would otherwise return the rejected token"""
+        self.expires_at = 0.0
+        self._stale = True
+
+    async def refresh(self, force: bool = False):
+        """Acquires a new token. Concurrent callers share a single in-flight refresh
+
+        Args:
+            force (bool, optional): whether to bypass the access tokens stored in the msal cache. Defaults to False.
+        """
+        if self.static_token is not None:
+            self.access_token, self.expires_at = self.static_token, float("inf")
+            return
+        force = force or self._stale
+        # a refresh started before the token was rejected may return it, hence a forced one isn't shared with it
+        if self._refresh_task is None or self._refresh_task.done() or (force and not self._refresh_forced):
+            self._refresh_task = asyncio.ensure_future(run_io(self._acquire, force))
+            self._refresh_forced = force
+        forced = self._refresh_forced
+        result = await asyncio.shield(self._refresh_task)
+        self.access_token = result["access_token"]
+        self.expires_at = self._clock() + float(result.get("expires_in", 3600))
+        if forced:
+            self._stale = False
+
+    def start(self):
+        """Starts the background refresh loop if it isn't running yet. A static token needs no refreshing"""
+        if self.static_token is not None:
+            return
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops the background refresh loop"""
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+
+    async def _run(self):
+        """Refreshes the token shortly before it expires, retrying in a minute if the refresh fails"""
+        while True:
+            delay = self.expires_at - self.refresh_margin - self._clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.refresh(force=self.access_token is not None)
+            except Exception as error:
+                print(f"\n [TokenManager] token refresh failed: {error}", file=sys.stderr)
+                await asyncio.sleep(60)
+            else:
+                if self.expires_at - self.refresh_margin <= self._clock():
+                    # msal handed out a token which is already within the margin
+                    await asyncio.sleep(60)
+
+    def _get_app(self):
+        """Creates the msal application on first use, loading the persisted token cache
+
+        Returns:
+            msal.ClientApplication: confidential or public client application
+        """
+        if self._app is None:
+            import msal
+
+            self._cache = msal.SerializableTokenCache()
+            if self.cache_path is not None and os.path.exists(self.cache_path):
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    self._cache.deserialize(f.read())
+            if self.client_secret is not None:
+                self._app = msal.ConfidentialClientApplication(
+                    self.client_id, client_credential=self.client_secret,
+                    authority=self.authority, token_cache=self._cache)
+            else:
+                self._app = msal.PublicClientApplication(
+                    self.client_id, authority=self.authority, token_cache=self._cache)
+        return self._app
+
+    def _acquire(self, force: bool = False) -> dict:
+        """Acquires a token. msal is blocking, hence this is run in the shared I/O pool
+
+        Args:
+            force (bool, optional): whether to bypass the access tokens stored in the msal cache. Defaults to False.
+
+        Raises:
+            ValueError: raised if no token could be acquired
+
+        Returns:
+            dict: msal result containing the access_token and expires_in keys
+        """
+        app = self._get_app()
+        if self.client_secret is not None:
+            scopes = [self.resource.rstrip("/") + "/.default"]
+            if force:
+                # acquire_token_for_client serves cached tokens since msal 1.23 and has no way to bypass them,
+                # hence they are dropped to have a new one minted
+                for item in list(self._cache.find(
+                        self._cache.CredentialType.ACCESS_TOKEN, target=scopes, query={"client_id": self.client_id})):
+                    self._cache.remove_at(item)
+            result = app.acquire_token_for_client(scopes=scopes)
+        else:
+            result = None
+            accounts = app.get_accounts()
+            if accounts:
+                result = app.acquire_token_silent(
+                    self.scopes, account=accounts[0], force_refresh=force)
+            if not result:
+                result = self._device_flow(app)
+        self._persist_cache()
+        if "access_token" not in result:
+            raise ValueError(
+                "Fail to acquire a token. Err: %s" % json.dumps(result, indent=4))
+        return result
+
+    def _device_flow(self, app) -> dict:
+        """Runs the interactive device flow
+
+        Args:
+            app (msal.PublicClientApplication): public client application
+
+        Raises:
+            ValueError: raised if no response or error reponse are received from MS servers
+            and hence the device flow can't be initiated.
+
+        Returns:
+            dict: msal result
+        """
+        import webbrowser
+        import pyperclip
+
+        # TODO switch to Integrated Windows Authentication flow in prod. RN it
+        # is device_flow which isn't scalable
+        flow = app.initiate_device_flow(scopes=self.scopes)
+        if "user_code" not in flow:
+            raise ValueError(
+                "Fail to create device flow. Err: %s" %
+                json.dumps(
+                    flow, indent=4))
+        print(flow["message"], file=sys.stderr)
+        pyperclip.copy(flow['user_code'])
+        webbrowser.open(flow['verification_uri'])
+        return app.acquire_token_by_device_flow(flow)
+
+    def _persist_cache(self):
+        """Writes the msal token cache to the cache file if it has changed"""
+        if self.cache_path is not None and self._cache is not None and self._cache.has_state_changed:
+            tmp_path = self.cache_path + ".tmp"
+            # the cache holds refresh tokens, hence it's readable by the owner only
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+                f.write(self._cache.serialize())
+            os.replace(tmp_path, self.cache_path)
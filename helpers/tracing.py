@@ -0,0 +1,429 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import sys
+import time
+from collections import deque
+from typing import List
+
+
+class Span:
+    """A timed operation of a trace
+
+    Attributes:
+        trace_id(str): 32 hex digits shared by all the spans of the trace
+        span_id(str): 16 hex digits
+        parent_id(str): span_id of the parent span or None for the root
+        name(str): operation, i.e. "GET /v1.0/users/{id}/manager"
+        kind(int): OTLP span kind: 1 internal, 2 server, 3 client
+        start_ns(int): unix start time in nanoseconds
+        end_ns(int): unix end time in nanoseconds or None while the span is open
+        attributes(dict): string, number or bool attributes
+        error(str): error message if the operation has failed, None otherwise
+    """
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error",
+                 "_trace", "_started", "_token")
+
+    def __init__(self, trace: "_Trace", parent_id: str, name: str, kind: int, attributes: dict):
+        self.trace_id = trace.trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+        self._trace = trace
+        self._started = time.perf_counter()
+        self._token = None
+
+    def set(self, **attributes):
+        """Adds attributes, i.e. the status of an HTTP call once it's known"""
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and not isinstance(exc, (asyncio.CancelledError, GeneratorExit)):
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.end_ns = self.start_ns + int((time.perf_counter() - self._started) * 1e9)
+        _current.reset(self._token)
+        self._trace.finish(self)
+
+
+class _NoSpan:
+    """Stand-in for a span outside of any trace or of a trace which isn't recorded, costs nothing"""
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_SPAN = _NoSpan()
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class _Trace:
+    """Spans of a single trace, buffered until the root span ends and the trace is either exported or dropped"""
+
+    __slots__ = ("tracer", "trace_id", "sampled", "spans", "failed", "root", "done")
+
+    def __init__(self, tracer: "Tracer", sampled: bool):
+        self.tracer = tracer
+        self.trace_id = "%032x" % random.getrandbits(128)
+        self.sampled = sampled
+        self.spans = []
+        self.failed = False
+        self.root = None
+        self.done = False
+
+    def finish(self, span: Span):
+        """Records an ended span, deciding the fate of the trace once its root has ended
+
+        Args:
+            span (Span): ended span
+        """
+        if self.done:
+            # a background task outlived the turn it was started by, its spans come too late
+            return
+        self.failed = self.failed or span.error is not None
+        if len(self.spans) < self.tracer.max_spans or span is self.root:
+            self.spans.append(span)
+        if span is self.root:
+            self.done = True
+            self.tracer.finish(self)
+
+
+class Tracer:
+    """Hierarchical tracing of the turns, from the incoming activity down to the Graph HTTP calls.
+    Spans are propagated with contextvars, so the tasks started within a span are traced as its children.
+    A trace is buffered until its root span ends, then it's exported if it was sampled up front,
+    took longer than slow_threshold or has failed, so the traces of the slow turns are always kept.
+    Without an exporter nothing is recorded at all.
+
+    Attributes:
+        exporter(SpanExporter): destination of the kept traces or None to disable tracing
+        sample_rate(float): share of the traces kept whatever their duration
+        slow_threshold(float): seconds above which a trace is always kept, 0 keeps only the sampled ones
+        max_spans(int): max number of spans kept per trace
+        stats(dict): started/exported/dropped traces counters
+    """
+
+    def __init__(self, exporter: "SpanExporter" = None, sample_rate: float = 0.01, slow_threshold: float = 2.0,
+                 max_spans: int = 1000):
+        """inits the Tracer instance
+
+        Args:
+            exporter (SpanExporter, optional): destination of the kept traces. Defaults to None.
+            sample_rate (float, optional): share of the traces kept whatever their duration. Defaults to 0.01.
+            slow_threshold (float, optional): seconds above which a trace is always kept. Defaults to 2.0.
+            max_spans (int, optional): max number of spans kept per trace. Defaults to 1000.
+        """
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_spans = max_spans
+        self.stats = {"started": 0, "exported": 0, "dropped": 0}
+
+    def trace(self, name: str, kind: int = 2, **attributes):
+        """Starts a new trace, i.e. for an incoming activity
+
+        Args:
+            name (str): name of the root span
+            kind (int, optional): OTLP span kind. Defaults to 2, server.
+            **attributes: attributes of the root span
+
+        Returns:
+            Span: root span to be used as a context manager, a no-op one if tracing is disabled
+        """
+        if self.exporter is None:
+            return NO_SPAN
+        self.stats["started"] += 1
+        trace = _Trace(self, random.random() < self.sample_rate)
+        trace.root = Span(trace, None, name, kind, attributes)
+        return trace.root
+
+    def span(self, name: str, kind: int = 1, **attributes):
+        """Starts a child of the current span
+
+        Args:
+            name (str): name of the span
+            kind (int, optional): OTLP span kind. Defaults to 1, internal.
+            **attributes: attributes of the span
+
+        Returns:
+            Span: span to be used as a context manager, a no-op one outside of any trace
+        """
+        parent = _current.get()
+        if parent is None:
+            return NO_SPAN
+        return Span(parent._trace, parent.span_id, name, kind, attributes)
+
+    @staticmethod
+    def current_trace_id() -> str:
+        """Returns the id of the trace being recorded, i.e. to print it with an error
+
+        Returns:
+            str: trace id or None outside of any trace
+        """
+        span = _current.get()
+        return span.trace_id if span is not None else None
+
+    def finish(self, trace: _Trace):
+        """Exports or drops a trace whose root span has ended
+
+        Args:
+            trace (_Trace): ended trace
+        """
+        root = trace.root
+        slow = self.slow_threshold > 0 and (root.end_ns - root.start_ns) / 1e9 >= self.slow_threshold
+        if (trace.sampled or slow or trace.failed) and self.exporter is not None:
+            root.set(**{"trace.kept_because": "sampled" if trace.sampled else ("slow" if slow else "error")})
+            self.stats["exported"] += 1
+            self.exporter.export(trace.spans)
+        else:
+            self.stats["dropped"] += 1
+
+    def start(self):
+        """Starts the exporter"""
+        if self.exporter is not None:
+            self.exporter.start()
+
+    async def stop(self):
+        """Stops the exporter, flushing the traces kept so far"""
+        if self.exporter is not None:
+            await self.exporter.stop()
+
+
+class SpanExporter:
+    """Queues the kept traces and sends them in the OTLP/JSON format once in a while from a background loop,
+    so exporting never holds up a turn. Traces queued over max_queue are dropped.
+    More details on the format are available here - https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding
+
+    Attributes:
+        service_name(str): service.name resource attribute
+        interval(float): seconds between the flushes
+        max_queue(int): max number of spans waiting to be sent
+        stats(dict): exported/dropped spans and failed flushes counters
+    """
+
+    def __init__(self, service_name: str, interval: float = 5.0, max_queue: int = 10000):
+        """inits the SpanExporter instance
+
+        Args:
+            service_name (str): service.name resource attribute
+            interval (float, optional): seconds between the flushes. Defaults to 5.0.
+            max_queue (int, optional): max number of spans waiting to be sent. Defaults to 10000.
+        """
+        self.service_name = service_name
+        self.interval = interval
+        self.max_queue = max_queue
+        self.stats = {"exported": 0, "dropped": 0, "failures": 0}
+        self._queue = deque()
+        self._task = None
+
+    def export(self, spans: List[Span]):
+        """Queues the spans of a trace
+
+        Args:
+            spans (List[Span]): ended spans
+        """
+        if len(self._queue) + len(spans) > self.max_queue:
+            self.stats["dropped"] += len(spans)
+            return
+        self._queue.extend(spans)
+
+    def start(self):
+        """Starts the background flush loop if it isn't running yet"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops the background flush loop and sends what's left in the queue"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        """Sends all the queued spans"""
+        spans = list(self._queue)
+        self._queue.clear()
+        if not spans:
+            return
+        try:
+            await self._send(self.payload(spans))
+            self.stats["exported"] += len(spans)
+        except Exception as error:
+            self.stats["failures"] += 1
+            self.stats["dropped"] += len(spans)
+            print(f"\n [{type(self).__name__}] export failed: {error}", file=sys.stderr)
+
+    def payload(self, spans: List[Span]) -> dict:
+        """Builds an OTLP ExportTraceServiceRequest
+
+        Args:
+            spans (List[Span]): ended spans
+
+        Returns:
+            dict: request body in the OTLP/JSON format
+        """
+        return {"resourceSpans": [{
+            "resource": {"attributes": self._attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "bot.tracing"}, "spans": [self._span(span) for span in spans]}],
+        }]}
+
+    async def _send(self, payload: dict):
+        """Delivers a request
+
+        Args:
+            payload (dict): request body in the OTLP/JSON format
+        """
+        raise NotImplementedError
+
+    async def _run(self):
+        """Flushes the queue on schedule"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    @classmethod
+    def _span(cls, span: Span) -> dict:
+        """Converts a span to its OTLP/JSON form
+
+        Args:
+            span (Span): ended span
+
+        Returns:
+            dict: OTLP span
+        """
+        otlp = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": span.kind,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": cls._attributes(span.attributes),
+            "status": {"code": 2, "message": span.error} if span.error is not None else {"code": 1},
+        }
+        if span.parent_id is not None:
+            otlp["parentSpanId"] = span.parent_id
+        return otlp
+
+    @staticmethod
+    def _attributes(attributes: dict) -> list:
+        """Converts attributes to OTLP key-values
+
+        Args:
+            attributes (dict): string, number or bool values, the rest is converted to strings
+
+        Returns:
+            list: OTLP attributes
+        """
+        converted = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                typed = {"boolValue": value}
+            elif isinstance(value, int):
+                typed = {"intValue": str(value)}
+            elif isinstance(value, float):
+                typed = {"doubleValue": value}
+            else:
+                typed = {"stringValue": str(value)}
+            converted.append({"key": key, "value": typed})
+        return converted
+
+
+class FileSpanExporter(SpanExporter):
+    """Appends every flush as a line of OTLP/JSON to a local file, the format the OpenTelemetry collector's
+    otlpjsonfile receiver reads
+
+    Attributes:
+        path(str): file the traces are appended to
+    """
+
+    def __init__(self, path: str, service_name: str, interval: float = 5.0, max_queue: int = 10000):
+        """inits the FileSpanExporter instance
+
+        Args:
+            path (str): file the traces are appended to
+            service_name (str): service.name resource attribute
+            interval (float, optional): seconds between the flushes. Defaults to 5.0.
+            max_queue (int, optional): max number of spans waiting to be sent. Defaults to 10000.
+        """
+        super().__init__(service_name, interval, max_queue)
+        self.path = path
+
+    async def _send(self, payload: dict):
+        # imported here as the worker pools are traced themselves
+        from helpers.executors import run_io
+
+        line = json.dumps(payload, ensure_ascii=False) + "\n"
+        await run_io(self._append, line)
+
+    def _append(self, line: str):
+        """Appends a line to the file. Blocking, hence run in the shared I/O pool
+
+        Args:
+            line (str): serialized request
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+class OTLPSpanExporter(SpanExporter):
+    """Posts the traces to an OTLP/HTTP collector, i.e. the OpenTelemetry collector, Jaeger or Tempo
+
+    Attributes:
+        endpoint(str): traces URL of the collector, i.e. "http://localhost:4318/v1/traces"
+        headers(dict): extra request headers, i.e. an API key
+    """
+
+    def __init__(self, endpoint: str, service_name: str, headers: dict = None, interval: float = 5.0,
+                 max_queue: int = 10000):
+        """inits the OTLPSpanExporter instance
+
+        Args:
+            endpoint (str): traces URL of the collector
+            service_name (str): service.name resource attribute
+            headers (dict, optional): extra request headers. Defaults to None.
+            interval (float, optional): seconds between the flushes. Defaults to 5.0.
+            max_queue (int, optional): max number of spans waiting to be sent. Defaults to 10000.
+        """
+        super().__init__(service_name, interval, max_queue)
+        self.endpoint = endpoint
+        self.headers = headers or {}
+
+    async def _send(self, payload: dict):
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.post(self.endpoint, json=payload, headers=self.headers) as response:
+                if response.status >= 300:
+                    raise ValueError(f"Collector answered {response.status}: {await response.text()}")
+
+
+# shared by the app, the dialogs and the Graph client, disabled until the app sets an exporter
+TRACER = Tracer()
@@ -0,0 +1,103 @@
+from botbuilder.core import BotAssert, ConversationState, TurnContext, UserState
+from botbuilder.core.bot_state import CachedBotState
+from jsonpickle.pickler import Pickler
+
+
+def fingerprint(value: object) -> str:
+    """Returns a string which changes whenever the value does, the same way botbuilder hashes state
+
+    Args:
+        value (object): state property value
+
+    Returns:
+        str: fingerprint
+    """
+    return str(Pickler().flatten(value))
+
+
+class TrackedCachedBotState(CachedBotState):
+    """Cached state of a turn which detects changes property by property.
+    Values tracking their own changes through a dirty flag, like UserProfile, are never flattened,
+    the rest are fingerprinted once on load and once per save instead of as a whole on every check.
+    """
+
+    def __init__(self, state: dict = None):
+        """inits the TrackedCachedBotState instance
+
+        Args:
+            state (dict, optional): state read from the storage. Defaults to None.
+        """
+        self._fingerprints = {}
+        self._current = None
+        super().__init__(state)
+
+    @property
+    def is_changed(self) -> bool:
+        """Whether any property has been changed, added or removed since the state was loaded or saved"""
+        return bool(self.changed_properties())
+
+    def changed_properties(self) -> set:
+        """Returns the names of the changed, added and removed properties
+
+        Returns:
+            set: property names
+        """
+        changed = set(self._fingerprints).difference(self.state)
+        current = {}
+        for name, value in self.state.items():
+            if hasattr(value, "dirty"):
+                if value.dirty or name not in self._fingerprints:
+                    changed.add(name)
+            else:
+                current[name] = fingerprint(value)
+                if self._fingerprints.get(name) != current[name]:
+                    changed.add(name)
+        # BotState saves right after the check, the fingerprints are reused to recompute the hash then
+        self._current = current
+        return changed
+
+    def compute_hash(self, obj: object) -> str:
+        """Records the state as unchanged. BotState calls it on load and after every save
+
+        Args:
+            obj (object): state dict
+
+        Returns:
+            str: marker stored as the hash. Changes are detected by is_changed, not by comparing it
+        """
+        current = self._current or {}
+        self._current = None
+        self._fingerprints = {}
+        for name, value in (obj or {}).items():
+            if hasattr(value, "mark_clean"):
+                value.mark_clean()
+                self._fingerprints[name] = None
+            else:
+                self._fingerprints[name] = current[name] if name in current else fingerprint(value)
+        return "tracked"
+
+
+class _TrackedLoadMixin:
+    """Makes a BotState cache the turn state as TrackedCachedBotState"""
+
+    async def load(self, turn_context: TurnContext, force: bool = False) -> None:
+        """Reads the current state object and caches it in the context object for this turn
+
+        Args:
+            turn_context (TurnContext): the context object for this turn
+            force (bool, optional): whether to bypass the cache. Defaults to False.
+        """
+        BotAssert.context_not_none(turn_context)
+        cached_state = self.get_cached_state(turn_context)
+        if force or not cached_state or not cached_state.state:
+            storage_key = self.get_storage_key(turn_context)
+            items = await self._storage.read([storage_key])
+            turn_context.turn_state[self._context_service_key] = TrackedCachedBotState(items.get(storage_key))
+
+
+class TrackedUserState(_TrackedLoadMixin, UserState):
+    """UserState which is only written when one of its properties has changed"""
+
+
+class TrackedConversationState(_TrackedLoadMixin, ConversationState):
+    """ConversationState which is only written when one of its properties has changed"""
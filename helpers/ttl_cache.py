@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class TTLCache:
+    """Bounded in-process cache with per-kind expiration times and LRU eviction.
+    Concurrent loads of the same key are coalesced, so a burst of identical requests
+    results in a single upstream call.
+
+    Attributes:
+        maxsize (int): max number of entries kept in the cache. The least recently used entry
+        is evicted once the limit is reached
+        ttls (dict): time to live in seconds for each kind of entries, i.e. {"photo": 86400}
+        default_ttl (float): time to live in seconds for kinds missing in the ttls attribute
+        negative_ttl (float): time to live in seconds for placeholder values returned when the data is unavailable
+        stats (dict): hit/miss/eviction/coalesced counters
+    """
+
+    def __init__(
+            self,
+            maxsize: int = 1024,
+            ttls: dict = None,
+            default_ttl: float = 60,
+            negative_ttl: float = 60,
+            clock: Callable[[], float] = time.monotonic):
+        """inits the TTLCache instance
+
+        Args:
+            maxsize (int, optional): max number of entries kept in the cache. Defaults to 1024.
+            ttls (dict, optional): time to live in seconds for each kind of entries. Defaults to None.
+            default_ttl (float, optional): time to live for kinds missing in ttls. Defaults to 60.
+            negative_ttl (float, optional): time to live for placeholder values. Defaults to 60.
+            clock (Callable[[], float], optional): monotonic time source. Defaults to time.monotonic.
+        """
+        self.maxsize = maxsize
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "coalesced": 0}
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, kind: str, key: Hashable, default=None) -> Any:
+        """Returns a fresh cached value without loading it
+
+        Args:
+            kind (str): kind of the entry, i.e. "user" or "presence"
+            key (Hashable): key of the entry within its kind
+            default (optional): value to return if there is no fresh entry. Defaults to None.
+
+        Returns:
+            Any: cached value or the default
+        """
+        full_key = (kind, key)
+        entry = self._entries.get(full_key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[full_key]
+            return default
+        self._entries.move_to_end(full_key)
+        return value
+
+    def set(self, kind: str, key: Hashable, value: Any, ttl: float = None):
+        """Stores a value, evicting the least recently used entries if the cache is full
+
+        Args:
+            kind (str): kind of the entry, i.e. "user" or "presence"
+            key (Hashable): key of the entry within its kind
+            value (Any): value to store
+            ttl (float, optional): time to live in seconds. Defaults to the kind's ttl.
+        """
+        if ttl is None:
+            ttl = self.ttls.get(kind, self.default_ttl)
+        full_key = (kind, key)
+        self._entries[full_key] = (self._clock() + ttl, value)
+        self._entries.move_to_end(full_key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self, kind: str, key: Hashable):
+        """Removes an entry from the cache
+
+        Args:
+            kind (str): kind of the entry
+            key (Hashable): key of the entry within its kind
+        """
+        self._entries.pop((kind, key), None)
+
+    def clear(self):
+        """Removes all entries from the cache"""
+        self._entries.clear()
+
+    async def get_or_load(
+            self,
+            kind: str,
+            key: Hashable,
+            loader: Callable[[], Awaitable],
+            is_placeholder: Callable[[Any], bool] = None) -> Any:
+        """Returns a cached value or loads it. Concurrent calls for the same key share a single load.
+
+        Args:
+            kind (str): kind of the entry, i.e. "user" or "presence"
+            key (Hashable): key of the entry within its kind
+            loader (Callable[[], Awaitable]): coroutine function fetching the value
+            is_placeholder (Callable[[Any], bool], optional): tells whether a loaded value is a placeholder
+            for unavailable data. Such values are kept for negative_ttl only. Defaults to None.
+
+        Returns:
+            Any: cached or freshly loaded value
+        """
+        sentinel = object()
+        value = self.get(kind, key, sentinel)
+        if value is not sentinel:
+            self.stats["hits"] += 1
+            return value
+
+        full_key = (kind, key)
+        task = self._inflight.get(full_key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(
+                self._load(kind, key, loader, is_placeholder))
+            self._inflight[full_key] = task
+        # shielding keeps the shared load alive if one of the waiters is cancelled
+        return await asyncio.shield(task)
+
+    async def _load(self, kind: str, key: Hashable, loader: Callable[[], Awaitable],
+                    is_placeholder: Callable[[Any], bool] = None) -> Any:
+        """Runs the loader and stores its result
+
+        Args:
+            kind (str): kind of the entry
+            key (Hashable): key of the entry within its kind
+            loader (Callable[[], Awaitable]): coroutine function fetching the value
+            is_placeholder (Callable[[Any], bool], optional): tells whether a value is a placeholder. Defaults to None.
+
+        Returns:
+            Any: loaded value
+        """
+        try:
+            value = await loader()
+            ttl = self.negative_ttl if is_placeholder is not None and is_placeholder(value) else None
+            self.set(kind, key, value, ttl)
+            return value
+        finally:
+            self._inflight.pop((kind, key), None)
+
+
+def cached(kind: str, is_placeholder: Callable[[Any], bool] = None):
+    """Decorator caching the results of an async method taking a single email argument.
+    The instance is expected to have a "cache" attribute holding a TTLCache, or None to disable caching.
+
+    Args:
+        kind (str): kind of the cached entries, used to pick the ttl
+        is_placeholder (Callable[[Any], bool], optional): tells whether a result is a placeholder
+        for unavailable data. Defaults to None.
+
+    Returns:
+        decorated method
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, email: str):
+            if self.cache is None:
+                return await method(self, email)
+            return await self.cache.get_or_load(
+                kind, email.lower(), lambda: method(self, email), is_placeholder)
+        return wrapper
+    return decorator
@@ -0,0 +1,109 @@
+import asyncio
+import importlib
+import sys
+import time
+from typing import Awaitable, Callable, List
+
+from helpers.executors import run_io
+
+
+async def import_modules(names: List[str]):
+    """Imports modules in the shared I/O pool, so the event loop keeps serving requests meanwhile
+
+    Args:
+        names (List[str]): dotted module names, i.e. ["PIL.Image", "yattag"]
+    """
+    for name in names:
+        await run_io(importlib.import_module, name)
+
+
+class Warmup:
+    """Runs the start-up work such as heavy imports, template loading and token acquisition
+    in the background after the HTTP listener is up, and reports its progress for the readiness probe.
+    Everything warmed up here is also loaded lazily on first use, so requests arriving earlier still work,
+    they just pay the loading cost themselves. Optional steps, i.e. the ones whose services recover
+    on their own, are reported but don't hold the readiness back, as a failed step is never run again.
+
+    Attributes:
+        steps(dict): coroutine functions keyed by the step name
+        optional(set): names of the steps readiness doesn't wait for
+        status(dict): "pending", "ok" or the error message keyed by the step name
+        started_at(float): unix time the warm-up was started at or None
+        finished_at(float): unix time all the steps were finished at or None
+    """
+
+    def __init__(self):
+        """inits the Warmup instance"""
+        self.steps = {}
+        self.optional = set()
+        self.status = {}
+        self.started_at = None
+        self.finished_at = None
+        self._task = None
+
+    def add(self, name: str, step: Callable[[], Awaitable], optional: bool = False):
+        """Registers a step. Steps run concurrently
+
+        Args:
+            name (str): step name shown in the readiness report
+            step (Callable[[], Awaitable]): coroutine function doing the work
+            optional (bool, optional): whether readiness doesn't wait for the step. Defaults to False.
+        """
+        self.steps[name] = step
+        self.status[name] = "pending"
+        if optional:
+            self.optional.add(name)
+
+    @property
+    def ready(self) -> bool:
+        """Whether all the required steps have succeeded"""
+        return self.finished_at is not None and all(
+            state == "ok" for name, state in self.status.items() if name not in self.optional)
+
+    def start(self):
+        """Starts the warm-up if it isn't running yet. Returns immediately"""
+        if self._task is None:
+            self.started_at = time.time()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Cancels the steps which are still running"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def report(self) -> dict:
+        """Returns the readiness report
+
+        Returns:
+            dict: overall readiness, the state of every step, the optional ones and the warm-up duration in seconds
+        """
+        end = self.finished_at or time.time()
+        return {
+            "ready": self.ready,
+            "steps": dict(self.status),
+            "optional": sorted(self.optional),
+            "seconds": round(end - self.started_at, 3) if self.started_at is not None else None,
+        }
+
+    async def _run(self):
+        """Runs all the steps concurrently and records their outcome"""
+        await asyncio.gather(*(self._run_step(name, step) for name, step in self.steps.items()))
+        self.finished_at = time.time()
+
+    async def _run_step(self, name: str, step: Callable[[], Awaitable]):
+        """Runs a single step. A failure is reported but doesn't stop the other steps
+
+        Args:
+            name (str): step name
+            step (Callable[[], Awaitable]): coroutine function doing the work
+        """
+        try:
+            await step()
+            self.status[name] = "ok"
+        except Exception as error:
+            self.status[name] = f"failed: {error}"
+            print(f"\n [Warmup] {name} failed: {error}", file=sys.stderr)
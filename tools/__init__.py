@@ -0,0 +1 @@
+"""Developer tooling: budgets, harnesses and benchmarks. Not imported by the bot."""
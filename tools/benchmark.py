@@ -0,0 +1,261 @@
+"""Offline end-to-end benchmark of every dialog branch.
+
+Scripted conversations for each branch are driven through DialogBot with the in-process test adapter.
+Graph and the quote source are replaced with the fakes from tools.fakes, so nothing leaves the process.
+For every branch it reports turns per second, p50/p95/p99 turn latency and the memory a turn allocates,
+and writes everything as JSON. The results of two commits can then be compared with --compare.
+
+Usage:
+    python -m tools.benchmark [--conversations 200] [--concurrency 1] [--upstream-delay 0] [--output bench.json]
+    python -m tools.benchmark --compare baseline.json [--tolerance 0.15]
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple
+
+from botbuilder.core import MemoryStorage
+
+from tools.concurrency_harness import Harness, SimulatedConversation, _texts
+
+AUTOREPLY_SUBMISSION = {
+    "startdate": "2030-01-01", "enddate": "2030-01-10", "phone": "+79990000000", "language": "RU", "reason": "Vacation",
+    "name1": "Colleague 1", "area1": "Area 1", "name2": "Colleague 2", "area2": "Area 2",
+    "name3": "Colleague 3", "area3": "Area 3", "name4": "Colleague 4", "area4": "Area 4",
+}
+
+
+class Script(NamedTuple):
+    """Scripted conversation of a single branch
+
+    Attributes:
+        turns (Callable[[Harness], list]): returns the messages to send, a dict is sent as a card submission
+        check (Callable[[list, Harness], bool]): tells whether the replies to the last message are right
+    """
+    turns: Callable[[Harness], list]
+    check: Callable[[list, Harness], bool]
+
+
+def _attachments(replies: list) -> list:
+    """Collects the attachments of the replies"""
+    return [attachment for reply in replies for attachment in (reply.attachments or [])]
+
+
+SCRIPTS: Dict[str, Script] = {
+    "reports": Script(
+        lambda harness: ["привет", "Отчеты Химкурьер", "Деко", "2019Q3, 2019Q2"],
+        lambda replies, harness: "[Deco2019Q3.pdf]" in _texts(replies) and "[Deco2019Q2.pdf]" in _texts(replies)),
+    "links": Script(
+        lambda harness: ["привет", "Полезные ссылки", "Вопрос по статьям затрат", "Завершить"],
+        lambda replies, harness: "Справка по статьям затрат" in _texts(replies)),
+    "stocks": Script(
+        lambda harness: ["привет", "Котировки акций Tikkurila"],
+        lambda replies, harness: len(_attachments(replies)) == 1),
+    "person": Script(
+        lambda harness: ["привет", "Не знаю, к кому обратиться с вопросом"] + harness.leaf_paths[0],
+        lambda replies, harness: len(_attachments(replies)) == len(harness.index.node(harness.leaf_paths[0]).emails)),
+    "autoreply": Script(
+        lambda harness: ["привет", "Хочу поставить красивый автоответ", AUTOREPLY_SUBMISSION],
+        lambda replies, harness: bool(harness.client.autoreplies)),
+}
+
+
+def _percentile(values: List[float], share: float) -> float:
+    """Returns the value below which the given share of the sorted values lies"""
+    return values[min(int(share * len(values)), len(values) - 1)] if values else 0.0
+
+
+async def _converse(harness: Harness, script: Script, user_id: str, on_turn: Callable = None) -> bool:
+    """Runs a single scripted conversation
+
+    Args:
+        harness (Harness): bot wired to the fakes
+        script (Script): conversation to run
+        user_id (str): id of the user, every conversation gets a new one
+        on_turn (Callable, optional): async callable wrapping every turn, i.e. to trace its allocations. Defaults to None.
+
+    Returns:
+        bool: whether the replies to the last message are right
+    """
+    conversation = SimulatedConversation(harness.bot, user_id)
+    replies = []
+    for turn in script.turns(harness):
+        say = conversation.say(value=turn) if isinstance(turn, dict) else conversation.say(turn)
+        replies = await (on_turn(say) if on_turn is not None else say)
+    harness.latencies.extend(conversation.latencies)
+    return script.check(replies, harness)
+
+
+async def bench_branch(name: str, conversations: int, concurrency: int, upstream_delay: float,
+                       alloc_conversations: int) -> dict:
+    """Benchmarks a single branch
+
+    Args:
+        name (str): branch name, a key of SCRIPTS
+        conversations (int): number of measured conversations
+        concurrency (int): number of conversations run at once
+        upstream_delay (float): max seconds every fake upstream call takes
+        alloc_conversations (int): number of conversations traced for allocations, in a separate pass
+
+    Returns:
+        dict: turns, failures, turns_per_sec, p50/p95/p99 turn latency in ms, KiB allocated and retained per turn
+    """
+    script = SCRIPTS[name]
+    harness = Harness(MemoryStorage(), upstream_delay, seed=1)
+    harness.latencies = []
+    # warm-up: lazy imports, caches, the decision tree and the card templates
+    for i in range(3):
+        await _converse(harness, script, f"warmup-{i}")
+    harness.latencies = []
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(i: int) -> bool:
+        async with semaphore:
+            return await _converse(harness, script, f"user-{i}")
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[bounded(i) for i in range(conversations)])
+    elapsed = time.perf_counter() - started
+    latencies = sorted(harness.latencies)
+
+    # allocations are traced in a pass of their own, tracing slows everything down
+    allocated, retained = [], []
+
+    async def traced(say):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        replies = await say
+        after, peak = tracemalloc.get_traced_memory()
+        allocated.append(peak - before)
+        retained.append(after - before)
+        return replies
+
+    tracemalloc.start()
+    try:
+        for i in range(alloc_conversations):
+            await _converse(harness, script, f"traced-{i}", traced)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "conversations": conversations,
+        "turns": len(latencies),
+        "failures": results.count(False),
+        "turns_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+        "alloc_peak_kib_per_turn": round(sum(allocated) / len(allocated) / 1024, 1) if allocated else 0.0,
+        "retained_kib_per_turn": round(sum(retained) / len(retained) / 1024, 1) if retained else 0.0,
+    }
+
+
+def _commit() -> str:
+    """Returns the current git commit or None outside a repository"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Lists the metrics which have got worse than the baseline by more than the tolerance
+
+    Args:
+        current (dict): results of this run
+        baseline (dict): results of the run to compare with
+        tolerance (float): allowed relative change, i.e. 0.15 for 15%
+
+    Returns:
+        List[str]: descriptions of the regressions
+    """
+    regressions = []
+    # metric name and whether a higher value is better
+    metrics = [("turns_per_sec", True), ("p50_ms", False), ("p95_ms", False), ("p99_ms", False),
+               ("alloc_peak_kib_per_turn", False)]
+    for branch, result in current["branches"].items():
+        before = baseline.get("branches", {}).get(branch)
+        if before is None:
+            continue
+        for metric, higher_is_better in metrics:
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f"{branch}.{metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+async def _main(args) -> int:
+    """Runs the benchmark, writes the results and compares them with the baseline
+
+    Args:
+        args: parsed command line arguments
+
+    Returns:
+        int: exit code, 1 if any conversation got a wrong answer or any metric has regressed
+    """
+    branches = {}
+    for name in args.branches:
+        branches[name] = await bench_branch(
+            name, args.conversations, args.concurrency, args.upstream_delay, args.alloc_conversations)
+    results = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "conversations": args.conversations,
+            "concurrency": args.concurrency,
+            "upstream_delay": args.upstream_delay,
+        },
+        "branches": branches,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+    failed = any(result["failures"] for result in branches.values())
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+def main(argv: List[str] = None) -> int:
+    """Parses the command line and runs the benchmark
+
+    Args:
+        argv (List[str], optional): command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: exit code
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--branches", nargs="+", choices=list(SCRIPTS), default=list(SCRIPTS),
+                        help="branches to benchmark")
+    parser.add_argument("--conversations", type=int, default=200, help="measured conversations per branch")
+    parser.add_argument("--concurrency", type=int, default=1, help="conversations run at once")
+    parser.add_argument("--upstream-delay", type=float, default=0.0, help="max seconds a fake upstream call takes")
+    parser.add_argument("--alloc-conversations", type=int, default=20,
+                        help="conversations per branch traced for allocations")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--compare", help="JSON results of a previous run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    return asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
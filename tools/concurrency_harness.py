@@ -0,0 +1,310 @@
+"""Drives many simulated conversations through DialogBot at once and checks every answer.
+
+Every conversation walks one of the bot's branches with its own choices: ChemCourier reports for
+its own channel and periods, the person selector down its own path of the decision tree, an autoreply
+with its own phone number, or the stock card. Graph and the quote source are replaced with the fakes
+from tools.fakes, whose random delays make the turns of different conversations interleave.
+A conversation fails if it gets an answer meant for another one.
+
+Usage:
+    python -m tools.concurrency_harness [--conversations 200] [--max-delay 0.01] [--think-time 0.05] [--storage memory] [--seed 1]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+from botbuilder.core import MemoryStorage
+from botbuilder.core.adapters import TestAdapter
+from botbuilder.schema import Activity, ActivityTypes, ChannelAccount, ConversationAccount
+
+from bots import DialogBot
+from data_models import UserProfile
+from dialogs import MainDialog
+from helpers.decision_tree import TreeIndex
+from helpers.quotes import QuoteService
+from helpers.sqlite_storage import SqliteStorage
+from helpers.tracked_state import TrackedConversationState, TrackedUserState
+from tools.fakes import TREE_PATH, FakeGraphClient, FakeQuoteSource
+
+CHANNEL_ID = "harness"
+
+
+class ScenarioError(AssertionError):
+    """Raised when a conversation gets a wrong answer"""
+
+
+class SimulatedConversation:
+    """A single user talking to the bot in their own conversation
+
+    Attributes:
+        user_id(str): id of the user
+        adapter(TestAdapter): adapter delivering the user's messages to the bot
+        think_time(float): max seconds the user pauses before every message
+        latencies(List[float]): duration of every turn in seconds
+    """
+
+    def __init__(self, bot: DialogBot, user_id: str, think_time: float = 0.0, seed: float = None):
+        """inits the SimulatedConversation instance
+
+        Args:
+            bot (DialogBot): bot under test, shared by all the conversations
+            user_id (str): id of the user
+            think_time (float, optional): max seconds the user pauses before every message. Defaults to 0.0.
+            seed (float, optional): seed of the pauses. Defaults to None.
+        """
+        self.user_id = user_id
+        self.think_time = think_time
+        self.latencies = []
+        self._random = random.Random(seed)
+        # TestAdapter only takes the channel from a ConversationReference, a template activity sets the ids too
+        template = Activity(
+            channel_id=CHANNEL_ID,
+            service_url="https://harness.invalid",
+            from_property=ChannelAccount(id=user_id, name=user_id),
+            recipient=ChannelAccount(id="bot", name="bot"),
+            conversation=ConversationAccount(id=f"conversation-{user_id}"),
+        )
+        self.adapter = TestAdapter(bot.on_turn, template)
+
+    async def say(self, text: str = None, value: dict = None) -> List[Activity]:
+        """Sends a message, or an Adaptive card submission if a value is passed, and waits for the turn to end
+
+        Args:
+            text (str, optional): message text. Defaults to None.
+            value (dict, optional): card submission. Defaults to None.
+
+        Returns:
+            List[Activity]: activities the bot has sent during the turn
+        """
+        # the pauses let the turns of other conversations run in between, like real users typing
+        await asyncio.sleep(self._random.uniform(0, self.think_time))
+        started = time.perf_counter()
+        await self.adapter.receive_activity(Activity(type=ActivityTypes.message, text=text, value=value))
+        self.latencies.append(time.perf_counter() - started)
+        replies = list(self.adapter.activity_buffer)
+        self.adapter.activity_buffer.clear()
+        return replies
+
+
+def _texts(replies: List[Activity]) -> str:
+    """Joins the texts of the replies"""
+    return "\n".join(reply.text or "" for reply in replies)
+
+
+def _card_values(node, slot_id: str) -> list:
+    """Collects the text of the elements with the given id from Adaptive card json"""
+    found = []
+    if isinstance(node, dict):
+        if node.get("id") == slot_id and "text" in node:
+            found.append(node["text"])
+        for child in node.values():
+            found.extend(_card_values(child, slot_id))
+    elif isinstance(node, list):
+        for child in node:
+            found.extend(_card_values(child, slot_id))
+    return found
+
+
+def _expect(condition: bool, message: str):
+    """Raises a ScenarioError if the condition doesn't hold"""
+    if not condition:
+        raise ScenarioError(message)
+
+
+async def reports_scenario(conversation: SimulatedConversation, rnd: random.Random, harness: "Harness"):
+    """Asks for ChemCourier reports of a random channel and periods"""
+    channel, prefix = rnd.choice([("Деко", "Deco"), ("Индастри", "Industry")])
+    await conversation.say("привет")
+    await conversation.say("Отчеты Химкурьер")
+    replies = await conversation.say(channel)
+    _expect(f"{prefix}2019Q4" in _texts(replies),
+            f"latest report of another channel: {_texts(replies)!r}")
+    periods = rnd.sample(["2018Q1", "2018Q4", "2019Q2", "2019Q3"], 2)
+    replies = await conversation.say(", ".join(periods))
+    expected = {f"[{prefix}{period}.pdf]" for period in periods}
+    links = {line.split("(")[0].strip()
+             for line in _texts(replies).splitlines()
+             if line.strip().startswith("[")}
+    _expect(links == expected,
+            f"expected links {sorted(expected)}, got {sorted(links)}")
+
+
+async def person_scenario(conversation: SimulatedConversation, rnd: random.Random, harness: "Harness"):
+    """Walks down a random path of the decision tree and checks the contacts on the cards"""
+    path = rnd.choice(harness.leaf_paths)
+    await conversation.say("привет")
+    replies = await conversation.say("Не знаю, к кому обратиться с вопросом")
+    for choice in path:
+        replies = await conversation.say(choice)
+    cards = [attachment.content
+             for reply in replies for attachment in (reply.attachments or [])]
+    emails = {email for card in cards for email in _card_values(card, "email")}
+    expected = set(harness.index.node(path).emails)
+    _expect(emails == expected,
+            f"path {path}: expected {sorted(expected)}, got {sorted(emails)}")
+
+
+async def autoreply_scenario(conversation: SimulatedConversation, rnd: random.Random, harness: "Harness"):
+    """Submits the autoreply card with a phone number of its own and checks the saved profile"""
+    phone = "+7999" + "".join(rnd.choice("0123456789") for _ in range(7))
+    await conversation.say("привет")
+    await conversation.say("Хочу поставить красивый автоответ")
+    submission = {
+        "startdate": "2030-01-01", "enddate": "2030-01-10", "phone": phone, "language": "RU", "reason": "Vacation",
+    }
+    for i in range(1, 5):
+        submission[f"name{i}"] = f"Colleague {i} of {conversation.user_id}"
+        submission[f"area{i}"] = f"Area {i}"
+    await conversation.say(value=submission)
+    key = f"{CHANNEL_ID}/users/{conversation.user_id}"
+    stored = (await harness.storage.read([key])).get(key, {})
+    profile = stored.get("UserProfile")
+    _expect(isinstance(profile, UserProfile) and profile.phone == phone,
+            f"expected phone {phone}, the saved profile has {getattr(profile, 'phone', None)}")
+    _expect(profile.names[0] == f"Colleague 1 of {conversation.user_id}",
+            f"saved names of another user: {profile.names}")
+
+
+async def stocks_scenario(conversation: SimulatedConversation, rnd: random.Random, harness: "Harness"):
+    """Asks for the stock card"""
+    await conversation.say("привет")
+    replies = await conversation.say("Котировки акций Tikkurila")
+    cards = [attachment
+             for reply in replies for attachment in (reply.attachments or [])]
+    _expect(len(cards) == 1, f"expected a single stock card, got {len(cards)}")
+
+
+SCENARIOS = [reports_scenario, person_scenario,
+             autoreply_scenario, stocks_scenario]
+
+
+class Harness:
+    """Bot wired to the fakes, plus everything the scenarios need to check the answers
+
+    Attributes:
+        client(FakeGraphClient): fake Graph client
+        storage: state storage
+        bot(DialogBot): bot under test
+        index(TreeIndex): decision tree used by the person selector
+        leaf_paths(List[List[str]]): paths to all the leaves of the decision tree
+    """
+
+    def __init__(self, storage, max_delay: float, seed: int = None):
+        """inits the Harness instance
+
+        Args:
+            storage: state storage
+            max_delay (float): max seconds every fake upstream call takes
+            seed (int, optional): seed of the fake delays. Defaults to None.
+        """
+        self.client = FakeGraphClient(max_delay=max_delay, seed=seed)
+        self.storage = storage
+        user_state = TrackedUserState(storage)
+        conversation_state = TrackedConversationState(storage)
+        quotes = QuoteService(FakeQuoteSource(max_delay))
+        self.bot = DialogBot(conversation_state, user_state,
+                             MainDialog(user_state, self.client, quotes))
+        with open(TREE_PATH, "r", encoding="utf-8") as f:
+            self.index = TreeIndex(json.load(f))
+        self.leaf_paths = [
+            list(path) for path, node in self.index.nodes.items() if node.is_leaf]
+
+    async def run(self, conversations: int, think_time: float = 0.0, seed: int = None) -> dict:
+        """Runs the conversations concurrently
+
+        Args:
+            conversations (int): number of conversations
+            think_time (float, optional): max seconds a user pauses before every message. Defaults to 0.0.
+            seed (int, optional): seed of the scenario choices and pauses. Defaults to None.
+
+        Returns:
+            dict: number of conversations, failures with their errors, wall time and turn latency percentiles
+        """
+        rnd = random.Random(seed)
+        jobs = []
+        for i in range(conversations):
+            scenario: Callable = SCENARIOS[i % len(SCENARIOS)]
+            conversation = SimulatedConversation(
+                self.bot, f"user-{i}", think_time, rnd.random())
+            job = scenario(conversation, random.Random(rnd.random()), self)
+            jobs.append((scenario.__name__, conversation, job))
+        started = time.perf_counter()
+        results = await asyncio.gather(*(job for _, _, job in jobs), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        failures = [
+            f"{conversation.user_id} ({name}): {result!r}"
+            for (name, conversation, _), result in zip(jobs, results) if isinstance(result, BaseException)]
+        latencies = sorted(
+            latency
+            for _, conversation, _ in jobs for latency in conversation.latencies)
+
+        def percentile(share: float) -> float:
+            return latencies[min(int(share * len(latencies)), len(latencies) - 1)] * 1000 if latencies else 0.0
+
+        return {
+            "conversations": conversations,
+            "turns": len(latencies),
+            "failures": failures,
+            "seconds": round(elapsed, 3),
+            "turn_ms_p50": round(percentile(0.5), 2),
+            "turn_ms_p95": round(percentile(0.95), 2),
+            "turn_ms_max": round(latencies[-1] * 1000 if latencies else 0.0, 2),
+        }
+
+
+async def _main(args) -> int:
+    """Builds the harness, runs it and prints the report
+
+    Args:
+        args: parsed command line arguments
+
+    Returns:
+        int: exit code, 1 if any conversation failed
+    """
+    if args.storage == "sqlite":
+        storage = SqliteStorage(
+            os.path.join(tempfile.mkdtemp(), "harness.sqlite3"))
+    else:
+        storage = MemoryStorage()
+    harness = Harness(storage, args.max_delay, args.seed)
+    report = await harness.run(args.conversations, args.think_time, args.seed)
+    if isinstance(storage, SqliteStorage):
+        await storage.close()
+    for failure in report["failures"][:20]:
+        print(failure, file=sys.stderr)
+    report["failures"] = len(report["failures"])
+    print(json.dumps(report, indent=2))
+    return 1 if report["failures"] else 0
+
+
+def main(argv: List[str] = None) -> int:
+    """Parses the command line and runs the harness
+
+    Args:
+        argv (List[str], optional): command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: exit code, 1 if any conversation failed
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conversations", type=int, default=200,
+                        help="number of simulated conversations")
+    parser.add_argument("--max-delay", type=float, default=0.01,
+                        help="max seconds a fake upstream call takes")
+    parser.add_argument("--think-time", type=float, default=0.05,
+                        help="max seconds a user pauses before a message")
+    parser.add_argument(
+        "--storage", choices=["memory", "sqlite"], default="memory", help="state storage to use")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed for reproducible runs")
+    return asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,928 @@
+"""Local stand-in for MS Graph, answering the endpoints GraphClient uses over real HTTP.
+
+It serves users, managers, presence, photos, mail tips, mailbox settings, events, subscriptions, $batch and
+a drive holding the ChemCourier report folders and the PersonDialog tree json, with paging and delta queries.
+Every endpoint can be given its own latency distribution, and 429/503 responses with Retry-After can be
+injected at random, scripted for the next calls or triggered by a request rate limit, so batching, caching
+and retries can be exercised without production Graph. Point the bot at it with
+GRAPH_RESOURCE_URI=http://127.0.0.1:8765/ and GRAPH_ACCESS_TOKEN=<any value>.
+
+    python -m tools.fake_graph_server self-test
+        runs a GraphClient against an in-process server and checks every endpoint, paging, delta, retries
+        and the circuit breaker probes.
+    python -m tools.fake_graph_server serve [--port 8765] [--latency "GET /v1.0/users/{id}/manager=lognormal:0.05:0.6"]
+        [--throttle "*=0.02"] [--unavailable "POST /v1.0/$batch=0.01"] [--retry-after 1] [--rate-limit 50]
+        [--page-size 100] [--token secret]
+        serves until interrupted. Endpoints are matched as fnmatch patterns against keys like "GET /v1.0/users/{id}".
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import fnmatch
+import itertools
+import json
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import aiohttp
+from aiohttp import web
+
+from graph_client import GraphBatcher, GraphClient, GraphResponse, drive_id, site_id
+from helpers.resilience import CircuitOpenError, Resilience
+from helpers.thumbnails import PLACEHOLDER_PATH
+from tools.fakes import TREE_PATH
+
+REPORT_CHANNELS = ["Deco", "Industry"]
+REPORT_PERIODS = [f"{year}Q{quarter}"
+                  for year in range(2015, 2020) for quarter in range(1, 5)]
+TREE_FILE = "FunctionalAreas/selector_dialog_tree.json"
+
+
+class Latency:
+    """Distribution of the time an endpoint takes to answer
+
+    Attributes:
+        kind (str): "fixed", "uniform", "lognormal" or "exp"
+        params (Tuple[float, ...]): seconds for fixed, (min, max) for uniform,
+        (median, sigma) for lognormal and the mean for exp
+    """
+
+    def __init__(self, kind: str, *params: float):
+        """inits the Latency instance
+
+        Args:
+            kind (str): "fixed", "uniform", "lognormal" or "exp"
+            *params (float): parameters of the distribution
+
+        Raises:
+            ValueError: raised for an unknown distribution or a wrong number of parameters
+        """
+        arity = {"fixed": 1, "uniform": 2, "lognormal": 2, "exp": 1}
+        if arity.get(kind) != len(params):
+            raise ValueError(f"Unknown latency distribution: {kind}{params}")
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        """Parses a distribution given as "kind:param[:param]", i.e. "lognormal:0.05:0.6"
+
+        Args:
+            spec (str): distribution spec
+
+        Returns:
+            Latency: parsed distribution
+        """
+        kind, *params = spec.split(":")
+        return cls(kind, *[float(param) for param in params])
+
+    def sample(self, rng: random.Random) -> float:
+        """Draws a latency
+
+        Args:
+            rng (random.Random): random source
+
+        Returns:
+            float: seconds
+        """
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return median * rng.lognormvariate(0.0, sigma)
+        return rng.expovariate(1.0 / self.params[0]) if self.params[0] > 0 else 0.0
+
+
+class FakeGraphServer:
+    """aiohttp application answering the Graph endpoints GraphClient uses, with injectable latency and faults.
+    The data is synthetic and deterministic: every email is a user whose object id is "id-" + email,
+    the drive holds the report folders of REPORT_CHANNELS for REPORT_PERIODS and the tree json.
+
+    Attributes:
+        latency (Dict[str, Latency]): latency distributions keyed by endpoint patterns, the first match applies
+        throttle (Dict[str, float]): share of the calls answered with 429, keyed by endpoint patterns
+        unavailable (Dict[str, float]): share of the calls answered with 503, keyed by endpoint patterns
+        retry_after (float): seconds sent in the Retry-After header of the injected faults
+        rate_limit (float): requests per second above which the calls are throttled, 0 disables the limit
+        page_size (int): max items per page of the collections, whatever $top asks for
+        token (str): bearer token the calls must carry or None to accept any
+        url (str): base URI once the server is started, i.e. "http://127.0.0.1:8765/"
+        presences (Dict[str, Tuple[str, str]]): (availability, activity) keyed by the object id
+        subscriptions (Dict[str, dict]): live subscriptions keyed by the id
+        autoreplies (Dict[str, dict]): automaticRepliesSetting keyed by the email
+        events (Dict[str, List[dict]]): created events keyed by the email
+        calls (collections.Counter): number of calls keyed by the endpoint, sub-requests of $batch included
+        stats (dict): requests/batches/throttled/unavailable/unauthorized counters
+    """
+
+    def __init__(
+            self,
+            latency: Dict[str, Latency] = None,
+            throttle: Dict[str, float] = None,
+            unavailable: Dict[str, float] = None,
+            retry_after: float = 1.0,
+            rate_limit: float = 0,
+            page_size: int = 200,
+            token: str = None,
+            seed: int = None):
+        """inits the FakeGraphServer instance
+
+        Args:
+            latency (Dict[str, Latency], optional): latency distributions keyed by endpoint patterns. Defaults to none.
+            throttle (Dict[str, float], optional): share of the calls answered with 429. Defaults to none.
+            unavailable (Dict[str, float], optional): share of the calls answered with 503. Defaults to none.
+            retry_after (float, optional): seconds sent in the Retry-After header. Defaults to 1.0.
+            rate_limit (float, optional): requests per second above which the calls are throttled. Defaults to 0.
+            page_size (int, optional): max items per page of the collections. Defaults to 200.
+            token (str, optional): bearer token the calls must carry. Defaults to None.
+            seed (int, optional): seed of the latencies and the faults. Defaults to None.
+        """
+        self.latency = dict(latency or {})
+        self.throttle = dict(throttle or {})
+        self.unavailable = dict(unavailable or {})
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.page_size = page_size
+        self.token = token or None
+        self.url = None
+        self.presences = {}
+        self.subscriptions = {}
+        self.autoreplies = {}
+        self.events = collections.defaultdict(list)
+        self.calls = collections.Counter()
+        self.stats = {"requests": 0, "batches": 0,
+                      "throttled": 0, "unavailable": 0, "unauthorized": 0}
+        self._rng = random.Random(seed)
+        # faults scripted for the next calls: [pattern, status, remaining count, retry_after]
+        self._scripted = []
+        self._recent = collections.deque()
+        self._runner = None
+        self._ids = itertools.count(1)
+        # driveItems keyed by the id, ids keyed by the path, and the change log of the delta queries
+        self._items = {}
+        self._paths = {}
+        self._changes = []
+        self._delta_epoch = 0
+        self._seed_drive()
+
+    def fail_next(self, pattern: str, status: int = 429, count: int = 1, retry_after: float = None):
+        """Makes the next calls matching an endpoint pattern fail
+
+        Args:
+            pattern (str): fnmatch pattern of the endpoint key, i.e. "GET /v1.0/users/{id}/manager"
+            status (int, optional): status to answer with. Defaults to 429.
+            count (int, optional): number of calls to fail. Defaults to 1.
+            retry_after (float, optional): Retry-After seconds, None leaves the header out. Defaults to retry_after.
+        """
+        self._scripted.append(
+            [pattern, status, count, self.retry_after if retry_after is None else retry_after])
+
+    def put_report(self, channel: str, period: str, latest: bool = False) -> str:
+        """Adds or updates a report file, recording the change for the delta queries
+
+        Args:
+            channel (str): name of the channel folder, i.e. "Deco"
+            period (str): period of the report, i.e. "2020Q1"
+            latest (bool, optional): value of the "Latest" column. Defaults to False.
+
+        Returns:
+            str: id of the driveItem
+        """
+        return self._put_file(f"{channel}/{channel}{period}.pdf", b"%PDF-1.4\n", latest)
+
+    def expire_delta(self):
+        """Makes all the delta links issued so far expire, so they are answered with 410"""
+        self._delta_epoch += 1
+
+    async def set_presence(self, user_id: str, availability: str, activity: str):
+        """Changes a status and posts rich notifications to the subscriptions watching the user
+
+        Args:
+            user_id (str): object id of the user
+            availability (str): new availability, i.e. "Busy"
+            activity (str): new activity, i.e. "InACall"
+        """
+        self.presences[user_id] = (availability, activity)
+        resource = f"communications/presences('{user_id}')"
+        async with aiohttp.ClientSession() as session:
+            for subscription in list(self.subscriptions.values()):
+                if f"'{user_id}'" not in subscription["resource"]:
+                    continue
+                body = {"value": [{
+                    "subscriptionId": subscription["id"],
+                    "clientState": subscription.get("clientState", ""),
+                    "changeType": "updated",
+                    "resource": resource,
+                    "resourceData": {
+                        "@odata.type": "#Microsoft.Graph.presence", "@odata.id": resource, "id": user_id,
+                        "availability": availability, "activity": activity},
+                }]}
+                try:
+                    async with session.post(subscription["notificationUrl"], json=body):
+                        pass
+                except aiohttp.ClientError:
+                    pass
+
+    def app(self) -> web.Application:
+        """Creates the aiohttp application serving every path
+
+        Returns:
+            web.Application: application to run
+        """
+        app = web.Application(client_max_size=4 * 1024 ** 2)
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Starts serving
+
+        Args:
+            host (str, optional): interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): port to listen on, 0 picks a free one. Defaults to 0.
+
+        Returns:
+            str: base URI to configure as GRAPH_RESOURCE_URI
+        """
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/"
+        return self.url
+
+    async def stop(self):
+        """Stops serving"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        """Answers a single HTTP call
+
+        Args:
+            request (web.Request): incoming call
+
+        Returns:
+            web.Response: Graph-like response
+        """
+        if request.path.startswith("/download/"):
+            # pre-authenticated download links need no token
+            item = self._items.get(request.path[len("/download/"):])
+            if item is None or "content" not in item:
+                return web.Response(status=404)
+            return web.Response(body=item["content"], content_type="application/octet-stream")
+        if self.token is not None and request.headers.get("Authorization") != "Bearer " + self.token:
+            self.stats["unauthorized"] += 1
+            return web.json_response(self._error("InvalidAuthenticationToken", "Access token is invalid"), status=401)
+        body = None
+        if request.can_read_body:
+            try:
+                body = await request.json()
+            except ValueError:
+                return web.json_response(self._error("BadRequest", "Malformed json body"), status=400)
+        status, headers, content = await self._serve(request.method, request.path_qs, body)
+        if isinstance(content, (bytes, type(None))):
+            return web.Response(status=status, headers=headers, body=content)
+        return web.json_response(content, status=status, headers=headers)
+
+    async def _serve(self, method: str, path_qs: str, body) -> Tuple[int, dict, object]:
+        """Answers a call or a $batch sub-request: injects the faults and the latency, then dispatches it
+
+        Args:
+            method (str): HTTP method
+            path_qs (str): path with the query, i.e. "/v1.0/users/a@b.c/manager"
+            body: parsed json body or None
+
+        Returns:
+            Tuple[int, dict, object]: status, headers and the json body, or the bytes of a binary one
+        """
+        key = GraphClient._endpoint_key(method, path_qs)
+        self.calls[key] += 1
+        self.stats["requests"] += 1
+        await asyncio.sleep(self._latency(key))
+        fault = self._fault(key)
+        if fault is not None:
+            return fault
+        path, query = urlsplit(path_qs).path, dict(
+            parse_qsl(urlsplit(path_qs).query))
+        try:
+            return await self._dispatch(method, path, query, body)
+        except KeyError:
+            return 404, {}, self._error("itemNotFound", f"{path} isn't found")
+
+    def _latency(self, key: str) -> float:
+        """Draws the latency of an endpoint
+
+        Args:
+            key (str): endpoint key
+
+        Returns:
+            float: seconds, 0 if no pattern matches
+        """
+        for pattern, latency in self.latency.items():
+            if fnmatch.fnmatchcase(key, pattern):
+                return max(latency.sample(self._rng), 0.0)
+        return 0.0
+
+    def _fault(self, key: str) -> Tuple[int, dict, object]:
+        """Decides whether the call fails: scripted faults first, then the rate limit, then the random ones
+
+        Args:
+            key (str): endpoint key
+
+        Returns:
+            Tuple[int, dict, object]: failed response or None if the call goes through
+        """
+        for fault in self._scripted:
+            pattern, status, count, retry_after = fault
+            if count > 0 and fnmatch.fnmatchcase(key, pattern):
+                fault[2] -= 1
+                self._scripted = [f for f in self._scripted if f[2] > 0]
+                return self._failure(status, retry_after)
+        if self.rate_limit > 0:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] >= 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.rate_limit:
+                return self._failure(429, max(1.0 - (now - self._recent[0]), 0.0))
+            self._recent.append(now)
+        for status, shares in ((429, self.throttle), (503, self.unavailable)):
+            share = next((s for pattern, s in shares.items()
+                          if fnmatch.fnmatchcase(key, pattern)), 0.0)
+            if share and self._rng.random() < share:
+                return self._failure(status, self.retry_after)
+        return None
+
+    def _failure(self, status: int, retry_after: float) -> Tuple[int, dict, object]:
+        """Builds a throttled or unavailable response
+
+        Args:
+            status (int): 429 or 503
+            retry_after (float): Retry-After seconds or None to leave the header out
+
+        Returns:
+            Tuple[int, dict, object]: failed response
+        """
+        self.stats["throttled" if status == 429 else "unavailable"] += 1
+        headers = {} if retry_after is None else {"Retry-After": f"{retry_after:g}"}
+        code = "TooManyRequests" if status == 429 else "ServiceUnavailable"
+        return status, headers, self._error(code, "Injected by the fake Graph server")
+
+    async def _dispatch(self, method: str, path: str, query: dict, body) -> Tuple[int, dict, object]:
+        """Routes a call to its endpoint
+
+        Args:
+            method (str): HTTP method
+            path (str): path without the query
+            query (dict): query parameters
+            body: parsed json body or None
+
+        Raises:
+            KeyError: raised if the path doesn't address anything
+
+        Returns:
+            Tuple[int, dict, object]: status, headers and the body
+        """
+        version, _, rest = path.lstrip("/").partition("/")
+        if version not in ("v1.0", "beta"):
+            raise KeyError(path)
+        segments = rest.split("/")
+        route = (method, segments[0])
+        if route == ("POST", "$batch"):
+            return await self._batch(version, body)
+        if segments[0] == "users" and len(segments) >= 2:
+            return self._user(method, segments[1], "/".join(segments[2:]), query, body)
+        if route == ("POST", "communications") and segments[1:] == ["getPresencesByUserId"]:
+            return 200, {}, {"value": [self._presence(user_id) for user_id in (body or {}).get("ids", [])]}
+        if segments[0] == "subscriptions":
+            return await self._subscription(method, segments[1] if len(segments) > 1 else None, body)
+        if method == "GET" and segments[0] == "sites" and len(segments) >= 5 and segments[2] == "drives":
+            return self._drive(version, "/".join(segments[4:]), query)
+        raise KeyError(path)
+
+    def _user(self, method: str, email: str, tail: str, query: dict, body) -> Tuple[int, dict, object]:
+        """Answers the /users/{email} endpoints
+
+        Args:
+            method (str): HTTP method
+            email (str): email of the user
+            tail (str): rest of the path, i.e. "manager"
+            query (dict): query parameters
+            body: parsed json body or None
+
+        Returns:
+            Tuple[int, dict, object]: status, headers and the body
+        """
+        email = email.lower()
+        user_id = "id-" + email
+        name = email.split("@")[0].replace(".", " ").title()
+        route = (method, tail)
+        if route == ("GET", ""):
+            user = {"id": user_id, "displayName": name,
+                    "jobTitle": "Employee", "mail": email}
+            if "$select" in query:
+                selected = query["$select"].split(",")
+                user = {k: v for k, v in user.items() if k in selected}
+            return 200, {}, user
+        if route == ("GET", "manager"):
+            return 200, {}, {"id": "id-manager." + email, "displayName": f"Manager of {name}"}
+        if route == ("GET", "presence"):
+            return 200, {}, self._presence(user_id)
+        if route == ("GET", "photo"):
+            return 200, {}, {"@odata.mediaEtag": f'W/"{email}-1"', "width": 96, "height": 96}
+        if method == "GET" and tail in ("photo/$value", "photos/96x96/$value"):
+            return 200, {"Content-Type": "image/png"}, self._photo
+        if route == ("POST", "getMailTips"):
+            setting = self.autoreplies.get(email)
+            replies = {"message": ""}
+            if setting is not None:
+                replies = {
+                    "message": setting.get("internalReplyMessage", ""),
+                    "scheduledEndTime": setting.get("scheduledEndDateTime")}
+            return 200, {}, {"value": [{"emailAddress": {"address": email}, "automaticReplies": replies}]}
+        if route == ("PATCH", "mailboxSettings"):
+            self.autoreplies[email] = (body or {}).get(
+                "automaticRepliesSetting", {})
+            return 200, {}, {"automaticRepliesSetting": self.autoreplies[email]}
+        if route == ("POST", "events"):
+            event = dict(body or {}, id=uuid.uuid4().hex)
+            self.events[email].append(event)
+            return 201, {}, event
+        raise KeyError(tail)
+
+    def _presence(self, user_id: str) -> dict:
+        """Returns the presence resource of a user
+
+        Args:
+            user_id (str): object id of the user
+
+        Returns:
+            dict: presence with the availability and activity keys
+        """
+        availability, activity = self.presences.get(
+            user_id, ("Available", "Available"))
+        return {"id": user_id, "availability": availability, "activity": activity}
+
+    async def _subscription(self, method: str, subscription_id: str, body) -> Tuple[int, dict, object]:
+        """Answers the /subscriptions endpoints. New subscriptions are validated the way Graph does
+
+        Args:
+            method (str): HTTP method
+            subscription_id (str): id of the subscription or None for the collection
+            body: parsed json body or None
+
+        Returns:
+            Tuple[int, dict, object]: status, headers and the body
+        """
+        if subscription_id is None and method == "POST":
+            token = uuid.uuid4().hex
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(body["notificationUrl"], params={"validationToken": token}) as response:
+                        valid = response.status == 200 and await response.text() == token
+            except (aiohttp.ClientError, KeyError):
+                valid = False
+            if not valid:
+                return 400, {}, self._error("ValidationError", "Notification endpoint must respond with the token")
+            subscription = dict(body, id=str(uuid.uuid4()))
+            self.subscriptions[subscription["id"]] = subscription
+            return 201, {}, subscription
+        subscription = self.subscriptions[subscription_id]
+        if method == "PATCH":
+            subscription["expirationDateTime"] = (body or {}).get(
+                "expirationDateTime", subscription["expirationDateTime"])
+            return 200, {}, subscription
+        if method == "DELETE":
+            del self.subscriptions[subscription_id]
+            return 204, {}, None
+        raise KeyError(subscription_id)
+
+    def _drive(self, version: str, tail: str, query: dict) -> Tuple[int, dict, object]:
+        """Answers the drive endpoints: items by path or id, folder children, file content and delta
+
+        Args:
+            version (str): API version, used in the paging links
+            tail (str): path after /sites/{site}/drives/{drive}/, i.e. "root:/Deco:/children"
+            query (dict): query parameters
+
+        Returns:
+            Tuple[int, dict, object]: status, headers and the body
+        """
+        base = f"{self.url}{version}/sites/{site_id}/drives/{drive_id}/"
+        if tail == "root/delta":
+            return self._delta(base + tail, query)
+        if tail.startswith("items/"):
+            return 200, {}, self._item(self._items[tail[len("items/"):]])
+        if not tail.startswith("root:/"):
+            raise KeyError(tail)
+        path, _, action = tail[len("root:/"):].partition(":")
+        item = self._items[self._paths[path]]
+        if action == "/children":
+            children = sorted(
+                (i for i in self._items.values()
+                 if i["parentReference"]["id"] == item["id"]),
+                key=lambda i: i["name"])
+            return 200, {}, self._page(base + tail, query, [self._item(i) for i in children])
+        if action == "/content":
+            return 200, {"Content-Type": "application/octet-stream"}, item["content"]
+        return 200, {}, self._item(item)
+
+    def _page(self, url: str, query: dict, items: list, extra: dict = None) -> dict:
+        """Cuts a page out of a collection, linking the next one with $skiptoken
+
+        Args:
+            url (str): URI of the collection without the query
+            query (dict): query parameters of the call
+            items (list): whole collection
+            extra (dict, optional): keys added to the last page, i.e. the delta link. Defaults to None.
+
+        Returns:
+            dict: page with the value and, unless it's the last one, the @odata.nextLink keys
+        """
+        size = min(int(query.get("$top", self.page_size)), self.page_size)
+        start = int(query.get("$skiptoken", 0))
+        page = {"value": items[start:start + size]}
+        if start + size < len(items):
+            page["@odata.nextLink"] = url + "?" + \
+                urlencode(dict(query, **{"$skiptoken": start + size}))
+        elif extra:
+            page.update(extra)
+        return page
+
+    def _delta(self, url: str, query: dict) -> Tuple[int, dict, object]:
+        """Answers a delta query with the items changed since its token
+
+        Args:
+            url (str): URI of the delta endpoint
+            query (dict): query parameters, the token is "latest" or "{epoch}.{position in the change log}"
+
+        Returns:
+            Tuple[int, dict, object]: status, headers and the body, 410 for an expired token
+        """
+        token = query.get("token", "latest")
+        epoch, _, since = token.partition(".")
+        if token != "latest" and epoch != str(self._delta_epoch):
+            return 410, {}, self._error("resyncRequired", "The delta token has expired")
+        since = len(self._changes) if token == "latest" else int(since)
+        changed = {}
+        for item_id in self._changes[since:]:
+            changed[item_id] = self._items.get(
+                item_id, {"id": item_id, "deleted": {"state": "deleted"}})
+        link = url + "?" + \
+            urlencode({"token": f"{self._delta_epoch}.{len(self._changes)}"})
+        options = {k: v for k, v in query.items() if k != "token"}
+        return 200, {}, self._page(
+            url, dict(options, token=token), [
+                self._item(item) for item in changed.values()],
+            {"@odata.deltaLink": link})
+
+    async def _batch(self, version: str, body) -> Tuple[int, dict, object]:
+        """Answers a $batch call, running the sub-requests concurrently with their own latency and faults
+
+        Args:
+            version (str): API version of the sub-requests
+            body: parsed json body with the requests list
+
+        Returns:
+            Tuple[int, dict, object]: status, headers and the body with the responses list
+        """
+        requests = (body or {}).get("requests", [])
+        if not requests or len(requests) > GraphBatcher.MAX_BATCH_SIZE:
+            return 400, {}, self._error("BadRequest", "A batch must have 1 to 20 requests")
+        self.stats["batches"] += 1
+
+        async def answer(request: dict) -> dict:
+            status, headers, content = await self._serve(
+                request["method"], f"/{version}/" + request["url"].lstrip("/"), request.get("body"))
+            item = {"id": request["id"],
+                    "status": status, "headers": dict(headers)}
+            if isinstance(content, bytes):
+                item["body"] = base64.b64encode(content).decode()
+            elif content is not None:
+                item["headers"].setdefault("Content-Type", "application/json")
+                item["body"] = content
+            return item
+
+        return 200, {}, {"responses": await asyncio.gather(*[answer(request) for request in requests])}
+
+    def _item(self, item: dict) -> dict:
+        """Returns the public representation of a driveItem, without its content
+
+        Args:
+            item (dict): stored driveItem
+
+        Returns:
+            dict: driveItem with the listItem fields and the download link of a file
+        """
+        public = {k: v for k, v in item.items()
+                  if k not in ("content", "latest")}
+        if "file" in item:
+            public["listItem"] = {"fields": {"Latest": item["latest"]}}
+            public["@microsoft.graph.downloadUrl"] = f"{self.url}download/{item['id']}"
+        return public
+
+    def _seed_drive(self):
+        """Fills the drive with the report folders and the tree json"""
+        self._items["root"] = {"id": "root", "name": "root",
+                               "folder": {}, "parentReference": {"id": None}}
+        self._paths[""] = "root"
+        for channel in REPORT_CHANNELS:
+            for period in REPORT_PERIODS:
+                self.put_report(channel, period,
+                                latest=period == REPORT_PERIODS[-1])
+        with open(TREE_PATH, "rb") as f:
+            self._put_file(TREE_FILE, f.read())
+        with open(PLACEHOLDER_PATH, "rb") as f:
+            self._photo = f.read()
+        # the seeded state is the starting point of the delta queries
+        self._changes = []
+
+    def _folder(self, path: str) -> str:
+        """Returns the id of a folder, creating the missing ones along the path
+
+        Args:
+            path (str): path of the folder, "" for the root
+
+        Returns:
+            str: id of the folder
+        """
+        if path not in self._paths:
+            parent, _, name = path.rpartition("/")
+            item_id = f"folder-{next(self._ids)}"
+            self._items[item_id] = {"id": item_id, "name": name, "folder": {},
+                                    "parentReference": {"id": self._folder(parent)}}
+            self._paths[path] = item_id
+        return self._paths[path]
+
+    def _put_file(self, path: str, content: bytes, latest: bool = False) -> str:
+        """Adds or updates a file, recording the change for the delta queries
+
+        Args:
+            path (str): path of the file
+            content (bytes): file content
+            latest (bool, optional): value of the "Latest" column. Defaults to False.
+
+        Returns:
+            str: id of the driveItem
+        """
+        parent, _, name = path.rpartition("/")
+        item_id = self._paths.get(path) or f"file-{next(self._ids)}"
+        version = self._items.get(item_id, {}).get("version", 0) + 1
+        self._items[item_id] = {
+            "id": item_id, "name": name, "file": {"mimeType": "application/octet-stream"},
+            "parentReference": {"id": self._folder(parent)}, "content": content, "latest": latest,
+            "version": version, "eTag": f'"{item_id},{version}"', "cTag": f'"c:{item_id},{version}"',
+            "lastModifiedDateTime": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+        self._paths[path] = item_id
+        self._changes.append(item_id)
+        return item_id
+
+    @staticmethod
+    def _error(code: str, message: str) -> dict:
+        """Builds a Graph error body
+
+        Args:
+            code (str): error code
+            message (str): error message
+
+        Returns:
+            dict: body with the error key
+        """
+        return {"error": {"code": code, "message": message}}
+
+
+async def self_test() -> List[str]:
+    """Runs a GraphClient against an in-process server
+
+    Returns:
+        List[str]: failed checks, empty if everything works
+    """
+    failures = []
+
+    def check(condition: bool, message: str):
+        if not condition:
+            failures.append(message)
+
+    await _check_probe_release(check)
+
+    server = FakeGraphServer(page_size=7, token="fake-token", seed=1)
+    url = await server.start()
+    client = GraphClient(resource_uri=url, access_token="fake-token")
+    client.resilience.base_delay = 0.01
+    try:
+        emails = [f"person.{i}@example.com" for i in range(5)]
+        users = await asyncio.gather(*[client.get_user(email) for email in emails])
+        check(users[0] == ["Person 0", "Employee", emails[0]],
+              f"unexpected user: {users[0]}")
+        check(server.stats["batches"] >= 1,
+              "concurrent lookups aren't batched")
+        check(await client.get_manager(emails[0]) == "Manager of Person 0", "manager isn't fetched")
+
+        server.presences["id-" + emails[1]] = ("Busy", "InACall")
+        presences = await client.get_presences(emails)
+        check(presences[emails[1]] == "Busy, InACall",
+              f"unexpected presences: {presences}")
+        bulk_calls = server.calls[
+            "POST /v1.0/communications/getPresencesByUserId"]
+        check(bulk_calls == 1, "presences aren't fetched in bulk")
+        check((await client.get_picture_for_adap(emails[0])).startswith("data:image/png;base64,"), "photo isn't fetched")
+
+        check(await client.set_autoreply(emails[2], "Away", "2030-01-01", "2030-01-10"), "autoreply isn't set")
+        check(await client.set_oof(emails[2], "Vacation", "2030-01-01", "2030-01-10"), "event isn't created")
+        check(bool(await client.get_autorepl_date(emails[2])), "autoreply date isn't read back")
+
+        meta = await client.get_item_meta(site_id, drive_id, TREE_FILE)
+        tree = json.loads((await client.download_file(site_id, drive_id, TREE_FILE + ":/content")).decode("utf-8"))
+        check(bool(meta.get("cTag")) and bool(tree), "tree json isn't served")
+
+        latest = REPORT_PERIODS[-1]
+        check(await client.get_latest("Deco") == f"Deco{latest}.pdf", "latest report isn't found")
+        check(
+            server.calls["GET /v1.0/sites/{id}/drives/{id}/root:{path}:/children"] > 1, "children aren't paged")
+        links = await client.get_links(site_id, drive_id, [f"Deco{latest}.pdf", f"Deco{REPORT_PERIODS[-2]}.pdf"])
+        async with aiohttp.ClientSession() as session:
+            async with session.get(links[f"Deco{latest}.pdf"]) as response:
+                check(response.status == 200, "download link doesn't work")
+
+        server.put_report("Deco", latest, latest=False)
+        server.put_report("Deco", "2020Q1", latest=True)
+        await client.report_catalogue().sync()
+        check(await client.get_latest("Deco") == "Deco2020Q1.pdf", "delta changes aren't applied")
+        server.expire_delta()
+        await client.report_catalogue().sync()
+        check(await client.get_latest("Deco") == "Deco2020Q1.pdf", "expired delta link isn't recovered from")
+
+        retries = client.resilience.stats["retries"]
+        server.fail_next(
+            "GET /v1.0/users/{id}/manager", 429, 2, retry_after=0.01)
+        check(await client.get_manager(emails[3]) == "Manager of Person 3", "throttled call isn't retried")
+        server.fail_next(
+            "POST /v1.0/communications/getPresencesByUserId", 503, 1, retry_after=0.01)
+        check((await client.get_presences(["fresh.person@example.com"]))["fresh.person@example.com"]
+              == "Available, Available",
+              "unavailable call with Retry-After isn't retried")
+        retried = client.resilience.stats["retries"] - retries
+        check(retried == 3, "unexpected number of retries")
+
+        server.fail_next("GET /v1.0/users/{id}", 429, 1, retry_after=0.01)
+        batched = await asyncio.gather(*[client.get_user(f"batched.{i}@example.com") for i in range(3)])
+        check(all(user[1] == "Employee" for user in batched),
+              "throttled sub-request of a batch isn't retried")
+
+        intruder = GraphClient(resource_uri=url, access_token="wrong-token")
+        try:
+            check((await intruder.get_user("someone@example.com"))[0] == "Not Available", "wrong token is accepted")
+        finally:
+            await intruder.close()
+    finally:
+        await client.close()
+        await server.stop()
+    return failures
+
+
+async def _check_probe_release(check):
+    """Checks that a half-open probe which raises or is cancelled instead of answering doesn't keep
+    the circuit of its endpoint open for good
+
+    Args:
+        check: records a failed check
+    """
+    now = [0.0]
+    resilience = Resilience(
+        max_retries=0, failure_threshold=1, reset_timeout=500, clock=lambda: now[0])
+
+    async def answer(status: int) -> GraphResponse:
+        return GraphResponse(status, {}, b"")
+
+    async def no_token() -> GraphResponse:
+        raise ValueError("token acquisition failed")
+
+    async def call(send) -> int:
+        try:
+            return (await resilience.call("GET /probe", send)).status_code
+        except CircuitOpenError:
+            return None
+
+    await call(lambda: answer(503))
+    check(await call(lambda: answer(200)) is None, "circuit isn't opened by a 503")
+    now[0] += 500
+    try:
+        await call(no_token)
+    except ValueError:
+        pass
+    check(await call(lambda: answer(200)) is None, "raising probe doesn't open the circuit again")
+    now[0] += 500
+    check(await call(lambda: answer(200)) == 200, "circuit is stuck after a raising probe")
+
+    await call(lambda: answer(503))
+    now[0] += 500
+    probe = asyncio.ensure_future(call(lambda: asyncio.sleep(3600)))
+    await asyncio.sleep(0)
+    probe.cancel()
+    await asyncio.gather(probe, return_exceptions=True)
+    check(await call(lambda: answer(200)) == 200, "circuit is stuck after a cancelled probe")
+
+
+def _rules(specs: List[str], parse) -> dict:
+    """Parses "pattern=value" options, the pattern may contain "="-free fnmatch wildcards
+
+    Args:
+        specs (List[str]): options as given on the command line
+        parse: converts the value
+
+    Returns:
+        dict: values keyed by the endpoint pattern
+    """
+    rules = {}
+    for spec in specs or []:
+        pattern, _, value = spec.rpartition("=")
+        rules[pattern or "*"] = parse(value)
+    return rules
+
+
+async def _serve(args):
+    """Serves until interrupted, printing the counters every minute
+
+    Args:
+        args: parsed command line arguments
+    """
+    server = FakeGraphServer(
+        latency=_rules(args.latency, Latency.parse),
+        throttle=_rules(args.throttle, float),
+        unavailable=_rules(args.unavailable, float),
+        retry_after=args.retry_after,
+        rate_limit=args.rate_limit,
+        page_size=args.page_size,
+        token=args.token,
+        seed=args.seed)
+    url = await server.start(args.host, args.port)
+    print(
+        f"Serving fake Graph at {url}, set GRAPH_RESOURCE_URI={url} GRAPH_ACCESS_TOKEN={args.token or 'any'}")
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(json.dumps(dict(server.stats, calls=dict(server.calls))))
+    finally:
+        await server.stop()
+
+
+def main(argv: List[str] = None) -> int:
+    """Parses the command line and runs the chosen command
+
+    Args:
+        argv (List[str], optional): command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: exit code
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser(
+        "self-test", help="check a GraphClient against an in-process server")
+    serve = commands.add_parser("serve", help="serve until interrupted")
+    serve.add_argument("--host", default="127.0.0.1",
+                       help="interface to listen on")
+    serve.add_argument("--port", type=int, default=8765,
+                       help="port to listen on")
+    serve.add_argument("--latency", action="append",
+                       help='endpoint pattern and distribution, i.e. "*=uniform:0.02:0.2" or "GET */manager=fixed:0.1"')
+    serve.add_argument("--throttle", action="append",
+                       help='endpoint pattern and share of 429s, i.e. "*=0.05"')
+    serve.add_argument("--unavailable", action="append",
+                       help='endpoint pattern and share of 503s, i.e. "*=0.01"')
+    serve.add_argument("--retry-after", type=float, default=1.0,
+                       help="Retry-After seconds of the injected faults")
+    serve.add_argument("--rate-limit", type=float, default=0,
+                       help="requests per second above which calls get 429")
+    serve.add_argument("--page-size", type=int, default=200,
+                       help="max items per page")
+    serve.add_argument(
+        "--token", help="bearer token the calls must carry, any is accepted by default")
+    serve.add_argument("--seed", type=int,
+                       help="seed of the latencies and the faults")
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        try:
+            asyncio.run(_serve(args))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    failures = asyncio.run(self_test())
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    print(json.dumps({"failures": len(failures)}))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""In-process stand-ins for the upstreams the bot talks to: MS Graph and the quote source.
+They answer deterministically, derived from their arguments, after a random delay,
+so concurrent conversations interleave the way they do against the real services.
+"""
+import asyncio
+import itertools
+import os
+import random
+import time
+import uuid
+
+import aiohttp
+
+from helpers.quotes import QuoteSnapshot
+
+TREE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "helpers", "selector_dialog_tree.json")
+
+
+class FakeGraphClient:
+    """Answers the GraphClient calls used by the dialogs without any network access
+
+    Attributes:
+        min_delay(float): min seconds every call takes
+        max_delay(float): max seconds every call takes
+        calls(dict): number of calls keyed by the method name
+        autoreplies(dict): messages set by set_autoreply keyed by the email
+        presences(dict): statuses keyed by the object id, "Available, Available" for the ones missing
+        subscriptions(dict): live subscriptions keyed by the id
+    """
+
+    def __init__(self, min_delay: float = 0.0, max_delay: float = 0.01, seed: int = None):
+        """inits the FakeGraphClient instance
+
+        Args:
+            min_delay (float, optional): min seconds every call takes. Defaults to 0.0.
+            max_delay (float, optional): max seconds every call takes. Defaults to 0.01.
+            seed (int, optional): seed of the delays. Defaults to None.
+        """
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.calls = {}
+        self.autoreplies = {}
+        self.presences = {}
+        self.subscriptions = {}
+        self._subscription_ids = itertools.count(1)
+        self._random = random.Random(seed)
+        with open(TREE_PATH, "rb") as f:
+            self._tree = f.read()
+
+    async def _delay(self, name: str):
+        """Counts the call and waits for a random time
+
+        Args:
+            name (str): method name
+        """
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self._random.uniform(self.min_delay, self.max_delay))
+
+    async def get_latest(self, channel: str) -> str:
+        await self._delay("get_latest")
+        return f"{channel}2019Q4.pdf"
+
+    async def get_links(self, site_id: str, drive_id: str, checklist: list) -> dict:
+        await self._delay("get_links")
+        return {name: f"https://reports.invalid/{name}" for name in checklist}
+
+    async def get_item_meta(self, site_id: str, drive_id: str, path: str) -> dict:
+        await self._delay("get_item_meta")
+        return {"cTag": "fake-1"}
+
+    async def download_file(self, site_id: str, drive_id: str, query: str) -> bytes:
+        await self._delay("download_file")
+        return self._tree
+
+    async def get_manager(self, email: str) -> str:
+        await self._delay("get_manager")
+        return f"Manager of {email}"
+
+    async def get_autorepl_date(self, email: str) -> str:
+        await self._delay("get_autorepl_date")
+        return ""
+
+    async def get_presence(self, email: str) -> str:
+        await self._delay("get_presence")
+        return "Available"
+
+    async def get_presences(self, emails: list) -> dict:
+        await self._delay("get_presences")
+        return {email: "Available" for email in emails}
+
+    async def get_user_ids(self, emails: list) -> dict:
+        await self._delay("get_user_ids")
+        return {email: "id-" + email.lower() for email in emails}
+
+    async def get_presences_by_ids(self, user_ids: list) -> dict:
+        await self._delay("get_presences_by_ids")
+        return {user_id: self.presences.get(user_id, "Available, Available") for user_id in user_ids}
+
+    async def create_subscription(self, resource: str, notification_url: str, client_state: str, expiration,
+                                  change_type: str = "updated") -> dict:
+        """Validates the notification URL the way Graph does, then records the subscription"""
+        await self._delay("create_subscription")
+        token = uuid.uuid4().hex
+        async with aiohttp.ClientSession() as session:
+            async with session.post(notification_url, params={"validationToken": token}) as response:
+                if response.status != 200 or await response.text() != token:
+                    raise ValueError(f"Notification URL validation failed: {response.status}")
+        subscription = {
+            "id": f"subscription-{next(self._subscription_ids)}",
+            "resource": resource,
+            "notificationUrl": notification_url,
+            "clientState": client_state,
+            "expirationDateTime": expiration.isoformat(),
+        }
+        self.subscriptions[subscription["id"]] = subscription
+        return subscription
+
+    async def renew_subscription(self, subscription_id: str, expiration) -> bool:
+        await self._delay("renew_subscription")
+        if subscription_id not in self.subscriptions:
+            return False
+        self.subscriptions[subscription_id]["expirationDateTime"] = expiration.isoformat()
+        return True
+
+    async def delete_subscription(self, subscription_id: str) -> bool:
+        await self._delay("delete_subscription")
+        self.subscriptions.pop(subscription_id, None)
+        return True
+
+    async def get_picture_for_adap(self, email: str) -> str:
+        await self._delay("get_picture_for_adap")
+        return f"data:image/png;base64,{email}"
+
+    async def get_placeholder_picture(self) -> str:
+        return "data:image/png;base64,"
+
+    async def get_user(self, email: str) -> list:
+        await self._delay("get_user")
+        return [email.split("@")[0].replace(".", " "), "Employee", email]
+
+    async def set_autoreply(self, email: str, message: str, startdate: str, enddate: str) -> bool:
+        await self._delay("set_autoreply")
+        self.autoreplies[email] = message
+        return True
+
+    async def set_oof(self, email: str, subject: str, startdate: str, enddate: str) -> bool:
+        await self._delay("set_oof")
+        return True
+
+    async def close(self):
+        pass
+
+
+class FakeQuoteSource:
+    """Quote source returning a fixed snapshot after a random delay"""
+
+    def __init__(self, max_delay: float = 0.01):
+        """inits the FakeQuoteSource instance
+
+        Args:
+            max_delay (float, optional): max seconds every fetch takes. Defaults to 0.01.
+        """
+        self.max_delay = max_delay
+
+    async def fetch(self) -> QuoteSnapshot:
+        await asyncio.sleep(random.uniform(0, self.max_delay))
+        return QuoteSnapshot("January 31 2020", 12.5, 12.0, 12.8, 11.9, 0.5, 4.0, time.time())
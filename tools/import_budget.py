@@ -0,0 +1,137 @@
+"""Checks the time it takes to import the bot against the import-time budget.
+
+Imports app.py in fresh interpreters several times and takes the best run. The frameworks the bot
+is built on (aiohttp and botbuilder) are imported first, so the bot's own share is measured separately.
+Fails if the whole import or the bot's own share exceed the budget, or if any of the modules
+which must only be loaded lazily gets imported.
+
+Usage:
+    python -m tools.import_budget [--runs 5] [--total-ms 1500] [--own-ms 100] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import List, NamedTuple, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# frameworks the bot can't start without, their import time is outside of the bot's control
+FRAMEWORKS = "aiohttp.web, botbuilder.core, botbuilder.core.integration, botbuilder.dialogs, botbuilder.schema"
+
+# heavy packages which are only needed by some of the dialogs and must be imported on first use
+LAZY = {"PIL", "yattag", "yfinance", "pandas", "pyperclip"}
+
+
+class ImportRecord(NamedTuple):
+    """A single line of the -X importtime output
+
+    Attributes:
+        name(str): dotted module name
+        self_us(int): time spent in the module itself in microseconds
+        cumulative_us(int): time including the modules it imported first in microseconds
+        depth(int): nesting level in the import tree
+    """
+    name: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def _run(code: str, *flags: str) -> subprocess.CompletedProcess:
+    """Runs code in a fresh interpreter started in the repo root
+
+    Args:
+        code (str): python code
+        *flags (str): extra interpreter flags
+
+    Raises:
+        RuntimeError: raised if the code fails
+
+    Returns:
+        subprocess.CompletedProcess: finished process
+    """
+    result = subprocess.run(
+        [sys.executable, *flags, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{code} failed:\n{result.stderr}")
+    return result
+
+
+def wall_times_ms(runs: int) -> Tuple[float, float]:
+    """Measures the wall-clock time of importing the frameworks and then the rest of app,
+    taking the best of several fresh interpreters for each
+
+    Args:
+        runs (int): number of interpreters to start
+
+    Returns:
+        Tuple[float, float]: milliseconds spent in the frameworks and in the bot itself
+    """
+    code = ("import time; t0 = time.perf_counter(); "
+            f"import {FRAMEWORKS}; t1 = time.perf_counter(); "
+            "import app; t2 = time.perf_counter(); print(t1 - t0, t2 - t1)")
+    samples = [tuple(map(float, _run(code).stdout.split())) for _ in range(runs)]
+    return min(s[0] for s in samples) * 1000, min(s[1] for s in samples) * 1000
+
+
+def import_tree(module: str) -> List[ImportRecord]:
+    """Imports a module with -X importtime and returns the import tree
+
+    Args:
+        module (str): module name
+
+    Returns:
+        List[ImportRecord]: records in the order printed by the interpreter, i.e. children first
+    """
+    records = []
+    for line in _run(f"import {module}", "-X", "importtime").stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        stripped = name.lstrip(" ")
+        records.append(ImportRecord(
+            stripped, int(self_us), int(cumulative_us), (len(name) - len(stripped) - 1) // 2))
+    return records
+
+
+def main(argv: List[str] = None) -> int:
+    """Runs the check
+
+    Args:
+        argv (List[str], optional): command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: exit code, 1 if the budget is exceeded
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="number of fresh imports, the best one counts")
+    parser.add_argument("--total-ms", type=float, default=1500, help="budget for import app")
+    parser.add_argument("--own-ms", type=float, default=100, help="budget for the bot's own share")
+    parser.add_argument("--top", type=int, default=15, help="number of the slowest modules to print")
+    args = parser.parse_args(argv)
+
+    records = import_tree("app")
+    print(f"{'cumulative ms':>14}  module")
+    for record in sorted(records, key=lambda r: r.cumulative_us, reverse=True)[:args.top]:
+        print(f"{record.cumulative_us / 1000:>14.1f}  {'  ' * record.depth}{record.name}")
+
+    framework_ms, own_ms = wall_times_ms(args.runs)
+    total_ms = framework_ms + own_ms
+    print(f"\nimport app: {total_ms:.1f} ms (budget {args.total_ms:.0f} ms)")
+    print(f"frameworks: {framework_ms:.1f} ms")
+    print(f"bot's own share: {own_ms:.1f} ms (budget {args.own_ms:.0f} ms)")
+
+    failed = False
+    if total_ms > args.total_ms or own_ms > args.own_ms:
+        print("import-time budget exceeded", file=sys.stderr)
+        failed = True
+    lazy = sorted({r.name for r in records if r.name.split(".")[0] in LAZY})
+    if lazy:
+        print(f"imported eagerly but must be lazy: {', '.join(lazy)}", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""Local stand-in for the Graph change notification sender, to exercise the presence subscriptions without Graph.
+
+    python -m tools.presence_notifier self-test
+        subscribes a PresenceSubscriptions instance through the fake Graph client against a local notification
+        route, then sends rich, plain and forged notifications and checks the statuses served to the cards.
+    python -m tools.presence_notifier validate --url http://localhost:3978/api/presence
+        sends the validation request Graph sends while subscribing.
+    python -m tools.presence_notifier send --url ... --client-state ... --subscription-id ... --user-id ...
+        [--availability Busy --activity InACall]
+        posts a single presence notification to a running bot.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import uuid
+from typing import List
+
+import aiohttp
+from aiohttp import web
+
+from helpers.presence_subscriptions import PresenceSubscriptions
+from tools.fakes import FakeGraphClient
+
+
+class NotificationSender:
+    """Posts validation requests and presence notifications shaped like the ones Graph sends
+
+    Attributes:
+        url (str): notification route
+        client_state (str): secret the notifications carry
+    """
+
+    def __init__(self, url: str, client_state: str):
+        """inits the NotificationSender instance
+
+        Args:
+            url (str): notification route
+            client_state (str): secret the notifications carry
+        """
+        self.url = url
+        self.client_state = client_state
+
+    async def validate(self) -> bool:
+        """Sends the validation request Graph sends while subscribing
+
+        Returns:
+            bool: True if the route has echoed the token as plain text
+        """
+        token = uuid.uuid4().hex
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.url, params={"validationToken": token}) as response:
+                return response.status == 200 and response.content_type == "text/plain" \
+                    and await response.text() == token
+
+    async def notify(self, subscription_id: str, user_id: str, availability: str = None, activity: str = None) -> int:
+        """Posts a presence notification. With the availability and the activity it's a rich notification
+        carrying the status, without them the receiver has to fetch the status itself
+
+        Args:
+            subscription_id (str): id of the subscription the notification belongs to
+            user_id (str): object id of the user whose presence has changed
+            availability (str, optional): new availability, i.e. "Busy". Defaults to None.
+            activity (str, optional): new activity, i.e. "InACall". Defaults to None.
+
+        Returns:
+            int: HTTP status of the response
+        """
+        resource = f"communications/presences('{user_id}')"
+        data = {"@odata.type": "#Microsoft.Graph.presence",
+                "@odata.id": resource, "id": user_id}
+        if availability is not None and activity is not None:
+            data.update(availability=availability, activity=activity)
+        body = {"value": [{
+            "subscriptionId": subscription_id,
+            "clientState": self.client_state,
+            "changeType": "updated",
+            "resource": resource,
+            "resourceData": data,
+        }]}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.url, json=body) as response:
+                return response.status
+
+
+async def self_test() -> List[str]:
+    """Runs the whole subscription flow locally
+
+    Returns:
+        List[str]: failed checks, empty if everything works
+    """
+    failures = []
+
+    def check(condition: bool, message: str):
+        if not condition:
+            failures.append(message)
+
+    client = FakeGraphClient(max_delay=0.0)
+    emails = ["first.contact@example.com", "second.contact@example.com"]
+
+    async def contacts() -> List[str]:
+        return emails
+
+    # the URL is only known once the route is listening on a free port
+    subscriptions = PresenceSubscriptions(
+        client, contacts, "", "secret", refresh_window=0.05)
+    app = web.Application()
+    app.router.add_post("/api/presence", subscriptions.notification_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        url = subscriptions.notification_url = f"http://127.0.0.1:{port}/api/presence"
+        sender = NotificationSender(url, "secret")
+
+        check(await sender.validate(), "validation token isn't echoed")
+        await subscriptions.sync()
+        check(len(client.subscriptions) == 1,
+              f"expected one subscription, got {len(client.subscriptions)}")
+        subscription_id = next(iter(client.subscriptions), None)
+        first, second = ("id-" + email for email in emails)
+        check(subscriptions.get(emails[0]) == "Available, Available",
+              "initial status isn't fetched")
+
+        calls = dict(client.calls)
+        check(await sender.notify(subscription_id, first, "Busy", "InACall") == 202, "notification isn't accepted")
+        check(subscriptions.get(emails[0]) == "Busy, InACall",
+              "rich notification isn't applied")
+        check(client.calls == calls, "rich notification has cost Graph calls")
+
+        client.presences[second] = "Away, Away"
+        await sender.notify(subscription_id, second)
+        await asyncio.sleep(0.2)
+        check(subscriptions.get(emails[1]) == "Away, Away",
+              "status of a plain notification isn't fetched")
+
+        await NotificationSender(url, "forged").notify(subscription_id, first, "Offline", "Offline")
+        await sender.notify("unknown-subscription", first, "Offline", "Offline")
+        check(subscriptions.get(emails[0]) == "Busy, InACall",
+              "forged notification is applied")
+        check(subscriptions.stats["rejected"] == 2,
+              f"expected 2 rejected, got {subscriptions.stats['rejected']}")
+
+        # the subscription is about to expire: it's renewed, not recreated
+        subscriptions.renew_margin = subscriptions.lifetime
+        await subscriptions.sync()
+        check(subscriptions.stats["renewed"] == 1
+              and len(client.subscriptions) == 1, "subscription isn't renewed")
+
+        # Graph has dropped it: the contacts are subscribed to anew
+        client.subscriptions.clear()
+        await subscriptions.sync()
+        check(len(client.subscriptions) == 1,
+              "lost subscription isn't recreated")
+    finally:
+        await subscriptions.stop()
+        check(not client.subscriptions, "subscriptions aren't cancelled on stop")
+        await runner.cleanup()
+    return failures
+
+
+async def _main(args) -> int:
+    """Runs the chosen command
+
+    Args:
+        args: parsed command line arguments
+
+    Returns:
+        int: exit code
+    """
+    if args.command == "self-test":
+        failures = await self_test()
+        for failure in failures:
+            print(failure, file=sys.stderr)
+        print(json.dumps({"failures": len(failures)}))
+        return 1 if failures else 0
+    sender = NotificationSender(args.url, args.client_state)
+    if args.command == "validate":
+        valid = await sender.validate()
+        print("validated" if valid else "validation failed")
+        return 0 if valid else 1
+    status = await sender.notify(args.subscription_id, args.user_id, args.availability, args.activity)
+    print(status)
+    return 0 if status == 202 else 1
+
+
+def main(argv: List[str] = None) -> int:
+    """Parses the command line and runs the chosen command
+
+    Args:
+        argv (List[str], optional): command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: exit code
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("self-test", help="run the whole flow locally")
+    validate = commands.add_parser(
+        "validate", help="send the validation request")
+    validate.add_argument("--url", required=True,
+                          help="notification route of the bot")
+    send = commands.add_parser("send", help="post a presence notification")
+    send.add_argument("--url", required=True,
+                      help="notification route of the bot")
+    send.add_argument("--client-state", required=True,
+                      help="PRESENCE_CLIENT_STATE of the bot")
+    send.add_argument("--subscription-id", required=True,
+                      help="id of a subscription created by the bot")
+    send.add_argument("--user-id", required=True, help="object id of the user")
+    send.add_argument("--availability", help="new availability, i.e. Busy")
+    send.add_argument("--activity", help="new activity, i.e. InACall")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args.command = "self-test"
+    if args.command == "validate":
+        args.client_state = ""
+    return asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())